@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Servicios de autenticación con Snowflake
+Evita el inicio de sesión interactivo (SSO en navegador) en cada ejecución: usa par de claves
+cuando está configurado, o el ID token cacheado por el conector mientras siga vigente
+"""
+import os
+import time
+import webbrowser
+
+from snowflake.snowpark import Session
+
+from logger_config import logger
+
+# Autenticación desatendida por par de claves: si SNOWFLAKE_PRIVATE_KEY_FILE está definida se usa
+# SNOWFLAKE_JWT en lugar de externalbrowser (la clave pública debe estar registrada en el usuario).
+VARIABLE_CLAVE_PRIVADA = "SNOWFLAKE_PRIVATE_KEY_FILE"
+VARIABLE_CLAVE_PRIVADA_PWD = "SNOWFLAKE_PRIVATE_KEY_FILE_PWD"
+
+# Si SNOWFLAKE_SIN_NAVEGADOR=1, la conexión falla en cuanto el conector intenta abrir el navegador
+# (su ID token cacheado no existe o ya no es válido), útil en ejecuciones programadas donde nadie
+# puede completar el SSO.
+VARIABLE_SIN_NAVEGADOR = "SNOWFLAKE_SIN_NAVEGADOR"
+
+
+# ============================================================================
+# FUNCIONES DE BLOQUEO DEL NAVEGADOR
+# ============================================================================
+
+class NavegadorRequeridoError(RuntimeError):
+    """El conector necesitó abrir el navegador para el SSO y la ejecución no lo permite."""
+
+
+class _BloqueoNavegador:
+    """
+    Durante el bloque `with`, reemplaza las funciones de apertura del módulo `webbrowser` (las que
+    usa el conector para el SSO) por una que lanza NavegadorRequeridoError sin abrir nada.
+    `error` guarda esa excepción si el conector llegó a pedir el navegador.
+    """
+
+    _FUNCIONES = ("open", "open_new", "open_new_tab")
+
+    def __init__(self):
+        self.error = None
+        self._originales = {}
+
+    def _bloquear(self, url, *args, **kwargs):
+        self.error = NavegadorRequeridoError(
+            f"El ID token cacheado de Snowflake no existe o no es válido y {VARIABLE_SIN_NAVEGADOR}=1 impide abrir "
+            f"el navegador. Ejecute una vez de forma interactiva o configure {VARIABLE_CLAVE_PRIVADA}."
+        )
+        raise self.error
+
+    def __enter__(self):
+        for nombre in self._FUNCIONES:
+            self._originales[nombre] = getattr(webbrowser, nombre)
+            setattr(webbrowser, nombre, self._bloquear)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        for nombre, funcion in self._originales.items():
+            setattr(webbrowser, nombre, funcion)
+        return False
+
+
+# ============================================================================
+# FUNCIÓN PRINCIPAL: CREAR SESIÓN
+# ============================================================================
+
+def configuracion_autenticacion(config_base):
+    """
+    Retorna (configuración, método) para conectar a Snowflake sin interacción cuando es posible:
+    - 'par_de_claves' si SNOWFLAKE_PRIVATE_KEY_FILE está definida.
+    - 'externalbrowser' con caché de ID token del conector en caso contrario.
+    """
+    config = dict(config_base)
+    ruta_clave = os.environ.get(VARIABLE_CLAVE_PRIVADA)
+    if ruta_clave:
+        config["AUTHENTICATOR"] = "SNOWFLAKE_JWT"
+        config["PRIVATE_KEY_FILE"] = ruta_clave
+        if os.environ.get(VARIABLE_CLAVE_PRIVADA_PWD):
+            config["PRIVATE_KEY_FILE_PWD"] = os.environ[VARIABLE_CLAVE_PRIVADA_PWD]
+        return config, "par_de_claves"
+
+    config["CLIENT_STORE_TEMPORARY_CREDENTIAL"] = True
+    return config, "externalbrowser"
+
+
+def crear_sesion_snowflake(config_base):
+    """
+    Crea la sesión de Snowpark con el método de autenticación más rápido disponible.
+    Con externalbrowser, el conector reutiliza el ID token cacheado y solo abre el navegador
+    si el token no existe o ya no es válido. Con SNOWFLAKE_SIN_NAVEGADOR=1 ese intento de abrir
+    el navegador hace fallar la conexión de inmediato (NavegadorRequeridoError).
+    Lanza excepción si la conexión falla.
+    """
+    config, metodo = configuracion_autenticacion(config_base)
+    sin_navegador = metodo == "externalbrowser" and os.environ.get(VARIABLE_SIN_NAVEGADOR) == "1"
+
+    if metodo == "externalbrowser":
+        logger.info(
+            "Conectando con Snowflake con el ID token cacheado "
+            + ("(sin navegador)." if sin_navegador else "(se abrirá el navegador solo si el token no es válido).")
+        )
+    else:
+        logger.info("Conectando con Snowflake mediante par de claves (SNOWFLAKE_JWT).")
+
+    inicio = time.monotonic()
+    if sin_navegador:
+        with _BloqueoNavegador() as bloqueo:
+            try:
+                session = Session.builder.configs(config).create()
+            except Exception as e:
+                # El conector puede envolver la excepción; lo que importa es que pidió el navegador.
+                if bloqueo.error is not None and e is not bloqueo.error:
+                    raise bloqueo.error from e
+                raise
+    else:
+        session = Session.builder.configs(config).create()
+
+    logger.info(f"Conexión con Snowflake establecida en {time.monotonic() - inicio:.1f} s (método: {metodo}).")
+    return session
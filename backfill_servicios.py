@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Servicios de backfill histórico paralelo
+Reparte las descargas pendientes de la cola en shards por rango de ACTIVITY_ID,
+las ejecuta en N procesos de trabajo y registra todos los resultados desde un
+único proceso escritor de SQLite
+"""
+import multiprocessing
+
+from logger_config import logger
+from snowflake_servicios import descargar_a_archivo, registrar_resultado_descarga, fecha_hora_actual
+from escritor_sqlite_servicios import ServicioEscritura, conectar_lectura
+
+# Cantidad máxima de resultados que el proceso escritor agrupa en una misma transacción.
+ESCRITOR_TAMANO_LOTE = 50
+
+
+# ============================================================================
+# FUNCIONES DE GESTIÓN DE SHARDS
+# ============================================================================
+
+def crear_tabla_backfill_shards(cursor):
+    """Crea la tabla con el plan y el progreso de los shards del backfill si no existe"""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS backfill_shards (
+        shard INTEGER PRIMARY KEY,
+        total_shards INTEGER NOT NULL,
+        activity_desde INTEGER NOT NULL,
+        activity_hasta INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'planificado',
+        pendientes INTEGER NOT NULL DEFAULT 0,
+        descargadas INTEGER NOT NULL DEFAULT 0,
+        fallidas INTEGER NOT NULL DEFAULT 0,
+        actualizado TEXT
+    )
+    """)
+    logger.info("Tabla 'backfill_shards' asegurada en SQLite.")
+
+
+def planificar_shards(conn_sqlite, total_shards):
+    """
+    Divide las descargas pendientes en `total_shards` rangos contiguos de ACTIVITY_ID
+    con una cantidad de URLs lo más pareja posible, y reemplaza el plan anterior.
+    Retorna la lista de shards como tuplas (shard, activity_desde, activity_hasta, pendientes).
+    """
+    cursor = conn_sqlite.cursor()
+    crear_tabla_backfill_shards(cursor)
+    cursor.execute("""
+        SELECT c.ACTIVITY_ID, COUNT(*)
+        FROM download_queue AS q
+        JOIN comentarios AS c ON c.id = q.comment_id
+        WHERE q.status = 'pendiente'
+        GROUP BY c.ACTIVITY_ID
+        ORDER BY c.ACTIVITY_ID
+    """)
+    actividades = cursor.fetchall()
+    total_urls = sum(cantidad for _, cantidad in actividades)
+
+    shards = []
+    objetivo = total_urls / total_shards if total_shards else 0
+    desde, acumulado = None, 0
+    for i, (activity_id, cantidad) in enumerate(actividades):
+        if desde is None:
+            desde = activity_id
+        acumulado += cantidad
+        restantes = len(actividades) - i - 1
+        ultimo_shard = len(shards) == total_shards - 1
+        if restantes == 0 or (not ultimo_shard and acumulado >= objetivo):
+            shards.append((len(shards) + 1, desde, activity_id, acumulado))
+            desde, acumulado = None, 0
+
+    cursor.execute("DELETE FROM backfill_shards")
+    cursor.executemany("""
+        INSERT INTO backfill_shards (shard, total_shards, activity_desde, activity_hasta, pendientes, actualizado)
+        VALUES (?,?,?,?,?,?)
+    """, [(shard, len(shards), desde, hasta, pendientes, fecha_hora_actual()) for shard, desde, hasta, pendientes in shards])
+    conn_sqlite.commit()
+
+    for shard, desde, hasta, pendientes in shards:
+        logger.info(f"Shard {shard}/{len(shards)}: ACTIVITY_ID {desde}..{hasta}, {pendientes} URLs pendientes.")
+    return shards
+
+
+def obtener_shards(conn_sqlite, shard=None):
+    """Retorna los shards planificados (o solo el indicado) como tuplas (shard, activity_desde, activity_hasta, pendientes)."""
+    cursor = conn_sqlite.cursor()
+    crear_tabla_backfill_shards(cursor)
+    if shard is None:
+        cursor.execute("SELECT shard, activity_desde, activity_hasta, pendientes FROM backfill_shards ORDER BY shard")
+    else:
+        cursor.execute("SELECT shard, activity_desde, activity_hasta, pendientes FROM backfill_shards WHERE shard = ?", (shard,))
+    return cursor.fetchall()
+
+
+def total_shards_planificados(conn_sqlite):
+    """Retorna la cantidad de shards del plan actual, o None si no hay plan."""
+    cursor = conn_sqlite.cursor()
+    crear_tabla_backfill_shards(cursor)
+    cursor.execute("SELECT MAX(total_shards) FROM backfill_shards")
+    return cursor.fetchone()[0]
+
+
+def resumen_shards(conn_sqlite):
+    """Retorna el estado y los contadores de cada shard del último backfill."""
+    cursor = conn_sqlite.cursor()
+    cursor.execute("SELECT shard, status, pendientes, descargadas, fallidas FROM backfill_shards ORDER BY shard")
+    return cursor.fetchall()
+
+
+# ============================================================================
+# PROCESOS DE TRABAJO Y ESCRITOR
+# ============================================================================
+
+def _proceso_shard(db_path, shard, total_shards, activity_desde, activity_hasta, cola_resultados, ignorar_reintentos=False):
+    """
+    Proceso de trabajo: descarga las URLs pendientes de su rango de ACTIVITY_ID.
+    Solo lee SQLite (conexión de solo lectura, también para la caché de descargas);
+    cada resultado se envía al proceso escritor.
+    Con `ignorar_reintentos` (re-ejecución explícita del shard) también se procesan las filas cuyo
+    próximo reintento aún no vence.
+    """
+    conn = conectar_lectura(db_path)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT q.id, q.comment_id, q.ordinal, q.url, q.attempts
+            FROM download_queue AS q
+            JOIN comentarios AS c ON c.id = q.comment_id
+            WHERE q.status = 'pendiente'
+              AND (? OR q.next_attempt_at IS NULL OR q.next_attempt_at <= ?)
+              AND c.ACTIVITY_ID BETWEEN ? AND ?
+            ORDER BY q.id
+        """, (ignorar_reintentos, fecha_hora_actual(), activity_desde, activity_hasta))
+        filas = cursor.fetchall()
+
+        cola_resultados.put(("shard", shard, "en_proceso", len(filas), 0, 0))
+        logger.info(f"Shard {shard}/{total_shards}: iniciando {len(filas)} descargas (ACTIVITY_ID {activity_desde}..{activity_hasta}).")
+
+        # La conexión de solo lectura se mantiene abierta para consultar la caché de descargas.
+        descargadas = fallidas = 0
+        for i, (queue_id, comment_id, ordinal, url, attempts) in enumerate(filas, start=1):
+            ruta, error, entrada_cache = descargar_a_archivo(url, comment_id, ordinal, conn)
+            cola_resultados.put(("descarga", queue_id, comment_id, ordinal, attempts, ruta, error, entrada_cache))
+            if error is None:
+                descargadas += 1
+            else:
+                fallidas += 1
+            if i % 10 == 0 or i == len(filas):
+                logger.info(f"Shard {shard}/{total_shards}: {i}/{len(filas)} procesadas ({descargadas} descargadas, {fallidas} fallidas).")
+    finally:
+        conn.close()
+
+    # El estado final lo decide el escritor, que ya aplicó todos los resultados del shard.
+    cola_resultados.put(("shard", shard, "terminado", len(filas), descargadas, fallidas))
+
+
+def _estado_final_shard(conn, shard, fallidas):
+    """
+    Estado de un shard que terminó: 'con_fallos' si hubo descargas fallidas, 'con_pendientes' si aún
+    quedan filas 'pendiente' en su rango (por ejemplo, reintentos que no vencían) y 'completado' si no.
+    """
+    if fallidas:
+        return "con_fallos"
+    restantes = conn.execute("""
+        SELECT COUNT(*)
+        FROM download_queue AS q
+        JOIN comentarios AS c ON c.id = q.comment_id
+        JOIN backfill_shards AS s ON c.ACTIVITY_ID BETWEEN s.activity_desde AND s.activity_hasta
+        WHERE s.shard = ? AND q.status = 'pendiente'
+    """, (shard,)).fetchone()[0]
+    return "con_pendientes" if restantes else "completado"
+
+
+def _aplicar_resultado(conn, resultado):
+    """Aplica en SQLite un resultado enviado por un proceso de trabajo."""
+    tipo, *datos = resultado
+    if tipo == "descarga":
+        registrar_resultado_descarga(conn, *datos)
+    elif tipo == "shard":
+        shard, status, pendientes, descargadas, fallidas = datos
+        if status == "terminado":
+            status = _estado_final_shard(conn, shard, fallidas)
+        conn.execute("""
+            UPDATE backfill_shards SET status = ?, pendientes = ?, descargadas = ?, fallidas = ?, actualizado = ?
+            WHERE shard = ?
+        """, (status, pendientes, descargadas, fallidas, fecha_hora_actual(), shard))
+
+
+def _proceso_escritor(db_path, cola_resultados):
+    """
+    Proceso escritor: única conexión de escritura a SQLite durante el backfill.
+    Reenvía los resultados recibidos a un ServicioEscritura, que los agrupa en transacciones de
+    hasta ESCRITOR_TAMANO_LOTE elementos; un resultado que falla no descarta al resto del lote.
+    Termina al recibir None, después de escribir todo lo recibido.
+    """
+    with ServicioEscritura(db_path, tamano_lote=ESCRITOR_TAMANO_LOTE) as servicio:
+        for resultado in iter(cola_resultados.get, None):
+            servicio.enviar(_aplicar_resultado, resultado)
+
+
+# ============================================================================
+# FUNCIÓN PRINCIPAL: EJECUTAR BACKFILL
+# ============================================================================
+
+def ejecutar_backfill(conn_sqlite, db_path, shard=None):
+    """
+    Ejecuta los shards planificados en paralelo (un proceso por shard) o solo el shard indicado.
+    La cantidad total de shards es la del plan guardado en `backfill_shards`.
+    Los resultados se registran desde un único proceso escritor; la conexión `conn_sqlite`
+    del proceso principal solo se usa antes y después de la ejecución.
+    Al re-ejecutar un solo shard se ignoran los tiempos de reintento de sus filas pendientes.
+    Retorna True si todos los shards ejecutados quedaron 'completado'; para los demás (proceso
+    con error, descargas fallidas o filas aún pendientes) se indica cómo re-ejecutarlos.
+    """
+    shards = obtener_shards(conn_sqlite, shard)
+    if not shards:
+        logger.warning("No hay shards planificados para ejecutar." if shard is None else f"No existe el shard {shard} en el plan actual.")
+        return False
+    total_shards = total_shards_planificados(conn_sqlite)
+    conn_sqlite.commit()
+
+    cola_resultados = multiprocessing.Queue()
+    escritor = multiprocessing.Process(target=_proceso_escritor, args=(db_path, cola_resultados), name="backfill-escritor")
+    escritor.start()
+
+    trabajadores = {}
+    for numero, desde, hasta, _ in shards:
+        proceso = multiprocessing.Process(
+            target=_proceso_shard,
+            args=(db_path, numero, total_shards, desde, hasta, cola_resultados, shard is not None),
+            name=f"backfill-shard-{numero}"
+        )
+        proceso.start()
+        trabajadores[numero] = proceso
+
+    fallidos = []
+    for numero, proceso in trabajadores.items():
+        proceso.join()
+        if proceso.exitcode != 0:
+            logger.error(f"El proceso del shard {numero} terminó con código {proceso.exitcode}.")
+            fallidos.append(numero)
+
+    cola_resultados.put(None)
+    escritor.join()
+
+    if fallidos:
+        conn_sqlite.executemany(
+            "UPDATE backfill_shards SET status = 'fallido', actualizado = ? WHERE shard = ?",
+            [(fecha_hora_actual(), numero) for numero in fallidos]
+        )
+        conn_sqlite.commit()
+
+    incompletos = []
+    for numero, status, pendientes, descargadas, fallidas in resumen_shards(conn_sqlite):
+        logger.info(f"Shard {numero}: {status} ({descargadas}/{pendientes} descargadas, {fallidas} fallidas).")
+        if numero in trabajadores and status != "completado":
+            incompletos.append(numero)
+    for numero in incompletos:
+        logger.error(f"Para re-ejecutar solo el shard {numero}: python main.py backfill {total_shards} {numero}")
+
+    return not incompletos
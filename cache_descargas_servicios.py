@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Servicios de caché de descargas por URL
+Registra por URL normalizada el hash, tamaño, validadores HTTP (ETag/Last-Modified) y ruta local
+de cada imagen descargada, para servir las repeticiones desde disco o revalidarlas con un GET
+condicional en lugar de abrir el navegador otra vez
+"""
+import os
+import hashlib
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+
+from logger_config import logger
+
+# Una entrada validada hace menos de esto se sirve desde disco sin consultar el origen.
+CACHE_DESCARGAS_REVALIDAR_HORAS = 24
+CACHE_DESCARGAS_TIMEOUT_SEG = 30
+
+PUERTOS_POR_DEFECTO = {"http": 80, "https": 443}
+
+COLUMNAS_CACHE = (
+    "url_normalizada", "url", "src", "sha256", "size", "etag", "last_modified",
+    "content_type", "local_path", "descargado_at", "validado_at"
+)
+
+
+# ============================================================================
+# FUNCIONES DE UTILIDAD
+# ============================================================================
+
+def _fecha_hora_actual():
+    """Fecha y hora local en el formato de texto usado en las tablas de SQLite."""
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def normalizar_url(url):
+    """
+    Clave de caché de una URL: esquema y host en minúsculas, sin puerto por defecto,
+    sin fragmento y con los parámetros de la query ordenados.
+    """
+    partes = urlsplit(url.strip())
+    esquema = partes.scheme.lower()
+    host = (partes.hostname or "").lower()
+    if partes.port and partes.port != PUERTOS_POR_DEFECTO.get(esquema):
+        host = f"{host}:{partes.port}"
+    if partes.username:
+        host = f"{partes.username}@{host}"
+    query = urlencode(sorted(parse_qsl(partes.query, keep_blank_values=True)))
+    return urlunsplit((esquema, host, partes.path or "/", query, ""))
+
+
+def calcular_sha256(ruta):
+    """SHA-256 del contenido de un archivo."""
+    digest = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(bloque)
+    return digest.hexdigest()
+
+
+# ============================================================================
+# FUNCIONES DE LA TABLA DE CACHÉ
+# ============================================================================
+
+def crear_tabla_cache_descargas(cursor):
+    """Crea la tabla de caché de descargas por URL si no existe"""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS download_cache (
+        url_normalizada TEXT PRIMARY KEY,
+        url TEXT NOT NULL,
+        src TEXT,
+        sha256 TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        etag TEXT,
+        last_modified TEXT,
+        content_type TEXT,
+        local_path TEXT NOT NULL,
+        descargado_at TEXT,
+        validado_at TEXT
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_download_cache_local_path ON download_cache (local_path)")
+    logger.info("Tabla 'download_cache' asegurada en SQLite.")
+
+
+def obtener_entrada_cache(conn_sqlite, url):
+    """Retorna la entrada de caché de una URL como diccionario, o None si no existe."""
+    cursor = conn_sqlite.execute(
+        f"SELECT {', '.join(COLUMNAS_CACHE)} FROM download_cache WHERE url_normalizada = ?",
+        (normalizar_url(url),)
+    )
+    fila = cursor.fetchone()
+    return dict(zip(COLUMNAS_CACHE, fila)) if fila else None
+
+
+def url_de_ruta(conn_sqlite, ruta):
+    """Retorna la URL normalizada cuya descarga está guardada en `ruta`, o None."""
+    fila = conn_sqlite.execute(
+        "SELECT url_normalizada FROM download_cache WHERE local_path = ? LIMIT 1", (ruta,)
+    ).fetchone()
+    return fila[0] if fila else None
+
+
+def guardar_entrada_cache(conn_sqlite, entrada):
+    """Inserta o reemplaza una entrada de caché. No hace commit."""
+    conn_sqlite.execute(
+        f"INSERT OR REPLACE INTO download_cache ({', '.join(COLUMNAS_CACHE)}) VALUES ({', '.join('?' for _ in COLUMNAS_CACHE)})",
+        tuple(entrada.get(columna) for columna in COLUMNAS_CACHE)
+    )
+
+
+def nueva_entrada_cache(url, ruta, metadatos=None, descargado_at=None):
+    """Construye la entrada de caché de una imagen guardada en `ruta`."""
+    metadatos = metadatos or {}
+    ahora = _fecha_hora_actual()
+    return {
+        "url_normalizada": normalizar_url(url),
+        "url": url,
+        "src": metadatos.get("src"),
+        "sha256": calcular_sha256(ruta),
+        "size": os.path.getsize(ruta),
+        "etag": metadatos.get("etag"),
+        "last_modified": metadatos.get("last_modified"),
+        "content_type": metadatos.get("content_type"),
+        "local_path": ruta,
+        "descargado_at": descargado_at or ahora,
+        "validado_at": ahora,
+    }
+
+
+# ============================================================================
+# FUNCIONES DE VALIDACIÓN
+# ============================================================================
+
+def archivo_coincide(entrada, ruta=None):
+    """Indica si el archivo (por defecto, el de la entrada) existe y tiene el tamaño y hash registrados."""
+    ruta = ruta or entrada["local_path"]
+    try:
+        if os.path.getsize(ruta) != entrada["size"]:
+            return False
+    except OSError:
+        return False
+    return calcular_sha256(ruta) == entrada["sha256"]
+
+
+def entrada_vigente(entrada, horas=CACHE_DESCARGAS_REVALIDAR_HORAS):
+    """Indica si la entrada se validó contra el origen hace menos de `horas`."""
+    if not entrada.get("validado_at"):
+        return False
+    validado = datetime.strptime(entrada["validado_at"], "%Y-%m-%d %H:%M:%S")
+    return datetime.now() - validado < timedelta(hours=horas)
+
+
+def revalidar_condicional(entrada):
+    """
+    Revalida una entrada con un GET condicional (If-None-Match / If-Modified-Since) a la URL
+    de la imagen (`src`, o la URL original si no se conoce). Retorna (estado, contenido, metadatos):
+    - ('no_modificada', None, metadatos) ante un 304, o ante un 200 cuyo contenido tiene el mismo
+      SHA-256 registrado (el origen no soporta GET condicional o la entrada no tiene validadores).
+    - ('modificada', bytes, metadatos) ante un 200 con contenido de imagen distinto.
+    - ('error', None, None) si el origen no responde como se espera (por ejemplo, pide iniciar
+      sesión o devuelve HTML); el llamador debe volver a la descarga con navegador.
+    """
+    url_imagen = entrada.get("src") or entrada["url"]
+    if not url_imagen.lower().startswith(("http://", "https://")):
+        return "error", None, None
+
+    cabeceras = {}
+    if entrada.get("etag"):
+        cabeceras["If-None-Match"] = entrada["etag"]
+    if entrada.get("last_modified"):
+        cabeceras["If-Modified-Since"] = entrada["last_modified"]
+
+    try:
+        respuesta = requests.get(url_imagen, headers=cabeceras, timeout=CACHE_DESCARGAS_TIMEOUT_SEG)
+    except requests.RequestException as e:
+        logger.warning(f"No se pudo revalidar la URL en caché {url_imagen}: {e}")
+        return "error", None, None
+
+    metadatos = {
+        "src": entrada.get("src"),
+        "etag": respuesta.headers.get("ETag") or entrada.get("etag"),
+        "last_modified": respuesta.headers.get("Last-Modified") or entrada.get("last_modified"),
+        "content_type": respuesta.headers.get("Content-Type") or entrada.get("content_type"),
+    }
+    if respuesta.status_code == 304:
+        return "no_modificada", None, metadatos
+    if respuesta.status_code == 200 and (respuesta.headers.get("Content-Type") or "").lower().startswith("image/"):
+        if hashlib.sha256(respuesta.content).hexdigest() == entrada.get("sha256"):
+            return "no_modificada", None, metadatos
+        return "modificada", respuesta.content, metadatos
+
+    logger.info(f"La revalidación de {url_imagen} respondió {respuesta.status_code}; se usará el navegador.")
+    return "error", None, None
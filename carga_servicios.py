@@ -4,7 +4,9 @@ Maneja la conversión de datos SQLite a JSON y el envío de archivos/imágenes
 """
 import sqlite3
 import json
+import re
 import os
+import hashlib
 from datetime import datetime, date
 import requests
 from requests.adapters import HTTPAdapter
@@ -13,9 +15,19 @@ import base64
 import urllib3
 
 from logger_config import logger
+from imagenes_servicios import listar_imagenes_comentario, recorrer_imagenes
 
 DB_PATH = "BDD_SNOWFLAKE.db"
 
+# Tiempo máximo por petición de los envíos de JSON y de imágenes.
+TIMEOUT_ENVIO_JSON_SEG = 180
+TIMEOUT_ENVIO_IMAGEN_SEG = 360
+
+# Límites de cada petición del envío de imágenes en lote: bytes de imagen (antes de Base64) e imágenes.
+# Una imagen que por sí sola supera el límite de bytes se envía sola.
+IMAGENES_LOTE_BYTES_MAXIMOS = 8 * 1024 * 1024
+IMAGENES_LOTE_MAXIMO = 20
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 def _crear_sesion_con_reintentos():
@@ -56,7 +68,7 @@ def _get_auth_headers():
 # FUNCIONES DE ENVÍO A ENDPOINT
 # ============================================================================
 
-def cargaEndpoint(ruta_json, endpoint):
+def cargaEndpoint(ruta_json, endpoint, timeout=TIMEOUT_ENVIO_JSON_SEG):
     """
     Carga un archivo JSON completo a un endpoint. Levanta excepción si falla.
     """
@@ -71,7 +83,7 @@ def cargaEndpoint(ruta_json, endpoint):
         
         headers = _get_auth_headers()
         
-        response = session.post(endpoint, json=data, timeout=180, headers=headers, verify=False)
+        response = session.post(endpoint, json=data, timeout=timeout, headers=headers, verify=False)
         response.raise_for_status()
         
         logger.info(f"Envío de '{ruta_json}' al endpoint {endpoint} completado exitosamente (Status: {response.status_code}).")
@@ -81,7 +93,7 @@ def cargaEndpoint(ruta_json, endpoint):
         raise e
 
 
-def enviar_imagen_json_memoria(ruta_imagen, tipo, endpoint, timeout=360):
+def enviar_imagen_json_memoria(ruta_imagen, tipo, endpoint, timeout=TIMEOUT_ENVIO_IMAGEN_SEG):
     """
     Convierte una imagen a Base64 y la envía como JSON al endpoint. Levanta excepción si falla.
     """
@@ -110,6 +122,71 @@ def enviar_imagen_json_memoria(ruta_imagen, tipo, endpoint, timeout=360):
         raise e
 
 
+def enviar_imagenes_lote_memoria(comment_id, rutas_imagenes, tipo, endpoint, timeout=TIMEOUT_ENVIO_IMAGEN_SEG):
+    """
+    Envía varias imágenes de un comentario en un solo JSON al endpoint de lotes y retorna los
+    nombres de archivo aceptados. Si la respuesta trae 'resultados' por imagen
+    ([{"filename": ..., "ok": true/false, "error": ...}]), solo se aceptan las marcadas con ok
+    (las que no figuran se consideran rechazadas); si no los trae, un 2xx acepta el lote completo.
+    Levanta excepción si la petición falla.
+    """
+    nombres = [os.path.basename(ruta) for ruta in rutas_imagenes]
+    logger.info(f"Enviando lote de {len(nombres)} imágenes del comentario ID {comment_id} al endpoint: {endpoint}")
+    try:
+        imagenes = []
+        for ruta, nombre in zip(rutas_imagenes, nombres):
+            with open(ruta, "rb") as f:
+                imagenes.append({"filename": nombre, "imagen_b64": base64.b64encode(f.read()).decode("utf-8")})
+
+        payload = {
+            "comment_id": comment_id,
+            "tipo": tipo,
+            "imagenes": imagenes
+        }
+
+        headers = _get_auth_headers()
+        response = session.post(endpoint, json=payload, timeout=timeout, headers=headers, verify=False)
+        response.raise_for_status()
+
+    except Exception as e:
+        logger.exception(f"Error enviando el lote de imágenes del comentario ID {comment_id} al endpoint {endpoint}.")
+        raise e
+
+    try:
+        cuerpo = response.json()
+    except ValueError:
+        cuerpo = None
+    resultados = cuerpo.get("resultados") if isinstance(cuerpo, dict) else None
+    if resultados is None:
+        logger.info(f"Lote de {len(nombres)} imágenes enviado exitosamente (Status: {response.status_code}).")
+        return nombres
+
+    aceptadas = set()
+    for resultado in resultados:
+        if resultado.get("ok"):
+            aceptadas.add(resultado.get("filename"))
+        else:
+            logger.warning(f"El endpoint rechazó la imagen '{resultado.get('filename')}' del comentario ID {comment_id}: {resultado.get('error')}")
+    aceptadas = [nombre for nombre in nombres if nombre in aceptadas]
+    logger.info(f"Lote enviado (Status: {response.status_code}): {len(aceptadas)} de {len(nombres)} imágenes aceptadas.")
+    return aceptadas
+
+
+def _armar_lotes_imagenes(rutas, bytes_maximos=IMAGENES_LOTE_BYTES_MAXIMOS, maximo=IMAGENES_LOTE_MAXIMO):
+    """Agrupa las rutas en lotes consecutivos que no superan `bytes_maximos` ni `maximo` imágenes."""
+    lotes, lote, bytes_lote = [], [], 0
+    for ruta in rutas:
+        tamano = os.path.getsize(ruta)
+        if lote and (bytes_lote + tamano > bytes_maximos or len(lote) >= maximo):
+            lotes.append(lote)
+            lote, bytes_lote = [], 0
+        lote.append(ruta)
+        bytes_lote += tamano
+    if lote:
+        lotes.append(lote)
+    return lotes
+
+
 def enviar_carpeta_imagenes_memoria(carpeta_imagenes, tipo, endpoint):
     """
     Recorre una carpeta y envía cada imagen individualmente como JSON.
@@ -119,17 +196,11 @@ def enviar_carpeta_imagenes_memoria(carpeta_imagenes, tipo, endpoint):
         logger.error(f"La carpeta de imágenes especificada no existe: {carpeta_imagenes}")
         raise FileNotFoundError(f"No existe la carpeta: {carpeta_imagenes}")
     
-    archivos_en_carpeta = sorted(os.listdir(carpeta_imagenes))
-    logger.info(f"Se encontraron {len(archivos_en_carpeta)} archivos en la carpeta.")
-
-    for nombre in archivos_en_carpeta:
-        ruta = os.path.join(carpeta_imagenes, nombre)
-        
-        if not os.path.isfile(ruta):
-            logger.warning(f"Se encontró un elemento que no es un archivo y será omitido: {ruta}")
-            continue
-        
+    # Se recorren también las subcarpetas, para soportar cualquier esquema de carpetas de imágenes.
+    archivos_en_carpeta = list(recorrer_imagenes(carpeta_imagenes))
+    logger.info(f"Se encontraron {len(archivos_en_carpeta)} imágenes en la carpeta.")
 
+    for ruta in archivos_en_carpeta:
         enviar_imagen_json_memoria(
             ruta_imagen=ruta,
             tipo=tipo,
@@ -138,9 +209,18 @@ def enviar_carpeta_imagenes_memoria(carpeta_imagenes, tipo, endpoint):
     logger.info(f"Proceso de envío de imágenes desde la carpeta '{carpeta_imagenes}' finalizado.")
 
 
-def enviar_imagenes_de_comentario(comment_id, carpeta_imagenes, tipo, endpoint):
+def enviar_imagenes_de_comentario(comment_id, carpeta_imagenes, tipo, endpoint, omitir=None, rutas_envio=None,
+                                  endpoint_lote=None, enviadas=None, timeout=TIMEOUT_ENVIO_IMAGEN_SEG, al_avanzar=None):
     """
     Busca y envía todas las imágenes asociadas a un comment_id.
+    Las imágenes cuyo nombre de archivo esté en `omitir` (ya enviadas antes) no se re-envían.
+    `rutas_envio` ({ruta_original: ruta_a_enviar}) permite enviar la versión normalizada de cada
+    imagen; una ruta None indica que el archivo no es una imagen válida y el envío falla.
+    Con `endpoint_lote`, las imágenes se envían en lotes (ver enviar_imagenes_lote_memoria) en vez
+    de una petición por imagen. Si se entrega la lista `enviadas`, se le agregan los nombres de
+    archivo confirmados por el endpoint, para registrarlos aunque el comentario quede incompleto.
+    `timeout` es el tiempo máximo de cada petición. `al_avanzar`, si se entrega, se llama antes de
+    cada petición (por ejemplo, para renovar el arriendo de un comentario con muchas imágenes).
     Retorna True si todas las imágenes se envían con éxito o si no hay imágenes.
     Retorna False si falla el envío de alguna imagen.
     """
@@ -151,12 +231,10 @@ def enviar_imagenes_de_comentario(comment_id, carpeta_imagenes, tipo, endpoint):
         return True # Si la carpeta no existe, no hay imágenes que enviar, se considera éxito para no bloquear el comentario.
 
     try:
-        # Convert comment_id to string to be safe
-        comment_id_str = str(comment_id)
+        # Solo se lista la subcarpeta del comentario según el esquema configurado.
         imagenes_a_enviar = [
-            os.path.join(carpeta_imagenes, f)
-            for f in sorted(os.listdir(carpeta_imagenes))
-            if f.startswith(f"{comment_id_str}_") and os.path.isfile(os.path.join(carpeta_imagenes, f))
+            ruta for ruta in listar_imagenes_comentario(comment_id, carpeta_imagenes)
+            if os.path.basename(ruta) not in (omitir or ())
         ]
     except Exception as e:
         logger.exception(f"Error al buscar imágenes para el comment_id {comment_id} en {carpeta_imagenes}")
@@ -168,23 +246,79 @@ def enviar_imagenes_de_comentario(comment_id, carpeta_imagenes, tipo, endpoint):
         return True
 
     logger.info(f"Se encontraron {len(imagenes_a_enviar)} imágenes para el comentario ID {comment_id}. Iniciando envío...")
+
+    if endpoint_lote:
+        return _enviar_imagenes_en_lotes(comment_id, imagenes_a_enviar, tipo, endpoint_lote, rutas_envio, enviadas, timeout, al_avanzar)
     
     for i, ruta_imagen in enumerate(imagenes_a_enviar):
+        if rutas_envio is not None:
+            ruta_imagen = rutas_envio.get(ruta_imagen, ruta_imagen)
+            if ruta_imagen is None:
+                logger.error(f"La imagen {i + 1} del comentario ID {comment_id} no es un archivo de imagen válido. Se cancela el resto de envíos para este comentario.")
+                return False
+        if al_avanzar is not None:
+            al_avanzar()
         try:
             logger.info(f"Enviando imagen {i + 1}/{len(imagenes_a_enviar)}: {os.path.basename(ruta_imagen)}")
             enviar_imagen_json_memoria(
                 ruta_imagen=ruta_imagen,
                 tipo=tipo,
-                endpoint=endpoint
+                endpoint=endpoint,
+                timeout=timeout
             )
         except Exception:
             logger.error(f"Fallo al enviar la imagen {os.path.basename(ruta_imagen)} para el comentario ID {comment_id}. Se cancela el resto de envíos para este comentario.")
             return False
+        if enviadas is not None:
+            enviadas.append(os.path.basename(ruta_imagen))
     
     logger.info(f"Todas las {len(imagenes_a_enviar)} imágenes para el comentario ID {comment_id} fueron enviadas exitosamente.")
     return True
 
 
+def _enviar_imagenes_en_lotes(comment_id, imagenes_a_enviar, tipo, endpoint_lote, rutas_envio, enviadas,
+                              timeout=TIMEOUT_ENVIO_IMAGEN_SEG, al_avanzar=None):
+    """
+    Envía las imágenes de un comentario en lotes limitados por bytes y cantidad. Las rechazadas
+    por el endpoint o no válidas hacen fallar el comentario, pero no impiden enviar el resto.
+    Un error de la petición cancela los lotes restantes. Retorna True si todas fueron aceptadas.
+    """
+    rutas = []
+    completo = True
+    for ruta_imagen in imagenes_a_enviar:
+        ruta_envio = rutas_envio.get(ruta_imagen, ruta_imagen) if rutas_envio is not None else ruta_imagen
+        if ruta_envio is None:
+            logger.error(f"La imagen '{os.path.basename(ruta_imagen)}' del comentario ID {comment_id} no es un archivo de imagen válido. No se enviará.")
+            completo = False
+        else:
+            rutas.append(ruta_envio)
+
+    try:
+        lotes = _armar_lotes_imagenes(rutas)
+    except OSError:
+        logger.exception(f"Error al leer las imágenes del comentario ID {comment_id} para armar los lotes.")
+        return False
+
+    for numero_lote, lote in enumerate(lotes, start=1):
+        if al_avanzar is not None:
+            al_avanzar()
+        try:
+            aceptadas = enviar_imagenes_lote_memoria(comment_id, lote, tipo, endpoint_lote, timeout)
+        except Exception:
+            logger.error(f"Fallo al enviar el lote {numero_lote}/{len(lotes)} del comentario ID {comment_id}. Se cancela el resto de envíos para este comentario.")
+            return False
+        if enviadas is not None:
+            enviadas.extend(aceptadas)
+        if len(aceptadas) < len(lote):
+            completo = False
+
+    if completo:
+        logger.info(f"Todas las {len(imagenes_a_enviar)} imágenes para el comentario ID {comment_id} fueron enviadas exitosamente en {len(lotes)} lotes.")
+    else:
+        logger.warning(f"El comentario ID {comment_id} quedó con imágenes sin aceptar; solo esas se re-enviarán.")
+    return completo
+
+
 # ============================================================================
 # FUNCIONES DE SERIALIZACIÓN
 # ============================================================================
@@ -230,6 +364,8 @@ def jsonHistorico():
     """
     Genera archivo JSON con todos los comentarios históricos desde SQLite.
     Archivo generado: 2.comentarios_por_ot_historico.json
+    Retorna {id: FINGERPRINT} de los comentarios escritos en el archivo, para registrar como
+    entregados solo esos tras enviarlo, o None si no se pudo generar.
     """
     logger.info("Iniciando generación de JSON de comentarios históricos...")
     try:
@@ -241,17 +377,142 @@ def jsonHistorico():
         rows = cursor.fetchall()
         
         data = []
+        huellas = {}
         for row in rows:
             d = dict(row)
             for k, v in d.items():
                 d[k] = serializar_fechas(v)
             data.append(d)
+            huellas[row["id"]] = row["FINGERPRINT"]
         
         with open("2.comentarios_por_ot_historico.json", "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=4)
         
         logger.info(f"JSON '2.comentarios_por_ot_historico.json' creado exitosamente con {len(data)} comentarios.")
         conn.close()
+        return huellas
     
     except Exception:
-        logger.exception("Error al generar el archivo JSON de comentarios históricos.")
\ No newline at end of file
+        logger.exception("Error al generar el archivo JSON de comentarios históricos.")
+        return None
+
+
+# ============================================================================
+# FUNCIONES DE EXPORTACIÓN INCREMENTAL
+# ============================================================================
+
+CARPETA_EXPORTACIONES = "exportaciones"
+# El nombre del consumidor se usa como carpeta dentro de CARPETA_EXPORTACIONES.
+PATRON_CONSUMIDOR = re.compile(r"[A-Za-z0-9_-]+")
+
+# Tablas exportables: (tabla, columna usada como cursor). 'change_seq' avanza con cada inserción
+# o cambio de un comentario; ot_lista solo recibe inserciones, por lo que basta su id.
+TABLAS_EXPORTACION = (("comentarios", "change_seq"), ("ot_lista", "id"))
+
+
+def _crear_tabla_export_cursores(cursor):
+    """Crea la tabla de cursores de exportación por consumidor si no existe."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS export_cursores (
+        consumidor TEXT NOT NULL,
+        tabla TEXT NOT NULL,
+        ultimo INTEGER NOT NULL DEFAULT 0,
+        actualizado TEXT,
+        PRIMARY KEY (consumidor, tabla)
+    )
+    """)
+
+
+def _exportar_tabla_ndjson(cursor, tabla, columna_cursor, desde, ruta):
+    """
+    Escribe en NDJSON (un objeto JSON por línea) las filas con `columna_cursor` > `desde`.
+    Retorna (filas_exportadas, ultimo_valor_de_cursor, sha256_del_archivo).
+    """
+    cursor.execute(f"SELECT * FROM {tabla} WHERE {columna_cursor} > ? ORDER BY {columna_cursor}", (desde,))
+    filas, ultimo = 0, desde
+    digest = hashlib.sha256()
+    ruta_tmp = f"{ruta}.tmp"
+    with open(ruta_tmp, "w", encoding="utf-8", newline="\n") as f:
+        for row in cursor:
+            d = {k: serializar_fechas(v) for k, v in dict(row).items()}
+            linea = json.dumps(d, ensure_ascii=False) + "\n"
+            f.write(linea)
+            digest.update(linea.encode("utf-8"))
+            filas += 1
+            ultimo = row[columna_cursor]
+
+    if filas:
+        os.replace(ruta_tmp, ruta)
+    else:
+        os.remove(ruta_tmp)
+    return filas, ultimo, digest.hexdigest()
+
+
+def exportar_delta(consumidor, carpeta=CARPETA_EXPORTACIONES):
+    """
+    Exporta como NDJSON solo los comentarios y OTs nuevos o modificados desde la última
+    exportación de `consumidor`, y escribe un manifiesto JSON que describe los archivos generados.
+    El cursor del consumidor se avanza solo después de escribir el manifiesto, de modo que una
+    exportación interrumpida se repite completa en la siguiente ejecución.
+    Archivos generados: exportaciones/<consumidor>/<marca>_<tabla>.ndjson y <marca>_manifest.json
+    Retorna la ruta del manifiesto. Lanza ValueError si `consumidor` no es un nombre válido
+    (solo letras, dígitos, '_' y '-').
+    """
+    if not isinstance(consumidor, str) or not PATRON_CONSUMIDOR.fullmatch(consumidor):
+        raise ValueError(f"Consumidor no válido: '{consumidor}'. Use solo letras, dígitos, '_' y '-'.")
+    logger.info(f"Iniciando exportación incremental para el consumidor '{consumidor}'...")
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        _crear_tabla_export_cursores(cursor)
+        conn.commit()
+
+        carpeta_consumidor = os.path.join(carpeta, consumidor)
+        os.makedirs(carpeta_consumidor, exist_ok=True)
+        marca = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+        # Todas las lecturas se hacen en una misma transacción para exportar una vista consistente.
+        cursor.execute("BEGIN")
+        cursor.execute("SELECT tabla, ultimo FROM export_cursores WHERE consumidor = ?", (consumidor,))
+        cursores = {row["tabla"]: row["ultimo"] for row in cursor.fetchall()}
+
+        archivos = []
+        nuevos_cursores = {}
+        for tabla, columna_cursor in TABLAS_EXPORTACION:
+            desde = cursores.get(tabla, 0)
+            nombre_archivo = f"{marca}_{tabla}.ndjson"
+            filas, hasta, sha256 = _exportar_tabla_ndjson(
+                cursor, tabla, columna_cursor, desde, os.path.join(carpeta_consumidor, nombre_archivo)
+            )
+            nuevos_cursores[tabla] = hasta
+            if filas:
+                archivos.append({
+                    "archivo": nombre_archivo, "tabla": tabla, "filas": filas,
+                    "cursor_desde": desde, "cursor_hasta": hasta, "sha256": sha256
+                })
+            logger.info(f"Tabla '{tabla}': {filas} filas nuevas o modificadas exportadas (cursor {desde} -> {hasta}).")
+        conn.commit()
+
+        manifiesto = {
+            "consumidor": consumidor,
+            "generado": datetime.now().isoformat(timespec="seconds"),
+            "cursores_anteriores": {tabla: cursores.get(tabla, 0) for tabla, _ in TABLAS_EXPORTACION},
+            "cursores_nuevos": nuevos_cursores,
+            "archivos": archivos
+        }
+        ruta_manifiesto = os.path.join(carpeta_consumidor, f"{marca}_manifest.json")
+        with open(ruta_manifiesto, "w", encoding="utf-8") as f:
+            json.dump(manifiesto, f, ensure_ascii=False, indent=4)
+
+        ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with conn:
+            conn.executemany("""
+                INSERT INTO export_cursores (consumidor, tabla, ultimo, actualizado) VALUES (?,?,?,?)
+                ON CONFLICT (consumidor, tabla) DO UPDATE SET ultimo = excluded.ultimo, actualizado = excluded.actualizado
+            """, [(consumidor, tabla, ultimo, ahora) for tabla, ultimo in nuevos_cursores.items()])
+
+        logger.info(f"Exportación incremental para '{consumidor}' completada. Manifiesto: '{ruta_manifiesto}'.")
+        return ruta_manifiesto
+    finally:
+        conn.close()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Servicio de escritura única en SQLite
+Un hilo dedicado es dueño de la única conexión de escritura: recibe comandos por una cola, los
+agrupa en transacciones por lotes y entrega su resultado a quien los envió. Las lecturas siguen
+usando conexiones propias, que en modo WAL no esperan al escritor
+"""
+import sqlite3
+import threading
+import time
+import queue as queue_estandar
+from concurrent.futures import Future
+
+from logger_config import logger
+
+# Cantidad máxima de comandos por transacción y espera máxima para completar un lote.
+ESCRITOR_TAMANO_LOTE = 200
+ESCRITOR_INTERVALO_SEG = 0.2
+# Espera máxima por el bloqueo de la base si otro proceso está escribiendo.
+ESCRITOR_TIMEOUT_SEG = 30
+
+_FIN = object()
+
+
+# ============================================================================
+# FUNCIONES DE CONEXIÓN
+# ============================================================================
+
+def conectar_lectura(db_path, timeout=ESCRITOR_TIMEOUT_SEG, check_same_thread=True):
+    """Abre una conexión de solo lectura a la base (no puede bloquear a los escritores)."""
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=timeout, check_same_thread=check_same_thread)
+
+
+def escribir(conn_sqlite, servicio, funcion, *args):
+    """
+    Ejecuta `funcion(conn, *args)` (que no hace commit) a través del servicio de escritura si se
+    entrega uno, o en una transacción propia de `conn_sqlite` si no. Retorna el resultado de la función.
+    Antes de delegar al servicio se cierra la transacción abierta de `conn_sqlite`, para que el hilo
+    escritor no quede esperando un bloqueo que tiene el mismo hilo que espera su resultado.
+    """
+    if servicio is None:
+        with conn_sqlite:
+            return funcion(conn_sqlite, *args)
+    if conn_sqlite is not None and conn_sqlite.in_transaction:
+        conn_sqlite.commit()
+    return servicio.enviar(funcion, *args).result()
+
+
+# ============================================================================
+# FUNCIÓN PRINCIPAL: SERVICIO DE ESCRITURA
+# ============================================================================
+
+class ServicioEscritura:
+    """
+    Hilo escritor único de una base SQLite, seguro para usar desde varios hilos.
+
+    - `enviar(funcion, *args)` encola `funcion(conn, *args)`, que se ejecuta en el hilo escritor con
+      la conexión de escritura y no debe hacer commit; retorna un Future con su resultado, disponible
+      una vez confirmada la transacción.
+    - Los comandos se agrupan en transacciones de hasta `tamano_lote` comandos (esperando como máximo
+      `intervalo` segundos a que lleguen más). Cada comando corre en su propio SAVEPOINT: si falla,
+      solo se deshace ese comando y su Future recibe la excepción.
+    - `vaciar()` espera a que todo lo enviado antes quede escrito; `cerrar()` además detiene el hilo.
+    Usado como context manager, se cierra al terminar el bloque.
+    """
+
+    def __init__(self, db_path, tamano_lote=ESCRITOR_TAMANO_LOTE, intervalo=ESCRITOR_INTERVALO_SEG,
+                 timeout=ESCRITOR_TIMEOUT_SEG, synchronous=None):
+        self.db_path = db_path
+        self.tamano_lote = max(1, tamano_lote)
+        self.intervalo = intervalo
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self.total_comandos = 0
+        self.total_transacciones = 0
+        self._cola = queue_estandar.Queue()
+        self._cerrado = False
+        self._listo = threading.Event()
+        self._error_inicio = None
+        self._hilo = threading.Thread(target=self._bucle, name="sqlite-escritor", daemon=True)
+        self._hilo.start()
+        self._listo.wait()
+        if self._error_inicio is not None:
+            raise self._error_inicio
+
+    # ---------------------------------------------------------------- comandos
+
+    def enviar(self, funcion, *args):
+        """Encola `funcion(conn, *args)` y retorna un Future con su resultado."""
+        if self._cerrado:
+            raise RuntimeError("El servicio de escritura ya está cerrado.")
+        futuro = Future()
+        self._cola.put((funcion, args, futuro))
+        return futuro
+
+    def vaciar(self):
+        """Espera a que todos los comandos enviados antes de esta llamada estén escritos."""
+        self.enviar(_sin_operacion).result()
+
+    def cerrar(self):
+        """Escribe lo pendiente y detiene el hilo escritor."""
+        if self._cerrado:
+            return
+        self._cerrado = True
+        self._cola.put(_FIN)
+        self._hilo.join()
+        logger.info(
+            f"Servicio de escritura SQLite cerrado: {self.total_comandos} comandos en "
+            f"{self.total_transacciones} transacciones."
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cerrar()
+        return False
+
+    # ---------------------------------------------------------------- hilo escritor
+
+    def _bucle(self):
+        """Hilo escritor: agrupa los comandos de la cola y los aplica por transacciones."""
+        try:
+            # Sin transacciones implícitas: el hilo controla BEGIN/COMMIT y los SAVEPOINT.
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+            if self.synchronous:
+                conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        except Exception as e:
+            self._error_inicio = e
+            self._listo.set()
+            return
+        self._listo.set()
+
+        try:
+            terminar = False
+            while not terminar:
+                lote = [self._cola.get()]
+                limite = time.monotonic() + self.intervalo
+                while len(lote) < self.tamano_lote and lote[-1] is not _FIN:
+                    restante = limite - time.monotonic()
+                    try:
+                        lote.append(self._cola.get(timeout=restante) if restante > 0 else self._cola.get_nowait())
+                    except queue_estandar.Empty:
+                        break
+                if lote[-1] is _FIN:
+                    terminar = True
+                    lote.pop()
+                if lote:
+                    try:
+                        self._aplicar_lote(conn, lote)
+                    except Exception as e:
+                        # Un error de la conexión no debe detener el hilo ni dejar Futures sin resolver.
+                        logger.exception("Error inesperado del hilo escritor de SQLite.")
+                        if conn.in_transaction:
+                            conn.execute("ROLLBACK")
+                        for _, _, futuro in lote:
+                            if not futuro.done():
+                                futuro.set_exception(e)
+        finally:
+            conn.close()
+
+    def _aplicar_lote(self, conn, lote):
+        """Aplica un lote de comandos en una transacción, aislando cada comando en un SAVEPOINT."""
+        resultados = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            logger.exception(f"No se pudo iniciar la transacción de escritura para {len(lote)} comandos.")
+            for _, _, futuro in lote:
+                futuro.set_exception(e)
+            return
+
+        for funcion, args, futuro in lote:
+            conn.execute("SAVEPOINT comando")
+            try:
+                resultados.append((futuro, funcion(conn, *args), None))
+                conn.execute("RELEASE comando")
+            except Exception as e:
+                conn.execute("ROLLBACK TO comando")
+                conn.execute("RELEASE comando")
+                logger.error(f"Comando de escritura '{getattr(funcion, '__name__', funcion)}' descartado: {e}")
+                resultados.append((futuro, None, e))
+
+        try:
+            conn.execute("COMMIT")
+        except Exception as e:
+            logger.exception(f"Error al confirmar la transacción de {len(lote)} comandos. Se descarta el lote.")
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for futuro, _, _ in resultados:
+                futuro.set_exception(e)
+            return
+
+        self.total_comandos += len(lote)
+        self.total_transacciones += 1
+        for futuro, resultado, error in resultados:
+            if error is None:
+                futuro.set_result(resultado)
+            else:
+                futuro.set_exception(error)
+
+
+def _sin_operacion(conn):
+    return None
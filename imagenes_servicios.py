@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Servicios de ubicación de imágenes en carpeta_imagenes
+Centraliza la resolución de rutas '<ID>_<n>.jpg' según el esquema de carpetas configurado
+(plano o repartido en subcarpetas) y la migración en línea entre esquemas
+"""
+import os
+import re
+import hashlib
+
+from logger_config import logger
+
+CARPETA_IMAGENES = "carpeta_imagenes"
+
+# Esquema de carpetas para las imágenes:
+#   'plano'   -> carpeta_imagenes/<ID>_<n>.jpg (comportamiento original)
+#   'hash'    -> carpeta_imagenes/ab/cd/<ID>_<n>.jpg, con ab/cd tomados del MD5 del ID
+#   'sufijo'  -> carpeta_imagenes/00/12/<ID>_<n>.jpg, con 00/12 tomados de los últimos dígitos del ID
+#                (con ceros a la izquierda): los IDs consecutivos se reparten entre las subcarpetas
+ESQUEMA_CARPETA_IMAGENES = os.environ.get("ESQUEMA_CARPETA_IMAGENES", "plano").lower()
+ESQUEMAS_VALIDOS = ("plano", "hash", "sufijo")
+# Nombres anteriores de los esquemas, aceptados en la configuración y en ARCHIVO_ESQUEMA.
+ALIAS_ESQUEMAS = {"prefijo": "sufijo"}
+
+# Intentos para crear la subcarpeta de una imagen y abrir el archivo, si la migración en línea
+# elimina la subcarpeta (vacía) entre ambos pasos.
+INTENTOS_ABRIR_IMAGEN = 3
+
+# Archivo dentro de la carpeta que registra el esquema en que están TODAS las imágenes.
+# Si no coincide con el configurado (migración pendiente o en curso), los lectores buscan en ambos.
+ARCHIVO_ESQUEMA = ".esquema"
+
+PATRON_NOMBRE_IMAGEN = re.compile(r"^(?P<comment_id>[^_]+)_(?P<ordinal>\d+)\.jpg$")
+
+
+# ============================================================================
+# FUNCIONES DE RESOLUCIÓN DE RUTAS
+# ============================================================================
+
+def _validar_esquema(esquema):
+    """Retorna el esquema indicado (o el configurado) validado."""
+    esquema = (esquema or ESQUEMA_CARPETA_IMAGENES).lower()
+    esquema = ALIAS_ESQUEMAS.get(esquema, esquema)
+    if esquema not in ESQUEMAS_VALIDOS:
+        raise ValueError(f"Esquema de carpeta de imágenes no válido: '{esquema}'. Use uno de: {', '.join(ESQUEMAS_VALIDOS)}")
+    return esquema
+
+
+def nombre_imagen(comment_id, ordinal):
+    """Nombre de archivo de la imagen `ordinal` de un comentario."""
+    return f"{comment_id}_{ordinal}.jpg"
+
+
+def subcarpeta_imagenes(comment_id, esquema=None):
+    """Subcarpeta relativa donde viven las imágenes de un comentario según el esquema."""
+    esquema = _validar_esquema(esquema)
+    if esquema == "hash":
+        digest = hashlib.md5(str(comment_id).encode("utf-8")).hexdigest()
+        return os.path.join(digest[:2], digest[2:4])
+    if esquema == "sufijo":
+        relleno = str(comment_id).zfill(6)
+        return os.path.join(relleno[-6:-4], relleno[-4:-2])
+    return ""
+
+
+def ruta_imagen(comment_id, ordinal, carpeta=CARPETA_IMAGENES, esquema=None):
+    """Ruta donde se debe escribir la imagen `ordinal` de un comentario con el esquema configurado."""
+    return os.path.join(carpeta, subcarpeta_imagenes(comment_id, esquema), nombre_imagen(comment_id, ordinal))
+
+
+def abrir_para_escribir(ruta, intentos=INTENTOS_ABRIR_IMAGEN):
+    """
+    Crea la subcarpeta de `ruta` y abre el archivo en modo binario de escritura.
+    Si una migración en curso eliminó la subcarpeta recién creada porque seguía vacía, se vuelve a crear.
+    """
+    for intento in range(1, intentos + 1):
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        try:
+            return open(ruta, "wb")
+        except FileNotFoundError:
+            if intento == intentos:
+                raise
+
+
+def esquema_consolidado(carpeta=CARPETA_IMAGENES):
+    """Esquema en que están todas las imágenes de la carpeta ('plano' si nunca se migró)."""
+    try:
+        with open(os.path.join(carpeta, ARCHIVO_ESQUEMA), "r", encoding="utf-8") as f:
+            return _validar_esquema(f.read().strip())
+    except FileNotFoundError:
+        return "plano"
+
+
+def _esquemas_de_lectura(carpeta):
+    """Esquemas donde puede haber imágenes: el configurado y, si difiere, el consolidado."""
+    configurado = _validar_esquema(None)
+    consolidado = esquema_consolidado(carpeta)
+    return [configurado] if consolidado == configurado else [configurado, consolidado]
+
+
+def buscar_imagen(comment_id, ordinal, carpeta=CARPETA_IMAGENES):
+    """Retorna la ruta existente de la imagen `ordinal` de un comentario, o None si no existe."""
+    for esquema in _esquemas_de_lectura(carpeta):
+        ruta = ruta_imagen(comment_id, ordinal, carpeta, esquema)
+        if os.path.isfile(ruta):
+            return ruta
+    return None
+
+
+def listar_imagenes_comentario(comment_id, carpeta=CARPETA_IMAGENES):
+    """
+    Retorna las rutas de las imágenes de un comentario, ordenadas por nombre.
+    Con un esquema repartido solo se lista la subcarpeta del comentario, no la carpeta completa.
+    """
+    prefijo = f"{comment_id}_"
+    encontradas = {}
+    for esquema in _esquemas_de_lectura(carpeta):
+        directorio = os.path.join(carpeta, subcarpeta_imagenes(comment_id, esquema))
+        if not os.path.isdir(directorio):
+            continue
+        with os.scandir(directorio) as entradas:
+            for entrada in entradas:
+                if entrada.name.startswith(prefijo) and entrada.is_file():
+                    encontradas.setdefault(entrada.name, entrada.path)
+    return [encontradas[nombre] for nombre in sorted(encontradas)]
+
+
+def recorrer_imagenes(carpeta=CARPETA_IMAGENES):
+    """Itera las rutas de todas las imágenes de la carpeta, en cualquier esquema."""
+    for raiz, subcarpetas, archivos in os.walk(carpeta):
+        subcarpetas.sort()
+        for nombre in sorted(archivos):
+            if PATRON_NOMBRE_IMAGEN.match(nombre):
+                yield os.path.join(raiz, nombre)
+
+
+# ============================================================================
+# FUNCIÓN PRINCIPAL: MIGRAR ESQUEMA DE CARPETAS
+# ============================================================================
+
+def migrar_carpeta_imagenes(carpeta=CARPETA_IMAGENES, esquema=None, conn_sqlite=None, tamano_lote=500):
+    """
+    Mueve en línea todas las imágenes de la carpeta al esquema indicado (por defecto, el configurado).
+    Cada archivo se mueve con os.replace (atómico dentro del mismo disco) y, mientras la migración
+    no termina, los lectores buscan en ambos esquemas, por lo que no hace falta detener otros modos.
+    Si se entrega `conn_sqlite`, actualiza `local_path` en la cola y la caché de descargas con commits cada `tamano_lote` archivos.
+    Al terminar registra el nuevo esquema como consolidado. Retorna la cantidad de archivos movidos.
+    """
+    esquema = _validar_esquema(esquema)
+    if not os.path.isdir(carpeta):
+        logger.warning(f"La carpeta de imágenes '{carpeta}' no existe. No hay nada que migrar.")
+        return 0
+
+    logger.info(f"Migrando imágenes de '{carpeta}' al esquema '{esquema}' (consolidado actual: '{esquema_consolidado(carpeta)}')...")
+    movidas = 0
+    rutas_actualizadas = []
+
+    for ruta_actual in list(recorrer_imagenes(carpeta)):
+        coincidencia = PATRON_NOMBRE_IMAGEN.match(os.path.basename(ruta_actual))
+        comment_id, ordinal = coincidencia.group("comment_id"), coincidencia.group("ordinal")
+        ruta_nueva = ruta_imagen(comment_id, ordinal, carpeta, esquema)
+        if os.path.normpath(ruta_actual) == os.path.normpath(ruta_nueva):
+            continue
+
+        os.makedirs(os.path.dirname(ruta_nueva), exist_ok=True)
+        os.replace(ruta_actual, ruta_nueva)
+        movidas += 1
+        rutas_actualizadas.append((ruta_nueva, ruta_actual))
+
+        if conn_sqlite is not None and len(rutas_actualizadas) >= tamano_lote:
+            _actualizar_rutas_cola(conn_sqlite, rutas_actualizadas)
+        if movidas % 1000 == 0:
+            logger.info(f"Migración en curso: {movidas} imágenes movidas...")
+
+    if conn_sqlite is not None:
+        _actualizar_rutas_cola(conn_sqlite, rutas_actualizadas)
+
+    with open(os.path.join(carpeta, ARCHIVO_ESQUEMA), "w", encoding="utf-8") as f:
+        f.write(esquema)
+
+    _eliminar_subcarpetas_vacias(carpeta)
+    logger.info(f"Migración completada: {movidas} imágenes movidas. Esquema consolidado: '{esquema}'.")
+    return movidas
+
+
+def _actualizar_rutas_cola(conn_sqlite, rutas_actualizadas):
+    """Actualiza en una transacción las rutas locales registradas en la cola y en la caché de descargas."""
+    if rutas_actualizadas:
+        with conn_sqlite:
+            conn_sqlite.executemany("UPDATE download_queue SET local_path = ? WHERE local_path = ?", rutas_actualizadas)
+            conn_sqlite.executemany("UPDATE download_cache SET local_path = ? WHERE local_path = ?", rutas_actualizadas)
+        rutas_actualizadas.clear()
+
+
+def _eliminar_subcarpetas_vacias(carpeta):
+    """
+    Elimina las subcarpetas que quedaron vacías tras la migración. Otro modo puede estar escribiendo
+    en una de ellas: si deja de estar vacía antes de borrarla se conserva, y los escritores que abren
+    con abrir_para_escribir vuelven a crear la que se borró entre su makedirs y su escritura.
+    """
+    for raiz, _, _ in os.walk(carpeta, topdown=False):
+        if raiz != carpeta and not os.listdir(raiz):
+            try:
+                os.rmdir(raiz)
+            except OSError:
+                pass
@@ -1,13 +1,28 @@
 import sys
 import sqlite3
 import os
-from snowflake.snowpark import Session
 
 from snowflake_servicios import (
     crear_ot, crear_comentarios, crear_json_temporal, 
-    get_pending_comentarios, get_pending_comentario_ids, update_comment_status
+    contar_comentarios_pendientes, configurar_durabilidad,
+    EscritorEstados, asegurar_esquema, crear_comentarios_historico, crear_ot_desde_comentarios,
+    ejecutar_queries_concurrentes, encolar_comentarios_sin_cola,
+    procesar_cola_descargas, resumen_cola_descargas, get_imagenes_enviadas, PlanificadorEnvios,
+    identificador_proceso, iterar_paginas_datos_sin_enviar, contar_datos_sin_enviar, huellas_datos_sin_enviar,
+    registrar_datos_enviados, registrar_imagenes_enviadas
 )
-from carga_servicios import jsonHistorico, cargaEndpoint, enviar_imagenes_de_comentario
+from autenticacion_servicios import crear_sesion_snowflake
+from snapshot_servicios import SesionConSnapshot, SesionReplay
+from backfill_servicios import planificar_shards, ejecutar_backfill, total_shards_planificados
+from imagenes_servicios import CARPETA_IMAGENES, ESQUEMA_CARPETA_IMAGENES, migrar_carpeta_imagenes, listar_imagenes_comentario
+from procesamiento_imagenes_servicios import ProcesadorImagenes
+from retencion_servicios import RETENCION_DIAS, archivar_entregados, restaurar_comentarios
+from carga_servicios import (
+    jsonHistorico, cargaEndpoint, enviar_imagenes_de_comentario, exportar_delta, PATRON_CONSUMIDOR,
+    TIMEOUT_ENVIO_JSON_SEG, TIMEOUT_ENVIO_IMAGEN_SEG
+)
+from presupuesto_servicios import PresupuestoEjecucion, separar_opciones_presupuesto
+from escritor_sqlite_servicios import ServicioEscritura
 from logger_config import logger, start_run_log
 
 CONEXION_SNOWFLAKE = {
@@ -24,8 +39,35 @@ CONEXION_SNOWFLAKE = {
 DB_SQLITE = "BDD_SNOWFLAKE.db"
 ENDPOINT = "https://volcano-soa.metacontrol.cl/api/import/comentarios/historico"
 ENDPOINT_IMG = "https://volcano-soa.metacontrol.cl/api/import/comentarios/foto"
+# Endpoint de envío de imágenes en lote (varias imágenes de un comentario por petición, con resultado
+# por imagen). Con None se mantiene el envío de una imagen por petición a ENDPOINT_IMG.
+ENDPOINT_IMG_LOTE = None
 JSON_HISTORICO = "2.comentarios_por_ot_historico.json"
-CARPETA_IMAGENES = "carpeta_imagenes"
+
+# Escritura de estados en lote: se vacía cada N cambios o cada X segundos (lo que ocurra primero).
+# SQLITE_SYNCHRONOUS controla la durabilidad: 'FULL' hace fsync en cada lote; 'NORMAL' reduce
+# los fsync en backlogs grandes a cambio de poder perder lo posterior al último checkpoint ante un corte de energía.
+ESTADOS_TAMANO_LOTE = 100
+ESTADOS_INTERVALO_SEG = 10
+SQLITE_SYNCHRONOUS = "FULL"
+# Espera máxima por el bloqueo de escritura de SQLite cuando varios procesos de envío comparten la base.
+SQLITE_TIMEOUT_SEG = 30
+
+# Si es True, cada extracción de Snowflake se guarda como snapshot Parquet en 'snapshots/<marca>/'
+# para poder re-ejecutar la ingesta con 'python main.py replay [marca]' sin consultar Snowflake.
+# Solo se conservan los SNAPSHOTS_CONSERVAR más recientes (ver snapshot_servicios.py).
+GUARDAR_SNAPSHOTS = True
+
+# Modos que respetan --max-duration / --max-items (pensados para ejecuciones programadas).
+MODOS_CON_PRESUPUESTO = ("temp", "solofotos", "enviojsonendpoint", "descargas")
+# Modos cuyas escrituras de estado, entregas y resultados de descarga pasan por un único hilo
+# escritor (ServicioEscritura), para compartir la base con otros procesos sin esperas largas.
+MODOS_CON_ESCRITOR = ("temp", "solofotos", "enviojsonendpoint", "descargas")
+
+# Si es True, 'ot_lista' se deriva de la extracción de comentarios y no se ejecuta QUERY_OT (una sola
+# query al warehouse). Solo se guardan las OTs con al menos un comentario 'Notification' o 'Report';
+# con False, QUERY_OT y QUERY_COMENTARIOS se envían a la vez de forma asíncrona.
+OT_DESDE_COMENTARIOS = False
 
 # Query para obtener lista de órdenes de trabajo
 QUERY_OT = """
@@ -63,9 +105,12 @@ QUERY_COMENTARIOS = f"""
 
 
 def conectar_snowflake():
-    """Establece y retorna la conexión con Snowflake"""
+    """
+    Establece y retorna la conexión con Snowflake. Usa par de claves si está configurado o el
+    ID token cacheado; el conector solo abre el navegador (SSO) cuando el token no es válido.
+    """
     try:
-        session = Session.builder.configs(CONEXION_SNOWFLAKE).create()
+        session = crear_sesion_snowflake(CONEXION_SNOWFLAKE)
         logger.info("Conexión exitosa con Snowflake.")
         return session
     except Exception as e:
@@ -73,10 +118,21 @@ def conectar_snowflake():
         sys.exit(1)
 
 
+def conectar_replay(marca):
+    """Retorna una sesión que lee las extracciones desde un snapshot local en lugar de Snowflake"""
+    try:
+        return SesionReplay(marca)
+    except Exception as e:
+        logger.exception("Error crítico al abrir el snapshot para el modo replay. Abortando ejecución.")
+        sys.exit(1)
+
+
 def conectar_sqlite():
     """Establece y retorna la conexión con SQLite"""
     try:
-        conn = sqlite3.connect(DB_SQLITE)
+        conn = sqlite3.connect(DB_SQLITE, timeout=SQLITE_TIMEOUT_SEG)
+        configurar_durabilidad(conn, SQLITE_SYNCHRONOUS)
+        asegurar_esquema(conn)
         logger.info(f"Conexión exitosa con SQLite en '{DB_SQLITE}'.")
         return conn
     except Exception as e:
@@ -84,6 +140,42 @@ def conectar_sqlite():
         sys.exit(1)
 
 
+def iniciar_servicio_escritura():
+    """Inicia el hilo escritor único de SQLite usado por los modos de envío y descarga"""
+    try:
+        return ServicioEscritura(DB_SQLITE, timeout=SQLITE_TIMEOUT_SEG, synchronous=SQLITE_SYNCHRONOUS)
+    except Exception as e:
+        logger.exception(f"Error crítico al iniciar el servicio de escritura de '{DB_SQLITE}'. Abortando ejecución.")
+        sys.exit(1)
+
+
+def sincronizar_desde_snowflake(session, conn_sqlite, modo, descargar=True, presupuesto=None, servicio=None):
+    """
+    Extrae OTs y comentarios desde Snowflake y los sincroniza en SQLite según `modo` ('historico' o 'temp').
+    Ambas queries se envían a la vez y cada resultado se procesa en cuanto llega; con
+    OT_DESDE_COMENTARIOS solo se ejecuta la query de comentarios y las OTs se derivan de ella.
+    Con `descargar=False` (solo 'historico') las imágenes se encolan pero no se descargan.
+    En modo 'temp', las descargas respetan el `presupuesto` de la ejecución y escriben sus
+    resultados a través de `servicio` (ServicioEscritura), si se entrega.
+    """
+    consultas = {"comentarios": QUERY_COMENTARIOS}
+    if not OT_DESDE_COMENTARIOS:
+        consultas["ot"] = QUERY_OT
+
+    for nombre, filas in ejecutar_queries_concurrentes(session, consultas):
+        if filas is None:
+            continue
+        if nombre == "ot":
+            crear_ot(session, QUERY_OT, conn_sqlite, filas=filas)
+            continue
+        if OT_DESDE_COMENTARIOS:
+            crear_ot_desde_comentarios(conn_sqlite, filas)
+        if descargar:
+            crear_comentarios(session, QUERY_COMENTARIOS, conn_sqlite, modo, filas=filas, presupuesto=presupuesto, servicio=servicio)
+        else:
+            crear_comentarios_historico(session, QUERY_COMENTARIOS, conn_sqlite, descargar=False, filas=filas)
+
+
 def modo_historico(session, conn_sqlite):
     """
     Modo de carga completa histórica.
@@ -91,72 +183,149 @@ def modo_historico(session, conn_sqlite):
     """
     logger.info("--- INICIANDO MODO HISTÓRICO ---")
     
-    crear_ot(session, QUERY_OT, conn_sqlite)
-    crear_comentarios(session, QUERY_COMENTARIOS, conn_sqlite, "historico")
+    sincronizar_desde_snowflake(session, conn_sqlite, "historico")
     jsonHistorico()
     
     conn_sqlite.commit()
     logger.info("--- PROCESO HISTÓRICO COMPLETADO ---")
 
 
-def modo_temp(session, conn_sqlite):
+def _normalizar_imagenes_comentario(procesador, comentario_id, omitir):
+    """
+    Normaliza (en el pool del procesador) las imágenes aún no enviadas de un comentario, justo antes
+    de enviarlas. Retorna {ruta_original: ruta_a_enviar} para `enviar_imagenes_de_comentario`.
+    """
+    if not procesador.habilitado:
+        return None
+    return procesador.procesar([
+        ruta for ruta in listar_imagenes_comentario(comentario_id, CARPETA_IMAGENES)
+        if os.path.basename(ruta) not in omitir
+    ])
+
+
+def _enviar_imagenes_y_registrar(conn_sqlite, escritor, procesador, planificador, comentario_id, tipo,
+                                 timeout=TIMEOUT_ENVIO_IMAGEN_SEG):
+    """
+    Envía las imágenes aún no enviadas de un comentario y registra su estado 'exitoso'
+    si todas se enviaron. Cualquier fallo deja el comentario como 'pendiente', pero las imágenes
+    confirmadas por el endpoint se registran como enviadas y no se re-envían.
+    Si el `procesador` está habilitado, las imágenes se normalizan justo antes del envío.
+    Antes de cada petición se renueva, si corresponde, el arriendo del `planificador`, para que un
+    comentario con muchas imágenes no lo pierda a mitad del envío.
+    `timeout` es el tiempo máximo de cada petición. Retorna True si el comentario quedó completo.
     """
-    Sincroniza con Snowflake, envía todos los comentarios pendientes en un solo JSON,
-    y luego procesa las imágenes individualmente, actualizando el estado de inmediato.
+    try:
+        # Los estados ya confirmados no esperan a que termine un envío que puede ser largo.
+        escritor.vaciar_si_vencido()
+        logger.info(f"Procesando imágenes para comentario ID {comentario_id}...")
+        enviadas = []
+        omitir = get_imagenes_enviadas(conn_sqlite, comentario_id)
+        rutas_envio = _normalizar_imagenes_comentario(procesador, comentario_id, omitir)
+        imagenes_ok = enviar_imagenes_de_comentario(
+            comentario_id, CARPETA_IMAGENES, tipo, ENDPOINT_IMG,
+            omitir=omitir,
+            rutas_envio=rutas_envio,
+            endpoint_lote=ENDPOINT_IMG_LOTE,
+            enviadas=enviadas,
+            timeout=timeout,
+            al_avanzar=planificador.renovar_arriendo
+        )
+        procesador.registrar_enviadas(enviadas)
+        if not imagenes_ok and enviadas:
+            registrar_imagenes_enviadas(conn_sqlite, comentario_id, enviadas, escritor.servicio)
+        
+        if imagenes_ok:
+            escritor.registrar(comentario_id, "exitoso")
+            logger.info(f"Imágenes para comentario ID {comentario_id} enviadas. Estado 'exitoso' registrado.")
+        else:
+            logger.warning(f"Fallo en envío de imágenes para comentario ID {comentario_id}. El estado permanecerá como 'pendiente'.")
+        return bool(imagenes_ok)
+    
+    except Exception:
+        logger.exception(f"Error inesperado procesando imágenes para el comentario ID {comentario_id}. El comentario seguirá como 'pendiente'.")
+        return False
+
+
+def modo_temp(session, conn_sqlite, presupuesto=None, servicio=None):
+    """
+    Sincroniza con Snowflake y envía los comentarios pendientes por páginas: cada página se
+    envía en un JSON y luego se procesan sus imágenes individualmente, registrando el estado.
+    Las páginas se arman por prioridad con PlanificadorEnvios (ver PRIORIDAD_PESOS).
+    Al agotarse el `presupuesto` no se inician descargas ni comentarios nuevos; --max-items solo
+    cuenta los comentarios enviados, no las descargas. Con `servicio` (ServicioEscritura), los
+    resultados de descarga, entregas y estados se escriben a través de él.
     """
     logger.info("--- INICIANDO MODO TEMPORAL (CON ESTADO) ---")
+    if presupuesto is None:
+        presupuesto = PresupuestoEjecucion()
     
     # 1. Sincronizar datos nuevos desde Snowflake
-    crear_ot(session, QUERY_OT, conn_sqlite)
-    crear_comentarios(session, QUERY_COMENTARIOS, conn_sqlite, "temp")
+    sincronizar_desde_snowflake(session, conn_sqlite, "temp", presupuesto=presupuesto, servicio=servicio)
     
-    # 2. Obtener todos los comentarios pendientes
-    comentarios_pendientes = get_pending_comentarios(conn_sqlite)
+    # 2. Contar los comentarios pendientes (se leen por páginas para no cargarlos todos en memoria)
+    total_pendientes = contar_comentarios_pendientes(conn_sqlite)
     
-    if not comentarios_pendientes:
+    if not total_pendientes:
         logger.info("--- PROCESO TEMPORAL COMPLETADO: No hay comentarios pendientes para enviar. ---")
         return
 
-    logger.info(f"Se encontraron {len(comentarios_pendientes)} comentarios pendientes para procesar.")
-    nombre_json_temp = None
+    logger.info(f"Se encontraron {total_pendientes} comentarios pendientes para procesar.")
+    # Cada página se reclama con un arriendo: otra ejecución solapada no enviará los mismos comentarios.
+    planificador = PlanificadorEnvios(conn_sqlite, propietario=identificador_proceso())
+    procesador = ProcesadorImagenes(conn_sqlite, servicio=servicio)
     try:
-        # 3. Enviar los datos de todos los comentarios pendientes en un solo lote
-        nombre_json_temp = crear_json_temporal(comentarios_pendientes)
-        if not nombre_json_temp:
-            logger.error("No se pudo generar el archivo JSON temporal para los comentarios pendientes. Abortando.")
-            return
-
-        logger.info(f"Enviando lote de {len(comentarios_pendientes)} comentarios pendientes desde '{nombre_json_temp}'...")
-        cargaEndpoint(nombre_json_temp, ENDPOINT)
-        logger.info("Lote de comentarios pendientes JSON enviado exitosamente.")
-
-        # 4. Procesar imágenes y estados individualmente para cada comentario del lote
-        logger.info(f"Procesando imágenes para los {len(comentarios_pendientes)} comentarios enviados...")
-        for comentario in comentarios_pendientes:
-            comentario_id = comentario.get('ID')
-            try:
-                logger.info(f"Procesando imágenes para comentario ID {comentario_id}...")
-                imagenes_ok = enviar_imagenes_de_comentario(comentario_id, CARPETA_IMAGENES, "temp", ENDPOINT_IMG)
+        with procesador, EscritorEstados(conn_sqlite, ESTADOS_TAMANO_LOTE, ESTADOS_INTERVALO_SEG, planificador.propietario,
+                                               servicio) as escritor:
+            for numero_pagina, pagina in enumerate(planificador.paginas(), start=1):
+                nombre_json_temp = None
+                # Solo se envían los datos que no se entregaron antes con su contenido actual
+                # (por ejemplo, comentarios que siguen pendientes porque falló alguna imagen).
+                huellas = huellas_datos_sin_enviar(conn_sqlite, [comentario.get('ID') for comentario in pagina])
+                datos_pagina = [comentario for comentario in pagina if comentario.get('ID') in huellas]
+                try:
+                    # 3. Enviar los datos de la página de comentarios pendientes en un solo lote
+                    if datos_pagina:
+                        nombre_json_temp = crear_json_temporal(datos_pagina)
+                        if not nombre_json_temp:
+                            logger.error("No se pudo generar el archivo JSON temporal para los comentarios pendientes. Abortando.")
+                            return
+
+                        logger.info(f"Enviando página {numero_pagina} con {len(datos_pagina)} comentarios pendientes desde '{nombre_json_temp}'...")
+                        cargaEndpoint(nombre_json_temp, ENDPOINT, timeout=presupuesto.timeout(TIMEOUT_ENVIO_JSON_SEG))
+                        registrar_datos_enviados(conn_sqlite, huellas, servicio)
+                        logger.info(f"Página {numero_pagina} de comentarios pendientes JSON enviada exitosamente.")
+                    else:
+                        logger.info(f"Los datos de la página {numero_pagina} ya fueron entregados; solo se procesarán sus imágenes.")
+
+                except Exception:
+                    logger.exception("ERROR CRÍTICO DURANTE EL ENVÍO DEL LOTE JSON de pendientes. No se procesarán más imágenes ni se actualizarán más estados.")
+                    return
                 
-                if imagenes_ok:
-                    update_comment_status(conn_sqlite, comentario_id, "exitoso")
-                    logger.info(f"Imágenes para comentario ID {comentario_id} enviadas. Estado actualizado a 'exitoso'.")
-                else:
-                    logger.warning(f"Fallo en envío de imágenes para comentario ID {comentario_id}. El estado permanecerá como 'pendiente'.")
-            
-            except Exception as e:
-                logger.exception(f"Error inesperado procesando imágenes para el comentario ID {comentario_id}. El comentario seguirá como 'pendiente'.")
-
-    except Exception:
-        logger.exception("ERROR CRÍTICO DURANTE EL ENVÍO DEL LOTE JSON de pendientes. No se procesarán imágenes ni se actualizarán estados.")
-    
+                finally:
+                    if nombre_json_temp and os.path.exists(nombre_json_temp):
+                        try:
+                            os.remove(nombre_json_temp)
+                            logger.info(f"Archivo JSON temporal '{nombre_json_temp}' eliminado.")
+                        except OSError as e:
+                            logger.error(f"No se pudo eliminar el archivo JSON temporal '{nombre_json_temp}': {e}")
+
+                # 4. Procesar imágenes y estados individualmente para cada comentario de la página
+                logger.info(f"Procesando imágenes para los {len(pagina)} comentarios de la página {numero_pagina}...")
+                for comentario in pagina:
+                    if not presupuesto.iniciar_item():
+                        break
+                    if _enviar_imagenes_y_registrar(conn_sqlite, escritor, procesador, planificador, comentario.get('ID'), "temp",
+                                                    presupuesto.timeout(TIMEOUT_ENVIO_IMAGEN_SEG)):
+                        planificador.registrar_envio(comentario.get('ID'))
+                    planificador.renovar_arriendo()
+                # Se evalúa antes de pedir otra página, para no reclamar comentarios que no se enviarán.
+                if not presupuesto.continuar():
+                    break
     finally:
-        if nombre_json_temp and os.path.exists(nombre_json_temp):
-            try:
-                os.remove(nombre_json_temp)
-                logger.info(f"Archivo JSON temporal '{nombre_json_temp}' eliminado.")
-            except OSError as e:
-                logger.error(f"No se pudo eliminar el archivo JSON temporal '{nombre_json_temp}': {e}")
+        # Después de vaciar el escritor: lo no completado vuelve a 'pendiente' para la próxima ejecución.
+        planificador.liberar_arriendos()
+        planificador.reportar_latencias()
+        procesador.reportar()
 
     logger.info("--- PROCESO TEMPORAL COMPLETADO ---")
 
@@ -172,53 +341,77 @@ def modo_json_historico(conn_sqlite):
     logger.info("--- GENERACIÓN DE JSON HISTÓRICO COMPLETADA ---")
 
 
-def modo_envio_endpoint(conn_sqlite):
+def modo_exportar_delta(consumidor):
+    """
+    Exporta en NDJSON solo los comentarios y OTs nuevos o modificados desde la última
+    exportación del consumidor indicado (no consulta Snowflake).
+    """
+    logger.info(f"--- INICIANDO MODO EXPORTACIÓN INCREMENTAL PARA '{consumidor}' ---")
+    exportar_delta(consumidor)
+    logger.info("--- EXPORTACIÓN INCREMENTAL COMPLETADA ---")
+
+
+def modo_envio_endpoint(conn_sqlite, completo=False, presupuesto=None, servicio=None):
     """
-    Envía todos los comentarios en un solo JSON y luego procesa las imágenes
-    individualmente, actualizando el estado de cada comentario pendiente de inmediato.
+    Envía al endpoint los datos de los comentarios que no se han entregado o que cambiaron desde
+    su última entrega, en JSON por páginas, y luego procesa individualmente las imágenes de los
+    comentarios pendientes, actualizando su estado.
+    Con `completo=True` envía todo el histórico en un solo JSON, como antes de registrar entregas.
+    Al agotarse el `presupuesto` no se inician páginas ni comentarios nuevos. Con `servicio`
+    (ServicioEscritura), las entregas y los estados se escriben a través de él.
     """
     logger.info("--- INICIANDO MODO ENVÍO A ENDPOINT (LOTE JSON, INDIVIDUAL IMÁGENES) ---")
+    if presupuesto is None:
+        presupuesto = PresupuestoEjecucion()
 
     try:
-        # 1. Generar y enviar el lote completo de TODOS los comentarios
-        jsonHistorico()
-        
-        # Se obtiene la lista de todos los comentarios para el log, pero solo se procesarán los pendientes.
-        cursor = conn_sqlite.cursor()
-        cursor.execute("SELECT COUNT(*) FROM comentarios")
-        total_comentarios = cursor.fetchone()[0]
-        
-        if total_comentarios == 0:
-            logger.info("No hay comentarios en la base de datos para enviar. Proceso finalizado.")
-            return
-
-        logger.info(f"Enviando lote completo de {total_comentarios} comentarios desde '{JSON_HISTORICO}'...")
-        cargaEndpoint(JSON_HISTORICO, ENDPOINT)
-        logger.info("Lote de comentarios JSON enviado exitosamente.")
+        # 1. Enviar los datos de comentarios: histórico completo o solo el delta no entregado
+        if completo:
+            # Solo se registran como entregados los comentarios (y huellas) que contiene el archivo enviado.
+            huellas = jsonHistorico()
+            if huellas is None:
+                raise RuntimeError(f"No se pudo generar '{JSON_HISTORICO}'.")
+            
+            if not huellas:
+                logger.info("No hay comentarios en la base de datos para enviar. Proceso finalizado.")
+                return
+
+            logger.info(f"Enviando lote completo de {len(huellas)} comentarios desde '{JSON_HISTORICO}'...")
+            cargaEndpoint(JSON_HISTORICO, ENDPOINT, timeout=presupuesto.timeout(TIMEOUT_ENVIO_JSON_SEG))
+            registrar_datos_enviados(conn_sqlite, huellas, servicio)
+            logger.info("Lote de comentarios JSON enviado exitosamente.")
+        else:
+            _enviar_datos_sin_enviar(conn_sqlite, presupuesto, servicio)
 
-        # 2. Procesar imágenes y estados individualmente para los comentarios PENDIENTES
-        comentarios_pendientes = get_pending_comentarios(conn_sqlite)
+        # 2. Procesar imágenes y estados individualmente para los comentarios PENDIENTES, por páginas
+        total_pendientes = contar_comentarios_pendientes(conn_sqlite)
         
-        if not comentarios_pendientes:
+        if not total_pendientes:
             logger.info("No hay comentarios pendientes para procesar imágenes. Proceso finalizado.")
             return
 
-        logger.info(f"Procesando imágenes para {len(comentarios_pendientes)} comentarios pendientes...")
-        for comentario in comentarios_pendientes:
-            comentario_id = comentario.get('ID')
-            
-            try:
-                logger.info(f"Procesando imágenes para comentario ID {comentario_id}...")
-                imagenes_ok = enviar_imagenes_de_comentario(comentario_id, CARPETA_IMAGENES, "historico", ENDPOINT_IMG)
-                
-                if imagenes_ok:
-                    update_comment_status(conn_sqlite, comentario_id, "exitoso")
-                    logger.info(f"Imágenes para comentario ID {comentario_id} enviadas. Estado actualizado a 'exitoso'.")
-                else:
-                    logger.warning(f"Fallo en envío de imágenes para comentario ID {comentario_id}. El estado permanecerá como 'pendiente'.")
-            
-            except Exception as e:
-                logger.exception(f"Error inesperado procesando imágenes para el comentario ID {comentario_id}. El comentario seguirá como 'pendiente'.")
+        logger.info(f"Procesando imágenes para {total_pendientes} comentarios pendientes...")
+        # Como en 'temp' y 'solofotos', cada página se reclama con un arriendo para no duplicar envíos
+        # con otra ejecución solapada.
+        planificador = PlanificadorEnvios(conn_sqlite, propietario=identificador_proceso())
+        procesador = ProcesadorImagenes(conn_sqlite, servicio=servicio)
+        try:
+            with procesador, EscritorEstados(conn_sqlite, ESTADOS_TAMANO_LOTE, ESTADOS_INTERVALO_SEG, planificador.propietario,
+                                             servicio) as escritor:
+                for pagina in planificador.paginas():
+                    for comentario in pagina:
+                        if not presupuesto.iniciar_item():
+                            break
+                        if _enviar_imagenes_y_registrar(conn_sqlite, escritor, procesador, planificador, comentario.get('ID'),
+                                                        "historico", presupuesto.timeout(TIMEOUT_ENVIO_IMAGEN_SEG)):
+                            planificador.registrar_envio(comentario.get('ID'))
+                        planificador.renovar_arriendo()
+                    if not presupuesto.continuar():
+                        break
+        finally:
+            planificador.liberar_arriendos()
+            planificador.reportar_latencias()
+            procesador.reportar()
 
     except Exception:
         logger.exception("ERROR CRÍTICO DURANTE EL ENVÍO DEL LOTE JSON. No se procesarán imágenes ni se actualizarán estados.")
@@ -227,77 +420,288 @@ def modo_envio_endpoint(conn_sqlite):
         logger.info("--- PROCESO DE ENVÍO A ENDPOINT COMPLETADO ---")
 
 
-def modo_solo_fotos(conn_sqlite):
+def _enviar_datos_sin_enviar(conn_sqlite, presupuesto, servicio=None):
+    """
+    Envía en JSON por páginas solo los comentarios cuyos datos no se han entregado o cambiaron,
+    registrando cada página como entregada al confirmarse su envío. Lanza excepción si un envío falla.
+    No inicia páginas nuevas si el `presupuesto` se agotó.
+    """
+    total = contar_datos_sin_enviar(conn_sqlite)
+    if not total:
+        logger.info("Los datos de todos los comentarios ya fueron entregados. No se envía JSON.")
+        return
+
+    logger.info(f"Enviando los datos de {total} comentarios no entregados o modificados...")
+    for numero_pagina, pagina in enumerate(iterar_paginas_datos_sin_enviar(conn_sqlite), start=1):
+        if not presupuesto.continuar():
+            break
+        huellas = huellas_datos_sin_enviar(conn_sqlite, [comentario.get('ID') for comentario in pagina])
+        nombre_json_temp = crear_json_temporal(pagina)
+        if not nombre_json_temp:
+            raise RuntimeError("No se pudo generar el archivo JSON temporal con los datos a enviar.")
+        try:
+            logger.info(f"Enviando página {numero_pagina} con {len(pagina)} comentarios desde '{nombre_json_temp}'...")
+            cargaEndpoint(nombre_json_temp, ENDPOINT, timeout=presupuesto.timeout(TIMEOUT_ENVIO_JSON_SEG))
+            registrar_datos_enviados(conn_sqlite, huellas, servicio)
+        finally:
+            if os.path.exists(nombre_json_temp):
+                os.remove(nombre_json_temp)
+
+
+def modo_solo_fotos(conn_sqlite, presupuesto=None, servicio=None):
     """
     Busca comentarios pendientes y envía solo sus imágenes asociadas, actualizando estado.
-    El procesamiento es atómico por comentario.
+    El procesamiento es atómico por comentario y los pendientes se leen por páginas.
+    Al agotarse el `presupuesto` no se inician comentarios nuevos. Con `servicio`
+    (ServicioEscritura), los estados se escriben a través de él.
     """
     logger.info("--- INICIANDO MODO ENVIAR SOLO FOTOS DE PENDIENTES ---")
+    if presupuesto is None:
+        presupuesto = PresupuestoEjecucion()
     
-    comentarios_pendientes = get_pending_comentario_ids(conn_sqlite)
+    total_pendientes = contar_comentarios_pendientes(conn_sqlite)
     
-    if not comentarios_pendientes:
+    if not total_pendientes:
         logger.info("No hay comentarios pendientes. No se enviaron fotos.")
         return
 
-    logger.info(f"Se encontraron {len(comentarios_pendientes)} comentarios pendientes. Procesando sus fotos...")
-
-    for comentario in comentarios_pendientes:
-        comentario_id = comentario.get('ID')
-        try:
-            logger.info(f"Procesando fotos para comentario ID {comentario_id}...")
-            
-            imagenes_ok = enviar_imagenes_de_comentario(comentario_id, CARPETA_IMAGENES, "temp", ENDPOINT_IMG)
-            
-            if imagenes_ok:
-                # Este modo asume que el dato del comentario ya fue enviado previamente.
-                # Si las imágenes son exitosas, se considera el comentario completo.
-                update_comment_status(conn_sqlite, comentario_id, "exitoso")
-                logger.info(f"Fotos para comentario ID {comentario_id} enviadas con éxito. Estado actualizado a 'exitoso'.")
-            else:
-                logger.warning(f"Fallo en envío de imágenes para comentario ID {comentario_id}. El estado no se actualizará.")
+    logger.info(f"Se encontraron {total_pendientes} comentarios pendientes. Procesando sus fotos...")
 
-        except Exception:
-            logger.exception(f"Error durante el envío de fotos para el comentario ID {comentario_id}. El comentario seguirá como 'pendiente'.")
+    # Este modo asume que el dato del comentario ya fue enviado previamente.
+    # Si las imágenes son exitosas, se considera el comentario completo.
+    planificador = PlanificadorEnvios(conn_sqlite, propietario=identificador_proceso())
+    procesador = ProcesadorImagenes(conn_sqlite, servicio=servicio)
+    try:
+        with procesador, EscritorEstados(conn_sqlite, ESTADOS_TAMANO_LOTE, ESTADOS_INTERVALO_SEG, planificador.propietario,
+                                               servicio) as escritor:
+            for pagina in planificador.paginas():
+                for comentario in pagina:
+                    if not presupuesto.iniciar_item():
+                        break
+                    if _enviar_imagenes_y_registrar(conn_sqlite, escritor, procesador, planificador, comentario.get('ID'), "temp",
+                                                    presupuesto.timeout(TIMEOUT_ENVIO_IMAGEN_SEG)):
+                        planificador.registrar_envio(comentario.get('ID'))
+                    planificador.renovar_arriendo()
+                if not presupuesto.continuar():
+                    break
+    finally:
+        planificador.liberar_arriendos()
+        planificador.reportar_latencias()
+        procesador.reportar()
 
     logger.info("--- PROCESO DE ENVÍO DE FOTOS COMPLETADO ---")
 
 
+def modo_descargas(conn_sqlite, presupuesto=None, servicio=None):
+    """
+    Reanuda las descargas de imágenes pendientes en la cola 'download_queue'
+    sin consultar Snowflake. Espera los reintentos programados hasta vaciar la cola
+    o hasta agotar el `presupuesto` de la ejecución. Con `servicio` (ServicioEscritura),
+    los resultados de cada descarga se escriben a través de él.
+    """
+    logger.info("--- INICIANDO MODO REANUDAR DESCARGAS ---")
+
+    encolar_comentarios_sin_cola(conn_sqlite)
+    logger.info(f"Estado inicial de la cola de descargas: {resumen_cola_descargas(conn_sqlite)}")
+
+    procesar_cola_descargas(conn_sqlite, esperar_reintentos=True, presupuesto=presupuesto, servicio=servicio)
+
+    logger.info(f"Estado final de la cola de descargas: {resumen_cola_descargas(conn_sqlite)}")
+    logger.info("--- PROCESO DE DESCARGAS COMPLETADO ---")
+
+
+def modo_migrar_imagenes(conn_sqlite, esquema=None):
+    """
+    Mueve las imágenes existentes de 'carpeta_imagenes' al esquema de carpetas indicado
+    (por defecto, ESQUEMA_CARPETA_IMAGENES). Puede ejecutarse mientras corren otros modos.
+    """
+    esquema = esquema or ESQUEMA_CARPETA_IMAGENES
+    logger.info(f"--- INICIANDO MODO MIGRAR CARPETA DE IMÁGENES AL ESQUEMA '{esquema}' ---")
+    migrar_carpeta_imagenes(CARPETA_IMAGENES, esquema, conn_sqlite)
+    logger.info("--- MIGRACIÓN DE CARPETA DE IMÁGENES COMPLETADA ---")
+
+
+def modo_archivar(conn_sqlite, dias=RETENCION_DIAS):
+    """
+    Archiva los comentarios entregados hace más de `dias` días: sus filas pasan a la base de archivo
+    y sus imágenes a bundles comprimidos, y se recupera espacio con VACUUM incremental.
+    """
+    logger.info(f"--- INICIANDO MODO ARCHIVAR (RETENCIÓN DE {dias} DÍAS) ---")
+    archivar_entregados(conn_sqlite, dias)
+    logger.info("--- ARCHIVADO COMPLETADO ---")
+
+
+def modo_restaurar(conn_sqlite, ids):
+    """Devuelve a la base activa los comentarios archivados indicados, con sus imágenes."""
+    logger.info(f"--- INICIANDO MODO RESTAURAR ({len(ids)} comentarios) ---")
+    restaurar_comentarios(conn_sqlite, ids)
+    logger.info("--- RESTAURACIÓN COMPLETADA ---")
+
+
+def _reportar_backlog_restante(conn_sqlite, presupuesto):
+    """Registra en el log el consumo del presupuesto y el trabajo que queda para la próxima ejecución."""
+    try:
+        logger.info(f"Ejecución con presupuesto: {presupuesto.resumen()}.")
+        logger.info(
+            f"Backlog restante: {contar_comentarios_pendientes(conn_sqlite)} comentarios pendientes, "
+            f"{contar_datos_sin_enviar(conn_sqlite)} con datos sin entregar; "
+            f"cola de descargas: {resumen_cola_descargas(conn_sqlite)}."
+        )
+    except Exception:
+        logger.exception("No se pudo calcular el backlog restante.")
+
+
+def modo_backfill(session, conn_sqlite, total_shards, shard=None):
+    """
+    Backfill histórico paralelo. Sin `shard`: sincroniza OTs y comentarios desde Snowflake
+    (solo encola las imágenes), reparte las descargas pendientes en `total_shards` rangos de
+    ACTIVITY_ID y los descarga en paralelo. Con `shard`: re-ejecuta solo ese shard del último plan,
+    sin consultar Snowflake; `total_shards` debe coincidir con la cantidad de shards de ese plan.
+    """
+    if shard is None:
+        logger.info(f"--- INICIANDO MODO BACKFILL PARALELO ({total_shards} shards) ---")
+        sincronizar_desde_snowflake(session, conn_sqlite, "historico", descargar=False)
+        if not planificar_shards(conn_sqlite, total_shards):
+            logger.info("--- PROCESO BACKFILL COMPLETADO: No hay descargas pendientes. ---")
+            return
+    else:
+        planificados = total_shards_planificados(conn_sqlite)
+        if planificados is None:
+            logger.error("No hay un plan de backfill guardado. Ejecute primero: python main.py backfill <cantidad_de_shards>")
+            return
+        if planificados != total_shards:
+            logger.error(
+                f"El último plan tiene {planificados} shards, no {total_shards}. Para re-ejecutar el shard {shard}: "
+                f"python main.py backfill {planificados} {shard}"
+            )
+            return
+        logger.info(f"--- INICIANDO MODO BACKFILL: re-ejecución del shard {shard}/{planificados} del último plan ---")
+
+    os.makedirs(CARPETA_IMAGENES, exist_ok=True)
+    if ejecutar_backfill(conn_sqlite, DB_SQLITE, shard):
+        logger.info("--- PROCESO BACKFILL COMPLETADO ---")
+    else:
+        logger.error("--- PROCESO BACKFILL COMPLETADO CON SHARDS FALLIDOS ---")
+
+
 def main():
-    if len(sys.argv) < 2:
-        print("Error: Debe proporcionar un parámetro de ejecución (historico, temp, jsonhistorico, enviojsonendpoint, solofotos).", file=sys.stderr)
+    # --max-duration y --max-items pueden ir en cualquier posición; el resto son argumentos del modo.
+    try:
+        argumentos, max_duracion, max_items = separar_opciones_presupuesto(sys.argv[1:])
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    argv = [sys.argv[0], *argumentos]
+
+    if len(argv) < 2:
+        print("Error: Debe proporcionar un parámetro de ejecución (historico, temp, jsonhistorico, enviojsonendpoint, solofotos, descargas, replay, backfill, migrarimagenes, exportdelta, archivar, restaurar).", file=sys.stderr)
         sys.exit(1)
     
-    parametro = sys.argv[1].lower()
+    parametro = argv[1].lower()
     start_run_log(parametro)
+
+    presupuesto = PresupuestoEjecucion(max_duracion, max_items)
+    if presupuesto.limitado:
+        if parametro in MODOS_CON_PRESUPUESTO:
+            logger.info(f"Presupuesto de ejecución: {presupuesto.resumen()}.")
+        else:
+            logger.warning(f"El modo '{parametro}' no admite --max-duration ni --max-items; se ignorarán.")
     
     session = None
     conn_sqlite = None
+    servicio = None
     
     try:
         if parametro in ["historico", "temp"]:
             session = conectar_snowflake()
+            if GUARDAR_SNAPSHOTS:
+                session = SesionConSnapshot(session)
             conn_sqlite = conectar_sqlite()
             
             if parametro == "historico":
                 modo_historico(session, conn_sqlite)
             else:
-                modo_temp(session, conn_sqlite)
+                servicio = iniciar_servicio_escritura()
+                modo_temp(session, conn_sqlite, presupuesto, servicio)
+        
+        elif parametro == "backfill":
+            # python main.py backfill <N> [shard]
+            try:
+                total_shards = int(argv[2]) if len(argv) > 2 else os.cpu_count() or 1
+                shard = int(argv[3]) if len(argv) > 3 else None
+            except ValueError:
+                logger.error("Uso: python main.py backfill <cantidad_de_shards> [shard]")
+                sys.exit(1)
+            if shard is None:
+                session = conectar_snowflake()
+                if GUARDAR_SNAPSHOTS:
+                    session = SesionConSnapshot(session)
+            conn_sqlite = conectar_sqlite()
+            modo_backfill(session, conn_sqlite, total_shards, shard)
+        
+        elif parametro == "replay":
+            # Ingesta completa (como 'historico') desde un snapshot, sin conexión a Snowflake.
+            marca = argv[2] if len(argv) > 2 else None
+            session = conectar_replay(marca)
+            conn_sqlite = conectar_sqlite()
+            modo_historico(session, conn_sqlite)
+        
+        elif parametro == "exportdelta":
+            if len(argv) < 3:
+                logger.error("Uso: python main.py exportdelta <consumidor>")
+                sys.exit(1)
+            if not PATRON_CONSUMIDOR.fullmatch(argv[2]):
+                logger.error(f"Consumidor no válido: '{argv[2]}'. Use solo letras, dígitos, '_' y '-'.")
+                sys.exit(1)
+            # Se abre la conexión para asegurar el esquema (columna y triggers de change_seq).
+            conn_sqlite = conectar_sqlite()
+            modo_exportar_delta(argv[2])
+        
+        elif parametro == "migrarimagenes":
+            conn_sqlite = conectar_sqlite()
+            modo_migrar_imagenes(conn_sqlite, argv[2].lower() if len(argv) > 2 else None)
+        
+        elif parametro == "archivar":
+            # python main.py archivar [dias]
+            try:
+                dias = int(argv[2]) if len(argv) > 2 else RETENCION_DIAS
+            except ValueError:
+                logger.error("Uso: python main.py archivar [dias]")
+                sys.exit(1)
+            conn_sqlite = conectar_sqlite()
+            modo_archivar(conn_sqlite, dias)
+        
+        elif parametro == "restaurar":
+            # python main.py restaurar <id> [<id> ...]
+            if len(argv) < 3 or not all(valor.isdigit() for valor in argv[2:]):
+                logger.error("Uso: python main.py restaurar <id_comentario> [<id_comentario> ...]")
+                sys.exit(1)
+            conn_sqlite = conectar_sqlite()
+            modo_restaurar(conn_sqlite, argv[2:])
         
-        elif parametro in ["jsonhistorico", "enviojsonendpoint", "solofotos"]:
+        elif parametro in ["jsonhistorico", "enviojsonendpoint", "solofotos", "descargas"]:
             conn_sqlite = conectar_sqlite()
+            if parametro in MODOS_CON_ESCRITOR:
+                servicio = iniciar_servicio_escritura()
             if parametro == "jsonhistorico":
                 modo_json_historico(conn_sqlite)
             elif parametro == "enviojsonendpoint":
-                modo_envio_endpoint(conn_sqlite)
+                modo_envio_endpoint(conn_sqlite, completo=len(argv) > 2 and argv[2].lower() == "completo",
+                                    presupuesto=presupuesto, servicio=servicio)
+            elif parametro == "descargas":
+                modo_descargas(conn_sqlite, presupuesto, servicio)
             else:
-                modo_solo_fotos(conn_sqlite)
+                modo_solo_fotos(conn_sqlite, presupuesto, servicio)
         
         else:
-            logger.error(f"Parámetro '{parametro}' no reconocido. Use uno de: historico, temp, jsonhistorico, enviojsonendpoint, solofotos.")
+            logger.error(f"Parámetro '{parametro}' no reconocido. Use uno de: historico, temp, jsonhistorico, enviojsonendpoint, solofotos, descargas, replay, backfill, migrarimagenes, exportdelta, archivar, restaurar.")
             sys.exit(1)
     
     finally:
+        if servicio:
+            servicio.cerrar()
+        if conn_sqlite and presupuesto.limitado and parametro in MODOS_CON_PRESUPUESTO:
+            _reportar_backlog_restante(conn_sqlite, presupuesto)
         if conn_sqlite:
             conn_sqlite.close()
             logger.info("Conexión a SQLite cerrada.")
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Servicios de presupuesto de ejecución
+Limita la duración y la cantidad de trabajo de una ejecución programada (--max-duration, --max-items):
+al acercarse el límite no se inicia trabajo nuevo y lo ya iniciado termina o se abandona por timeout,
+para que cada ejecución quepa en su ventana sin solaparse con la siguiente
+"""
+import re
+import time
+from collections import deque
+
+from logger_config import logger
+
+# No se inicia un elemento nuevo si quedan menos de este margen o menos de lo que tardó el elemento
+# más lento de los últimos PRESUPUESTO_VENTANA_ESTIMACION.
+PRESUPUESTO_MARGEN_SEG = 30
+PRESUPUESTO_VENTANA_ESTIMACION = 10
+# Timeout mínimo de una petición cerca del límite, para no abandonar envíos que casi terminan.
+PRESUPUESTO_TIMEOUT_MINIMO_SEG = 15
+
+UNIDADES_DURACION = {"s": 1, "m": 60, "h": 3600}
+PATRON_DURACION = re.compile(r"^(?P<valor>\d+(?:\.\d+)?)(?P<unidad>[smh]?)$")
+
+
+# ============================================================================
+# FUNCIONES DE UTILIDAD
+# ============================================================================
+
+def parsear_duracion(texto):
+    """Convierte '3600', '90s', '55m' o '1.5h' a segundos. Lanza ValueError si el formato no es válido."""
+    coincidencia = PATRON_DURACION.match(texto.strip().lower())
+    if not coincidencia:
+        raise ValueError(f"Duración no válida: '{texto}'. Use segundos o un sufijo s, m u h (por ejemplo, 55m).")
+    segundos = float(coincidencia.group("valor")) * UNIDADES_DURACION[coincidencia.group("unidad") or "s"]
+    if segundos <= 0:
+        raise ValueError(f"La duración debe ser mayor que cero: '{texto}'.")
+    return segundos
+
+
+def separar_opciones_presupuesto(argumentos):
+    """
+    Separa de los argumentos de línea de comandos las opciones --max-duration y --max-items
+    (como '--opcion valor' o '--opcion=valor'). Retorna (argumentos_restantes, max_duracion_seg, max_items).
+    Lanza ValueError si una opción no tiene valor o su valor no es válido.
+    """
+    restantes = []
+    opciones = {"--max-duration": None, "--max-items": None}
+    i = 0
+    while i < len(argumentos):
+        argumento = argumentos[i]
+        nombre, _, valor = argumento.partition("=")
+        if nombre in opciones:
+            if not valor:
+                if i + 1 >= len(argumentos):
+                    raise ValueError(f"Falta el valor de la opción {nombre}.")
+                i += 1
+                valor = argumentos[i]
+            opciones[nombre] = valor
+        else:
+            restantes.append(argumento)
+        i += 1
+
+    max_duracion = parsear_duracion(opciones["--max-duration"]) if opciones["--max-duration"] else None
+    max_items = None
+    if opciones["--max-items"]:
+        if not opciones["--max-items"].isdigit() or int(opciones["--max-items"]) == 0:
+            raise ValueError(f"--max-items debe ser un entero positivo: '{opciones['--max-items']}'.")
+        max_items = int(opciones["--max-items"])
+    return restantes, max_duracion, max_items
+
+
+# ============================================================================
+# FUNCIÓN PRINCIPAL: PRESUPUESTO DE EJECUCIÓN
+# ============================================================================
+
+class PresupuestoEjecucion:
+    """
+    Presupuesto de tiempo y de elementos de una ejecución. Sin límites, siempre permite continuar.
+    Los bucles de trabajo llaman a `iniciar_item()` antes de cada elemento (comentario a enviar o
+    descarga) y se detienen cuando retorna False; `continuar()` consulta el límite de tiempo sin
+    contar un elemento. Una vez agotado, `motivo` indica por qué y no se vuelve a permitir trabajo.
+    """
+
+    def __init__(self, max_duracion_seg=None, max_items=None, margen_seg=PRESUPUESTO_MARGEN_SEG):
+        self.inicio = time.monotonic()
+        self.max_duracion_seg = max_duracion_seg
+        self.limite = self.inicio + max_duracion_seg if max_duracion_seg else None
+        self.max_items = max_items
+        self.margen_seg = margen_seg
+        self.items = 0
+        self.motivo = None
+        self._ultimo_inicio = None
+        self._duraciones = deque(maxlen=PRESUPUESTO_VENTANA_ESTIMACION)
+
+    @property
+    def limitado(self):
+        """Indica si la ejecución tiene algún límite."""
+        return self.limite is not None or self.max_items is not None
+
+    @property
+    def agotado(self):
+        """Indica si el presupuesto ya detuvo el trabajo."""
+        return self.motivo is not None
+
+    def restante(self):
+        """Segundos que quedan hasta el límite, o None si no hay límite de tiempo."""
+        return None if self.limite is None else self.limite - time.monotonic()
+
+    def _agotar(self, motivo):
+        """Registra (una sola vez) que el presupuesto se agotó."""
+        if self.motivo is None:
+            self.motivo = motivo
+            logger.warning(f"Presupuesto de ejecución agotado ({motivo}): no se iniciará trabajo nuevo.")
+        return False
+
+    def continuar(self):
+        """Indica si queda tiempo para iniciar trabajo nuevo, sin contarlo como elemento."""
+        if self.motivo is not None:
+            return False
+        restante = self.restante()
+        if restante is not None:
+            reserva = max([self.margen_seg, *self._duraciones])
+            if restante < reserva:
+                return self._agotar(f"quedan {max(restante, 0):.0f} s de --max-duration y se reservan {reserva:.0f} s")
+        return True
+
+    def iniciar_item(self):
+        """Cuenta un elemento nuevo si el presupuesto lo permite. Retorna False si hay que detenerse."""
+        ahora = time.monotonic()
+        if self._ultimo_inicio is not None:
+            self._duraciones.append(ahora - self._ultimo_inicio)
+        self._ultimo_inicio = ahora
+        if self.max_items is not None and self.items >= self.max_items:
+            return self._agotar(f"se alcanzó --max-items={self.max_items}")
+        if not self.continuar():
+            return False
+        self.items += 1
+        return True
+
+    def timeout(self, maximo):
+        """Timeout para una petición: `maximo`, acotado al tiempo restante (con un mínimo razonable)."""
+        restante = self.restante()
+        if restante is None:
+            return maximo
+        return max(min(maximo, restante), PRESUPUESTO_TIMEOUT_MINIMO_SEG)
+
+    def resumen(self):
+        """Texto con el consumo del presupuesto para el log."""
+        transcurrido = time.monotonic() - self.inicio
+        limites = []
+        if self.max_duracion_seg:
+            limites.append(f"--max-duration={self.max_duracion_seg:.0f} s")
+        if self.max_items is not None:
+            limites.append(f"--max-items={self.max_items}")
+        estado = f"detenida por presupuesto: {self.motivo}" if self.motivo else "completada dentro del presupuesto"
+        return f"{self.items} elementos en {transcurrido:.0f} s ({', '.join(limites) or 'sin límites'}); {estado}"
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Servicios de normalización de imágenes antes del envío
+Verifica que cada archivo descargado sea realmente una imagen, elimina sus metadatos y la reduce
+o recomprime según una dimensión, calidad y tamaño máximos. El original se conserva intacto en
+carpeta_imagenes (para auditoría) y la versión normalizada se guarda aparte y se reutiliza
+mientras el original y los parámetros no cambien. Si la versión normalizada no es más liviana,
+se envía el original
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from logger_config import logger
+from imagenes_servicios import PATRON_NOMBRE_IMAGEN, ruta_imagen
+from escritor_sqlite_servicios import escribir
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+# Etapa opcional: con PROCESAR_IMAGENES=1 las imágenes se normalizan antes de enviarse.
+PROCESAR_IMAGENES = os.environ.get("PROCESAR_IMAGENES", "0") == "1"
+
+CARPETA_IMAGENES_PROCESADAS = "carpeta_imagenes_procesadas"
+
+# Lado mayor máximo en píxeles; las imágenes más grandes se reducen manteniendo la proporción.
+IMAGEN_DIMENSION_MAXIMA = 1920
+IMAGEN_CALIDAD_JPEG = 85
+# Si el JPEG resultante supera IMAGEN_BYTES_MAXIMOS, se baja la calidad de a IMAGEN_PASO_CALIDAD
+# hasta IMAGEN_CALIDAD_MINIMA (0 = sin límite de tamaño).
+IMAGEN_BYTES_MAXIMOS = 500 * 1024
+IMAGEN_CALIDAD_MINIMA = 60
+IMAGEN_PASO_CALIDAD = 10
+
+PROCESAMIENTO_TRABAJADORES = os.cpu_count() or 1
+
+COLUMNAS_PROCESADAS = (
+    "ruta_original", "tamano_original", "mtime_original", "parametros",
+    "ruta_procesada", "tamano_procesada", "estado", "procesado_at"
+)
+
+
+# ============================================================================
+# FUNCIONES DE UTILIDAD
+# ============================================================================
+
+def _verificar_pillow():
+    """Lanza un error claro si Pillow no está instalado."""
+    if Image is None:
+        raise ImportError("El procesamiento de imágenes requiere el paquete 'Pillow'. Instálelo con: pip install Pillow")
+
+
+def parametros_procesamiento(dimension=IMAGEN_DIMENSION_MAXIMA, calidad=IMAGEN_CALIDAD_JPEG,
+                             bytes_maximos=IMAGEN_BYTES_MAXIMOS, calidad_minima=IMAGEN_CALIDAD_MINIMA):
+    """Parámetros de normalización; su texto identifica en caché con qué configuración se procesó una imagen."""
+    return {"dimension": dimension, "calidad": calidad, "bytes_maximos": bytes_maximos, "calidad_minima": calidad_minima}
+
+
+def _texto_parametros(parametros):
+    """Representación estable de los parámetros para compararlos con la caché."""
+    return "|".join(f"{clave}={parametros[clave]}" for clave in sorted(parametros))
+
+
+def ruta_procesada(ruta_original, carpeta=CARPETA_IMAGENES_PROCESADAS):
+    """Ruta de la versión normalizada de una imagen: mismo nombre y esquema, en la carpeta de procesadas."""
+    coincidencia = PATRON_NOMBRE_IMAGEN.match(os.path.basename(ruta_original))
+    if not coincidencia:
+        return os.path.join(carpeta, os.path.basename(ruta_original))
+    return ruta_imagen(coincidencia.group("comment_id"), coincidencia.group("ordinal"), carpeta)
+
+
+def _fecha_hora_actual():
+    """Fecha y hora local en el formato de texto usado en las tablas de SQLite."""
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+# ============================================================================
+# FUNCIONES DE LA TABLA DE CACHÉ
+# ============================================================================
+
+def crear_tabla_imagenes_procesadas(cursor):
+    """Crea la tabla de caché de imágenes normalizadas si no existe"""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS imagenes_procesadas (
+        ruta_original TEXT PRIMARY KEY,
+        tamano_original INTEGER NOT NULL,
+        mtime_original INTEGER NOT NULL,
+        parametros TEXT NOT NULL,
+        ruta_procesada TEXT,
+        tamano_procesada INTEGER,
+        estado TEXT NOT NULL,
+        procesado_at TEXT
+    )
+    """)
+    logger.info("Tabla 'imagenes_procesadas' asegurada en SQLite.")
+
+
+def _entrada_vigente(entrada, estado_archivo, texto_parametros):
+    """
+    Indica si una entrada de caché sigue sirviendo: el original no cambió (tamaño y mtime), se
+    procesó con los mismos parámetros y, si produjo una versión normalizada, esta sigue en disco.
+    Los errores de normalización no se reutilizan: se reintentan en la siguiente ejecución. Un archivo
+    que no es una imagen nunca queda en caché (se elimina junto con su entrada al detectarlo).
+    """
+    if entrada is None or estado_archivo is None:
+        return False
+    if (entrada["tamano_original"], entrada["mtime_original"], entrada["parametros"]) != (*estado_archivo, texto_parametros):
+        return False
+    if entrada["estado"] == "error":
+        return False
+    if entrada["estado"] == "sin_reduccion":
+        return True
+    try:
+        return os.path.getsize(entrada["ruta_procesada"]) == entrada["tamano_procesada"]
+    except OSError:
+        return False
+
+
+def descartar_procesadas(conn_sqlite, rutas_originales):
+    """Elimina las versiones normalizadas de las imágenes indicadas y sus entradas de caché. No hace commit."""
+    for ruta in rutas_originales:
+        fila = conn_sqlite.execute(
+            "SELECT ruta_procesada FROM imagenes_procesadas WHERE ruta_original = ?", (ruta,)
+        ).fetchone()
+        if fila and fila[0] and os.path.isfile(fila[0]):
+            os.remove(fila[0])
+    conn_sqlite.executemany(
+        "DELETE FROM imagenes_procesadas WHERE ruta_original = ?", [(ruta,) for ruta in rutas_originales]
+    )
+
+
+def _guardar_entradas(conn_sqlite, filas):
+    """Inserta o reemplaza entradas de caché de imágenes normalizadas. No hace commit."""
+    conn_sqlite.executemany(
+        f"INSERT OR REPLACE INTO imagenes_procesadas ({', '.join(COLUMNAS_PROCESADAS)}) "
+        f"VALUES ({', '.join('?' for _ in COLUMNAS_PROCESADAS)})", filas
+    )
+
+
+def _marcar_descarga_no_imagen(conn_sqlite, ruta, motivo):
+    """
+    Marca como 'fallida' la descarga que produjo un archivo que no es una imagen y olvida su ruta
+    local, para que el comentario no quede esperando una imagen que nunca podrá enviarse. No hace commit.
+    """
+    conn_sqlite.execute("""
+        UPDATE download_queue SET status = 'fallida', next_attempt_at = NULL, local_path = NULL, last_error = ?
+        WHERE local_path = ? AND status = 'descargada'
+    """, (f"No es una imagen válida: {motivo}", ruta))
+    conn_sqlite.execute("DELETE FROM imagenes_procesadas WHERE ruta_original = ?", (ruta,))
+
+
+# ============================================================================
+# FUNCIÓN DE TRABAJO (SE EJECUTA EN LOS PROCESOS DEL POOL)
+# ============================================================================
+
+def _guardar_jpeg(imagen, ruta_destino, calidad):
+    """Guarda la imagen como JPEG sin metadatos de forma atómica y retorna su tamaño en bytes."""
+    ruta_tmp = f"{ruta_destino}.tmp"
+    imagen.save(ruta_tmp, format="JPEG", quality=calidad, optimize=True, progressive=True)
+    os.replace(ruta_tmp, ruta_destino)
+    return os.path.getsize(ruta_destino)
+
+
+def normalizar_imagen(ruta_original, ruta_destino, parametros):
+    """
+    Normaliza una imagen y retorna (estado, tamaño_procesada, detalle):
+    - ('procesada', bytes, calidad) si se escribió la versión normalizada en `ruta_destino`.
+    - ('sin_reduccion', None, calidad) si la versión normalizada no pesa menos que el original
+      (no se conserva y se envía el original).
+    - ('no_imagen', None, motivo) si el archivo no es una imagen válida (no debe enviarse).
+    - ('error', None, motivo) si falló la normalización de una imagen válida (se envía el original).
+    La orientación EXIF se aplica antes de descartar los metadatos, para no rotar la foto.
+    """
+    try:
+        with Image.open(ruta_original) as imagen:
+            imagen.verify()
+    except Exception as e:
+        return "no_imagen", None, f"{type(e).__name__}: {e}"
+
+    try:
+        with Image.open(ruta_original) as imagen:
+            imagen = ImageOps.exif_transpose(imagen)
+            if imagen.mode in ("RGBA", "LA", "P"):
+                imagen = imagen.convert("RGBA")
+                fondo = Image.new("RGB", imagen.size, (255, 255, 255))
+                fondo.paste(imagen, mask=imagen.getchannel("A"))
+                imagen = fondo
+            elif imagen.mode not in ("RGB", "L"):
+                imagen = imagen.convert("RGB")
+            imagen.thumbnail((parametros["dimension"], parametros["dimension"]), Image.LANCZOS)
+
+            os.makedirs(os.path.dirname(ruta_destino) or ".", exist_ok=True)
+            calidad = parametros["calidad"]
+            tamano = _guardar_jpeg(imagen, ruta_destino, calidad)
+            while parametros["bytes_maximos"] and tamano > parametros["bytes_maximos"] and calidad > parametros["calidad_minima"]:
+                calidad = max(calidad - IMAGEN_PASO_CALIDAD, parametros["calidad_minima"])
+                tamano = _guardar_jpeg(imagen, ruta_destino, calidad)
+        if tamano >= os.path.getsize(ruta_original):
+            os.remove(ruta_destino)
+            return "sin_reduccion", None, calidad
+        return "procesada", tamano, calidad
+    except Exception as e:
+        return "error", None, f"{type(e).__name__}: {e}"
+
+
+# ============================================================================
+# FUNCIÓN PRINCIPAL: PROCESADOR DE IMÁGENES
+# ============================================================================
+
+class ProcesadorImagenes:
+    """
+    Normaliza en un pool de procesos las imágenes a enviar y acumula el resumen de la ejecución.
+    `procesar(rutas)` retorna {ruta_original: ruta_a_enviar}: la versión normalizada, o el original si
+    la normalización falló o no reduce su tamaño. Deshabilitado, envía los originales.
+    Un archivo que no es una imagen se elimina de disco, su descarga queda 'fallida' y su ruta es None.
+    `registrar_enviadas(nombres)` suma al resumen de bytes solo las imágenes confirmadas por el endpoint.
+    Con `servicio` (ServicioEscritura), las escrituras en SQLite pasan por el hilo escritor único.
+    Se usa como context manager para cerrar el pool al terminar.
+    """
+
+    def __init__(self, conn_sqlite, habilitado=PROCESAR_IMAGENES, parametros=None,
+                 carpeta_procesadas=CARPETA_IMAGENES_PROCESADAS, trabajadores=PROCESAMIENTO_TRABAJADORES,
+                 servicio=None):
+        self.conn = conn_sqlite
+        self.servicio = servicio
+        self.habilitado = habilitado
+        self.parametros = parametros or parametros_procesamiento()
+        self.texto_parametros = _texto_parametros(self.parametros)
+        self.carpeta_procesadas = carpeta_procesadas
+        self.trabajadores = trabajadores
+        self._pool = None
+        # Tamaños (original, a enviar) de las imágenes resueltas y aún no confirmadas, por nombre de archivo.
+        self._tamanos = {}
+        self.totales = {"procesadas": 0, "sin_reduccion": 0, "desde_cache": 0, "no_imagen": 0, "errores": 0,
+                        "enviadas": 0, "bytes_originales": 0, "bytes_enviados": 0}
+        if habilitado:
+            _verificar_pillow()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        return False
+
+    def _entradas_cache(self, rutas):
+        """Entradas de caché de las rutas indicadas, como diccionarios por ruta original."""
+        entradas = {}
+        for inicio in range(0, len(rutas), 500):
+            lote = rutas[inicio:inicio + 500]
+            cursor = self.conn.execute(
+                f"SELECT {', '.join(COLUMNAS_PROCESADAS)} FROM imagenes_procesadas "
+                f"WHERE ruta_original IN ({','.join('?' for _ in lote)})", lote
+            )
+            for fila in cursor:
+                entradas[fila[0]] = dict(zip(COLUMNAS_PROCESADAS, fila))
+        return entradas
+
+    def _descartar_no_imagen(self, ruta, motivo):
+        """Elimina un archivo que no es una imagen y marca su descarga como 'fallida'."""
+        self.totales["no_imagen"] += 1
+        logger.error(f"El archivo '{ruta}' no es una imagen válida ({motivo}). Se elimina y su descarga queda 'fallida'.")
+        try:
+            os.remove(ruta)
+        except OSError as e:
+            logger.warning(f"No se pudo eliminar el archivo no válido '{ruta}': {e}")
+        escribir(self.conn, self.servicio, _marcar_descarga_no_imagen, ruta, motivo)
+
+    def _resolver(self, ruta, entrada):
+        """Ruta a enviar según la entrada de caché; guarda sus tamaños para el resumen."""
+        if entrada["estado"] == "procesada":
+            self._tamanos[os.path.basename(ruta)] = (entrada["tamano_original"], entrada["tamano_procesada"])
+            return entrada["ruta_procesada"]
+        self._tamanos[os.path.basename(ruta)] = (entrada["tamano_original"], entrada["tamano_original"])
+        return ruta
+
+    def registrar_enviadas(self, nombres):
+        """Suma al resumen los bytes de las imágenes confirmadas por el endpoint (por nombre de archivo)."""
+        if not self.habilitado:
+            return
+        for nombre in nombres:
+            tamanos = self._tamanos.pop(nombre, None)
+            if tamanos is not None:
+                self.totales["enviadas"] += 1
+                self.totales["bytes_originales"] += tamanos[0]
+                self.totales["bytes_enviados"] += tamanos[1]
+
+    def procesar(self, rutas):
+        """Normaliza las imágenes indicadas (las vigentes en caché no se vuelven a procesar)."""
+        if not self.habilitado or not rutas:
+            return {ruta: ruta for ruta in rutas}
+
+        rutas = list(dict.fromkeys(rutas))
+        entradas = self._entradas_cache(rutas)
+        resultado = {}
+        pendientes = {}
+        for ruta in rutas:
+            try:
+                estado_archivo = (os.path.getsize(ruta), os.stat(ruta).st_mtime_ns)
+            except OSError:
+                estado_archivo = None
+            if estado_archivo is None:
+                resultado[ruta] = ruta  # El envío reportará el archivo faltante.
+            elif _entrada_vigente(entradas.get(ruta), estado_archivo, self.texto_parametros):
+                self.totales["desde_cache"] += 1
+                resultado[ruta] = self._resolver(ruta, entradas[ruta])
+            else:
+                pendientes[ruta] = estado_archivo
+
+        if pendientes:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.trabajadores)
+            inicio = time.monotonic()
+            futuros = {
+                ruta: self._pool.submit(normalizar_imagen, ruta, ruta_procesada(ruta, self.carpeta_procesadas), self.parametros)
+                for ruta in pendientes
+            }
+            nuevas = []
+            for ruta, futuro in futuros.items():
+                estado, tamano_procesada, detalle = futuro.result()
+                if estado == "no_imagen":
+                    self._descartar_no_imagen(ruta, detalle)
+                    resultado[ruta] = None
+                    continue
+                if estado == "error":
+                    self.totales["errores"] += 1
+                    logger.warning(f"No se pudo normalizar '{ruta}' ({detalle}). Se enviará el original.")
+                elif estado == "sin_reduccion":
+                    self.totales["sin_reduccion"] += 1
+                    logger.info(f"La versión normalizada de '{ruta}' no es más liviana. Se enviará el original.")
+                elif estado == "procesada":
+                    self.totales["procesadas"] += 1
+                entrada = {
+                    "ruta_original": ruta,
+                    "tamano_original": pendientes[ruta][0],
+                    "mtime_original": pendientes[ruta][1],
+                    "parametros": self.texto_parametros,
+                    "ruta_procesada": ruta_procesada(ruta, self.carpeta_procesadas) if estado == "procesada" else None,
+                    "tamano_procesada": tamano_procesada,
+                    "estado": estado,
+                    "procesado_at": _fecha_hora_actual(),
+                }
+                nuevas.append(tuple(entrada[columna] for columna in COLUMNAS_PROCESADAS))
+                resultado[ruta] = self._resolver(ruta, entrada)
+            if nuevas:
+                escribir(self.conn, self.servicio, _guardar_entradas, nuevas)
+            logger.info(f"Normalizadas {len(pendientes)} imágenes en {time.monotonic() - inicio:.1f} s.")
+
+        return resultado
+
+    def reportar(self):
+        """Registra en el log el resumen de la normalización de la ejecución."""
+        if not self.habilitado:
+            return
+        t = self.totales
+        ahorro = t["bytes_originales"] - t["bytes_enviados"]
+        porcentaje = (100 * ahorro / t["bytes_originales"]) if t["bytes_originales"] else 0
+        logger.info(
+            f"Normalización de imágenes: {t['procesadas']} procesadas, {t['sin_reduccion']} sin reducción, "
+            f"{t['desde_cache']} desde caché, {t['no_imagen']} no válidas, {t['errores']} con error. "
+            f"{t['enviadas']} enviadas: originales {t['bytes_originales'] / (1024 * 1024):.1f} MB, "
+            f"enviados {t['bytes_enviados'] / (1024 * 1024):.1f} MB "
+            f"(ahorro: {ahorro / (1024 * 1024):.1f} MB, {porcentaje:.0f}%)."
+        )
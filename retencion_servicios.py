@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+Servicios de retención y archivo
+Mueve los comentarios entregados hace más de N días (y sus filas de la cola de descargas) a una
+base de archivo, empaqueta sus imágenes en archivos tar comprimidos con un índice, deja lápidas
+para que no se vuelvan a ingresar y recupera espacio con VACUUM incremental
+"""
+import os
+import tarfile
+from datetime import datetime, timedelta
+
+from logger_config import logger
+from cache_descargas_servicios import calcular_sha256
+from imagenes_servicios import (
+    CARPETA_IMAGENES, PATRON_NOMBRE_IMAGEN, listar_imagenes_comentario, ruta_imagen, abrir_para_escribir
+)
+from procesamiento_imagenes_servicios import descartar_procesadas
+
+# Política: se archivan los comentarios 'exitoso' cuyos datos e imágenes se entregaron hace más de RETENCION_DIAS.
+RETENCION_DIAS = int(os.environ.get("RETENCION_DIAS", "90"))
+RETENCION_TAMANO_LOTE = 500
+
+DB_ARCHIVO = "BDD_SNOWFLAKE_archivo.db"
+CARPETA_ARCHIVO = "archivo_imagenes"
+
+# Páginas liberadas por cada PRAGMA incremental_vacuum al terminar un archivado (0 = todas).
+VACUUM_PAGINAS = 0
+
+TABLAS_ARCHIVADAS = ("comentarios", "download_queue")
+
+
+# ============================================================================
+# FUNCIONES DE LA BASE DE ARCHIVO
+# ============================================================================
+
+def adjuntar_base_archivo(conn_sqlite, db_archivo=DB_ARCHIVO):
+    """
+    Adjunta la base de archivo como esquema 'archivo' (la crea si no existe) y asegura sus tablas,
+    con las mismas columnas y claves únicas que las tablas activas y el índice de imágenes archivadas.
+    """
+    bases = {fila[1] for fila in conn_sqlite.execute("PRAGMA database_list")}
+    if "archivo" not in bases:
+        conn_sqlite.execute("ATTACH DATABASE ? AS archivo", (db_archivo,))
+
+    for tabla in TABLAS_ARCHIVADAS:
+        conn_sqlite.execute(f"CREATE TABLE IF NOT EXISTS archivo.{tabla} AS SELECT * FROM main.{tabla} WHERE 0")
+        conn_sqlite.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS archivo.idx_{tabla}_id ON {tabla} (id)")
+        existentes = {fila[1] for fila in conn_sqlite.execute(f"PRAGMA archivo.table_info({tabla})")}
+        for fila in conn_sqlite.execute(f"PRAGMA main.table_info({tabla})").fetchall():
+            if fila[1] not in existentes:
+                conn_sqlite.execute(f"ALTER TABLE archivo.{tabla} ADD COLUMN {fila[1]} {fila[2]}")
+
+    # Misma clave (comment_id, ordinal) que la cola activa. Las bases de archivo anteriores pueden
+    # tener filas repetidas de un comentario archivado más de una vez: se conserva la más reciente.
+    if not conn_sqlite.execute(
+        "SELECT 1 FROM archivo.sqlite_master WHERE type = 'index' AND name = 'idx_download_queue_comentario'"
+    ).fetchone():
+        conn_sqlite.execute("""
+            DELETE FROM archivo.download_queue
+            WHERE id NOT IN (SELECT MAX(id) FROM archivo.download_queue GROUP BY comment_id, ordinal)
+        """)
+        conn_sqlite.execute(
+            "CREATE UNIQUE INDEX archivo.idx_download_queue_comentario ON download_queue (comment_id, ordinal)"
+        )
+
+    conn_sqlite.execute("""
+    CREATE TABLE IF NOT EXISTS archivo.imagenes_archivadas (
+        comment_id INTEGER NOT NULL,
+        nombre TEXT NOT NULL,
+        bundle TEXT NOT NULL,
+        sha256 TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        archivado_at TEXT NOT NULL,
+        PRIMARY KEY (comment_id, nombre)
+    )
+    """)
+    conn_sqlite.commit()
+
+
+def _columnas(conn_sqlite, tabla):
+    """Lista de columnas de una tabla activa, en orden, para copiarlas explícitamente."""
+    return ", ".join(fila[1] for fila in conn_sqlite.execute(f"PRAGMA main.table_info({tabla})"))
+
+
+def _candidatos(conn_sqlite, limite, ultimo_id, tamano_lote):
+    """IDs de comentarios entregados antes de `limite`, por páginas keyset sobre id."""
+    cursor = conn_sqlite.execute("""
+        SELECT id FROM main.comentarios
+        WHERE status = 'exitoso' AND data_sent_at < ? AND images_sent_at < ? AND id > ?
+        ORDER BY id
+        LIMIT ?
+    """, (limite, limite, ultimo_id, tamano_lote))
+    return [fila[0] for fila in cursor.fetchall()]
+
+
+# ============================================================================
+# FUNCIONES DE EMPAQUETADO DE IMÁGENES
+# ============================================================================
+
+def _crear_bundle(ids, carpeta_imagenes, carpeta_archivo):
+    """
+    Empaqueta en un tar.gz las imágenes de los comentarios `ids`.
+    Retorna (ruta_bundle, [(comment_id, nombre, sha256, size, ruta_original)]); ruta_bundle es None si no hay imágenes.
+    """
+    imagenes = [
+        (comment_id, ruta) for comment_id in ids
+        for ruta in listar_imagenes_comentario(comment_id, carpeta_imagenes)
+    ]
+    if not imagenes:
+        return None, []
+
+    os.makedirs(carpeta_archivo, exist_ok=True)
+    nombre_bundle = f"imagenes_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{ids[0]}-{ids[-1]}.tar.gz"
+    ruta_bundle = os.path.join(carpeta_archivo, nombre_bundle)
+    ruta_tmp = f"{ruta_bundle}.tmp"
+
+    indice = []
+    with tarfile.open(ruta_tmp, "w:gz") as tar:
+        for comment_id, ruta in imagenes:
+            nombre = os.path.basename(ruta)
+            tar.add(ruta, arcname=nombre)
+            indice.append((comment_id, nombre, calcular_sha256(ruta), os.path.getsize(ruta), ruta))
+    with open(ruta_tmp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(ruta_tmp, ruta_bundle)
+    return ruta_bundle, indice
+
+
+# ============================================================================
+# FUNCIÓN PRINCIPAL: ARCHIVAR
+# ============================================================================
+
+def archivar_entregados(conn_sqlite, dias=RETENCION_DIAS, carpeta_imagenes=CARPETA_IMAGENES,
+                        carpeta_archivo=CARPETA_ARCHIVO, db_archivo=DB_ARCHIVO, tamano_lote=RETENCION_TAMANO_LOTE):
+    """
+    Archiva los comentarios 'exitoso' cuyos datos e imágenes se entregaron hace más de `dias` días.
+    Por cada lote: empaqueta sus imágenes en un tar.gz, copia sus filas (comentarios y download_queue)
+    a la base de archivo, las borra de la base activa dejando lápidas y, al final, elimina los archivos
+    originales. La copia al archivo se confirma antes del borrado, por lo que una interrupción solo
+    puede dejar filas duplicadas que la siguiente ejecución vuelve a procesar sin pérdida.
+    Retorna {"comentarios": n, "imagenes": n, "bytes_imagenes": n}.
+    """
+    limite = (datetime.now() - timedelta(days=dias)).strftime("%Y-%m-%d %H:%M:%S")
+    logger.info(f"Archivando comentarios entregados antes de {limite} (retención de {dias} días)...")
+    adjuntar_base_archivo(conn_sqlite, db_archivo)
+    columnas = {tabla: _columnas(conn_sqlite, tabla) for tabla in TABLAS_ARCHIVADAS}
+
+    totales = {"comentarios": 0, "imagenes": 0, "bytes_imagenes": 0}
+    ultimo_id = 0
+    while True:
+        ids = _candidatos(conn_sqlite, limite, ultimo_id, tamano_lote)
+        if not ids:
+            break
+        ultimo_id = ids[-1]
+        marcadores = ",".join("?" for _ in ids)
+        ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        ruta_bundle, indice = _crear_bundle(ids, carpeta_imagenes, carpeta_archivo)
+
+        # 1. Copia a la base de archivo (idempotente) e índice de imágenes.
+        with conn_sqlite:
+            conn_sqlite.execute(f"""
+                INSERT OR REPLACE INTO archivo.comentarios ({columnas['comentarios']})
+                SELECT {columnas['comentarios']} FROM main.comentarios WHERE id IN ({marcadores})
+            """, ids)
+            conn_sqlite.execute(f"""
+                INSERT OR REPLACE INTO archivo.download_queue ({columnas['download_queue']})
+                SELECT {columnas['download_queue']} FROM main.download_queue WHERE comment_id IN ({marcadores})
+            """, ids)
+            conn_sqlite.executemany("""
+                INSERT OR REPLACE INTO archivo.imagenes_archivadas (comment_id, nombre, bundle, sha256, size, archivado_at)
+                VALUES (?,?,?,?,?,?)
+            """, [(comment_id, nombre, ruta_bundle, sha256, size, ahora) for comment_id, nombre, sha256, size, _ in indice])
+
+        # 2. Lápidas y borrado de la base activa.
+        with conn_sqlite:
+            conn_sqlite.execute(f"""
+                INSERT OR REPLACE INTO main.comentarios_archivados (id, FINGERPRINT, archivado_at)
+                SELECT id, FINGERPRINT, ? FROM main.comentarios WHERE id IN ({marcadores})
+            """, (ahora, *ids))
+            conn_sqlite.execute(f"DELETE FROM main.download_queue WHERE comment_id IN ({marcadores})", ids)
+            conn_sqlite.execute(f"DELETE FROM main.comentarios WHERE id IN ({marcadores})", ids)
+
+        # 3. Solo ahora se eliminan las imágenes originales (ya están en el bundle) y sus versiones
+        #    normalizadas, que se regeneran si el comentario se restaura.
+        for _, _, _, size, ruta in indice:
+            os.remove(ruta)
+            totales["bytes_imagenes"] += size
+        with conn_sqlite:
+            descartar_procesadas(conn_sqlite, [ruta for _, _, _, _, ruta in indice])
+
+        totales["comentarios"] += len(ids)
+        totales["imagenes"] += len(indice)
+        logger.info(f"Lote archivado: {len(ids)} comentarios y {len(indice)} imágenes" + (f" en '{ruta_bundle}'." if ruta_bundle else "."))
+
+    if totales["comentarios"]:
+        vacuum_incremental(conn_sqlite)
+    logger.info(
+        f"Archivado completado: {totales['comentarios']} comentarios y {totales['imagenes']} imágenes "
+        f"({totales['bytes_imagenes'] / (1024 * 1024):.1f} MB) movidos al archivo."
+    )
+    return totales
+
+
+def vacuum_incremental(conn_sqlite, paginas=VACUUM_PAGINAS):
+    """
+    Devuelve al sistema de archivos las páginas libres de la base activa con PRAGMA incremental_vacuum.
+    Si la base aún no usa auto_vacuum=INCREMENTAL, lo activa con un VACUUM completo (solo la primera vez).
+    """
+    conn_sqlite.commit()
+    if conn_sqlite.execute("PRAGMA main.auto_vacuum").fetchone()[0] != 2:
+        logger.info("Activando auto_vacuum=INCREMENTAL en la base activa (VACUUM completo, solo esta vez)...")
+        conn_sqlite.execute("PRAGMA main.auto_vacuum = INCREMENTAL")
+        conn_sqlite.execute("VACUUM main")
+        return
+
+    libres = conn_sqlite.execute("PRAGMA main.freelist_count").fetchone()[0]
+    conn_sqlite.execute(f"PRAGMA main.incremental_vacuum({int(paginas)})").fetchall()
+    conn_sqlite.commit()
+    tamano_pagina = conn_sqlite.execute("PRAGMA main.page_size").fetchone()[0]
+    liberadas = libres - conn_sqlite.execute("PRAGMA main.freelist_count").fetchone()[0]
+    logger.info(f"VACUUM incremental: {liberadas} páginas liberadas ({liberadas * tamano_pagina / (1024 * 1024):.1f} MB).")
+
+
+# ============================================================================
+# FUNCIÓN PRINCIPAL: RESTAURAR
+# ============================================================================
+
+def restaurar_comentarios(conn_sqlite, ids, carpeta_imagenes=CARPETA_IMAGENES, db_archivo=DB_ARCHIVO):
+    """
+    Devuelve a la base activa los comentarios archivados `ids`, con sus filas de la cola de descargas,
+    y extrae sus imágenes de los bundles a la carpeta de imágenes (verificando el SHA-256).
+    Los comentarios conservan su estado y sus marcas de entrega. Retorna la cantidad restaurada.
+    """
+    ids = [int(comment_id) for comment_id in ids]
+    if not ids:
+        return 0
+    adjuntar_base_archivo(conn_sqlite, db_archivo)
+    columnas = {tabla: _columnas(conn_sqlite, tabla) for tabla in TABLAS_ARCHIVADAS}
+    marcadores = ",".join("?" for _ in ids)
+
+    # Un comentario que volvió a la base activa (se modificó en Snowflake) no se pisa con su copia archivada.
+    encontrados = [fila[0] for fila in conn_sqlite.execute(f"""
+        SELECT id FROM archivo.comentarios
+        WHERE id IN ({marcadores}) AND id NOT IN (SELECT id FROM main.comentarios)
+    """, ids)]
+    faltantes = set(ids) - set(encontrados)
+    if faltantes:
+        logger.warning(f"No están en el archivo (o ya están activos) los comentarios: {', '.join(str(i) for i in sorted(faltantes))}")
+    if not encontrados:
+        return 0
+    marcadores = ",".join("?" for _ in encontrados)
+
+    # 1. Extraer las imágenes primero: si un bundle falta o está dañado, no se toca la base.
+    imagenes = conn_sqlite.execute(f"""
+        SELECT comment_id, nombre, bundle, sha256 FROM archivo.imagenes_archivadas
+        WHERE comment_id IN ({marcadores}) ORDER BY bundle
+    """, encontrados).fetchall()
+    rutas_restauradas = {}
+    bundle_abierto, tar = None, None
+    try:
+        for comment_id, nombre, bundle, sha256 in imagenes:
+            if bundle != bundle_abierto:
+                if tar is not None:
+                    tar.close()
+                tar, bundle_abierto = tarfile.open(bundle, "r:gz"), bundle
+            ordinal = PATRON_NOMBRE_IMAGEN.match(nombre).group("ordinal")
+            destino = ruta_imagen(comment_id, ordinal, carpeta_imagenes)
+            with tar.extractfile(nombre) as origen, abrir_para_escribir(destino) as f:
+                f.write(origen.read())
+            if calcular_sha256(destino) != sha256:
+                raise ValueError(f"La imagen '{nombre}' restaurada desde '{bundle}' no coincide con su SHA-256.")
+            rutas_restauradas[(comment_id, int(ordinal))] = destino
+    finally:
+        if tar is not None:
+            tar.close()
+
+    # 2. Mover las filas de vuelta y quitar las lápidas.
+    with conn_sqlite:
+        conn_sqlite.execute(f"""
+            INSERT OR REPLACE INTO main.comentarios ({columnas['comentarios']})
+            SELECT {columnas['comentarios']} FROM archivo.comentarios WHERE id IN ({marcadores})
+        """, encontrados)
+        conn_sqlite.execute(f"""
+            INSERT OR REPLACE INTO main.download_queue ({columnas['download_queue']})
+            SELECT {columnas['download_queue']} FROM archivo.download_queue WHERE comment_id IN ({marcadores})
+        """, encontrados)
+        conn_sqlite.executemany(
+            "UPDATE main.download_queue SET local_path = ? WHERE comment_id = ? AND ordinal = ?",
+            [(ruta, comment_id, ordinal) for (comment_id, ordinal), ruta in rutas_restauradas.items()]
+        )
+        conn_sqlite.execute(f"DELETE FROM main.comentarios_archivados WHERE id IN ({marcadores})", encontrados)
+
+    with conn_sqlite:
+        conn_sqlite.execute(f"DELETE FROM archivo.imagenes_archivadas WHERE comment_id IN ({marcadores})", encontrados)
+        conn_sqlite.execute(f"DELETE FROM archivo.download_queue WHERE comment_id IN ({marcadores})", encontrados)
+        conn_sqlite.execute(f"DELETE FROM archivo.comentarios WHERE id IN ({marcadores})", encontrados)
+
+    logger.info(f"Restaurados {len(encontrados)} comentarios y {len(rutas_restauradas)} imágenes desde el archivo.")
+    return len(encontrados)
+
+
+# ============================================================================
+# FUNCIÓN PRINCIPAL: REINGRESAR
+# ============================================================================
+
+def reingresar_archivado(conn_sqlite, comment_id, db_archivo=DB_ARCHIVO):
+    """
+    Devuelve a la base activa la fila archivada de un comentario que cambió en Snowflake, con sus
+    filas de la cola de descargas, y quita su lápida, para que la sincronización lo trate como una
+    modificación: las imágenes ya enviadas conservan su ordinal y su `sent_at`, y solo las URLs nuevas
+    se encolan y se envían. Las imágenes no se extraen (siguen en su bundle y en el índice).
+    Retorna False si el comentario no está en la base de archivo.
+    """
+    if not os.path.exists(db_archivo):
+        return False
+    conn_sqlite.commit()
+    adjuntar_base_archivo(conn_sqlite, db_archivo)
+    if not conn_sqlite.execute("SELECT 1 FROM archivo.comentarios WHERE id = ?", (comment_id,)).fetchone():
+        return False
+
+    columnas = {tabla: _columnas(conn_sqlite, tabla) for tabla in TABLAS_ARCHIVADAS}
+    with conn_sqlite:
+        conn_sqlite.execute(f"""
+            INSERT OR REPLACE INTO main.comentarios ({columnas['comentarios']})
+            SELECT {columnas['comentarios']} FROM archivo.comentarios WHERE id = ?
+        """, (comment_id,))
+        conn_sqlite.execute(f"""
+            INSERT OR REPLACE INTO main.download_queue ({columnas['download_queue']})
+            SELECT {columnas['download_queue']} FROM archivo.download_queue WHERE comment_id = ?
+        """, (comment_id,))
+        conn_sqlite.execute("DELETE FROM main.comentarios_archivados WHERE id = ?", (comment_id,))
+    with conn_sqlite:
+        conn_sqlite.execute("DELETE FROM archivo.download_queue WHERE comment_id = ?", (comment_id,))
+        conn_sqlite.execute("DELETE FROM archivo.comentarios WHERE id = ?", (comment_id,))
+    return True
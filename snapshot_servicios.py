@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Servicios de snapshots locales de las extracciones de Snowflake
+Guarda el resultado de cada query como Parquet comprimido y permite re-ejecutar
+la ingesta desde un snapshot sin conexión a Snowflake (modo 'replay')
+"""
+import os
+import re
+import shutil
+import hashlib
+from datetime import datetime
+
+from logger_config import logger
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+CARPETA_SNAPSHOTS = "snapshots"
+COMPRESION_SNAPSHOTS = "zstd"
+# Cantidad de snapshots (ejecuciones) que se conservan; al guardar uno nuevo se eliminan los más antiguos.
+SNAPSHOTS_CONSERVAR = 5
+
+
+# ============================================================================
+# FUNCIONES DE UTILIDAD
+# ============================================================================
+
+def _verificar_pyarrow():
+    """Lanza un error claro si pyarrow no está instalado."""
+    if pa is None:
+        raise ImportError("Los snapshots requieren el paquete 'pyarrow'. Instálelo con: pip install pyarrow")
+
+
+def huella_query(query):
+    """
+    Genera la huella de una query: SHA-256 del texto con espacios normalizados.
+    Dos queries que solo difieren en indentación o saltos de línea comparten huella.
+    """
+    normalizada = re.sub(r"\s+", " ", query).strip().rstrip(";").strip()
+    return hashlib.sha256(normalizada.encode("utf-8")).hexdigest()[:16]
+
+
+def nueva_marca_snapshot():
+    """Retorna la marca de tiempo que identifica los snapshots de una ejecución."""
+    return datetime.now().strftime("%Y%m%d_%H%M%S")
+
+
+def listar_snapshots():
+    """Retorna las marcas de snapshot disponibles, de la más antigua a la más reciente."""
+    if not os.path.isdir(CARPETA_SNAPSHOTS):
+        return []
+    return sorted(
+        nombre for nombre in os.listdir(CARPETA_SNAPSHOTS)
+        if os.path.isdir(os.path.join(CARPETA_SNAPSHOTS, nombre))
+    )
+
+
+def depurar_snapshots(conservar=SNAPSHOTS_CONSERVAR, proteger=None):
+    """
+    Elimina los snapshots más antiguos hasta dejar los `conservar` más recientes.
+    El snapshot `proteger` (el de la ejecución en curso) nunca se elimina. Retorna las marcas eliminadas.
+    """
+    disponibles = [marca for marca in listar_snapshots() if marca != proteger]
+    sobrantes = disponibles[:max(0, len(disponibles) - (conservar - (1 if proteger else 0)))]
+    for marca in sobrantes:
+        shutil.rmtree(os.path.join(CARPETA_SNAPSHOTS, marca), ignore_errors=True)
+    if sobrantes:
+        logger.info(f"{len(sobrantes)} snapshot(s) antiguo(s) eliminado(s); se conservan los {conservar} más recientes.")
+    return sobrantes
+
+
+def _ruta_snapshot(marca, query):
+    """Ruta del archivo Parquet de una query dentro del snapshot `marca`."""
+    return os.path.join(CARPETA_SNAPSHOTS, marca, f"{huella_query(query)}.parquet")
+
+
+# ============================================================================
+# FUNCIONES DE LECTURA Y ESCRITURA
+# ============================================================================
+
+def guardar_snapshot(filas, query, marca):
+    """
+    Persiste las filas de una query como Parquet comprimido en snapshots/<marca>/<huella>.parquet.
+    Las filas pueden ser Rows de Snowpark o diccionarios.
+    """
+    _verificar_pyarrow()
+    ruta = _ruta_snapshot(marca, query)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+
+    registros = [fila.asDict() if hasattr(fila, "asDict") else dict(fila) for fila in filas]
+    tabla = pa.Table.from_pylist(registros)
+    tabla = tabla.replace_schema_metadata({"query": query})
+    pq.write_table(tabla, ruta, compression=COMPRESION_SNAPSHOTS)
+
+    logger.info(f"Snapshot guardado en '{ruta}' con {len(registros)} filas ({os.path.getsize(ruta)} bytes).")
+    return ruta
+
+
+def cargar_snapshot(query, marca):
+    """
+    Lee las filas de una query desde el snapshot `marca`.
+    Retorna una lista de diccionarios con las mismas claves que las Rows de Snowflake.
+    """
+    _verificar_pyarrow()
+    ruta = _ruta_snapshot(marca, query)
+    if not os.path.isfile(ruta):
+        raise FileNotFoundError(f"El snapshot '{marca}' no contiene la query con huella {huella_query(query)}: {ruta}")
+
+    filas = pq.read_table(ruta).to_pylist()
+    logger.info(f"Snapshot '{ruta}' cargado con {len(filas)} filas.")
+    return filas
+
+
+# ============================================================================
+# ADAPTADORES DE SESIÓN
+# ============================================================================
+
+class _TrabajoSnapshot:
+    """
+    Imita el AsyncJob de Snowpark devuelto por `collect_nowait()`; solo soporta is_done() y result().
+    Envuelve un trabajo real (y ejecuta `al_terminar` con sus filas una sola vez) o filas ya disponibles.
+    """
+
+    def __init__(self, trabajo=None, filas=None, al_terminar=None):
+        self._trabajo = trabajo
+        self._filas = filas
+        self._al_terminar = al_terminar
+
+    def is_done(self):
+        return self._trabajo is None or self._trabajo.is_done()
+
+    def result(self):
+        if self._trabajo is not None:
+            filas = self._trabajo.result()
+            self._trabajo, self._filas = None, filas
+            if self._al_terminar is not None:
+                self._al_terminar(filas)
+        return self._filas
+
+
+class _ConsultaSnapshot:
+    """Imita el DataFrame de Snowpark devuelto por `session.sql()`; solo soporta collect() y collect_nowait()."""
+
+    def __init__(self, obtener_filas, enviar_async=None):
+        self._obtener_filas = obtener_filas
+        self._enviar_async = enviar_async
+
+    def collect(self):
+        return self._obtener_filas()
+
+    def collect_nowait(self):
+        if self._enviar_async is None:
+            return _TrabajoSnapshot(filas=self._obtener_filas())
+        return self._enviar_async()
+
+
+class SesionConSnapshot:
+    """
+    Envuelve una sesión de Snowpark y guarda un snapshot de cada query que se ejecuta con collect()
+    o collect_nowait() (en este caso, al obtener su resultado).
+    Tras guardar el primer snapshot de la ejecución se eliminan los antiguos, conservando los
+    `conservar` más recientes. Sin pyarrow no se guardan snapshots (se advierte una sola vez).
+    Un error al guardar el snapshot se registra en el log pero no interrumpe la ejecución.
+    """
+
+    def __init__(self, session, marca=None, conservar=SNAPSHOTS_CONSERVAR):
+        self.session = session
+        self.marca = marca or nueva_marca_snapshot()
+        self.conservar = conservar
+        self.habilitado = pa is not None
+        self._depurado = False
+        if not self.habilitado:
+            logger.warning("pyarrow no está instalado: esta ejecución no guardará snapshots (pip install pyarrow).")
+
+    def _guardar(self, filas, query):
+        if not self.habilitado:
+            return
+        try:
+            guardar_snapshot(filas, query, self.marca)
+            if not self._depurado:
+                self._depurado = True
+                depurar_snapshots(self.conservar, proteger=self.marca)
+        except Exception:
+            logger.exception("No se pudo guardar el snapshot de la query. La ejecución continúa sin él.")
+
+    def sql(self, query):
+        consulta = self.session.sql(query)
+
+        def obtener_filas():
+            filas = consulta.collect()
+            self._guardar(filas, query)
+            return filas
+
+        def enviar_async():
+            return _TrabajoSnapshot(consulta.collect_nowait(), al_terminar=lambda filas: self._guardar(filas, query))
+
+        return _ConsultaSnapshot(obtener_filas, enviar_async)
+
+    def close(self):
+        self.session.close()
+
+
+class SesionReplay:
+    """
+    Sustituye a la sesión de Snowpark leyendo las queries desde un snapshot local.
+    Si no se indica `marca`, usa el snapshot más reciente.
+    """
+
+    def __init__(self, marca=None):
+        disponibles = listar_snapshots()
+        if marca is None:
+            if not disponibles:
+                raise FileNotFoundError(f"No hay snapshots disponibles en '{CARPETA_SNAPSHOTS}'.")
+            marca = disponibles[-1]
+        elif marca not in disponibles:
+            raise FileNotFoundError(f"No existe el snapshot '{marca}'. Disponibles: {', '.join(disponibles) or 'ninguno'}")
+        self.marca = marca
+        logger.info(f"Reproduciendo extracciones desde el snapshot '{marca}'.")
+
+    def sql(self, query):
+        return _ConsultaSnapshot(lambda: cargar_snapshot(query, self.marca))
+
+    def close(self):
+        pass
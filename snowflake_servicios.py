@@ -8,14 +8,31 @@ import hashlib
 import ast
 import os
 import json
+import time
 import base64
-from datetime import datetime
+import socket
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 
 from logger_config import logger
+from imagenes_servicios import CARPETA_IMAGENES, ruta_imagen, buscar_imagen, abrir_para_escribir
+from cache_descargas_servicios import (
+    crear_tabla_cache_descargas, obtener_entrada_cache, url_de_ruta, guardar_entrada_cache,
+    nueva_entrada_cache, normalizar_url, archivo_coincide, entrada_vigente, revalidar_condicional
+)
+from procesamiento_imagenes_servicios import crear_tabla_imagenes_procesadas
+from escritor_sqlite_servicios import escribir
+from retencion_servicios import reingresar_archivado
+
+# Reintentos de la cola de descargas: espera = min(BASE * 2^(intentos-1), MAXIMO) segundos.
+DESCARGAS_MAX_INTENTOS = 5
+DESCARGAS_BACKOFF_BASE_SEG = 30
+DESCARGAS_BACKOFF_MAXIMO_SEG = 3600
 
 # ============================================================================
 # FUNCIONES DE UTILIDAD GENERAL
@@ -31,19 +48,14 @@ def generar_md5(*valores):
 # FUNCIONES DE DESCARGA DE IMÁGENES
 # ============================================================================
 
-def descarga_img_selenium(url, contImg, ID):
+def obtener_imagen_selenium_con_metadatos(url):
     """
-    Descarga una imagen desde una URL usando Selenium en modo headless.
-    Verifica si la imagen ya existe antes de descargarla.
-    Retorna la ruta del archivo guardado o None si falla.
+    Abre una URL con Selenium en modo headless y retorna (bytes, metadatos) de la imagen que
+    contiene. Los metadatos incluyen la URL real de la imagen ('src') y sus cabeceras ETag,
+    Last-Modified y Content-Type (si el navegador las expone), usadas luego para revalidar la
+    caché con un GET condicional.
+    Lanza excepción si la imagen no se puede obtener.
     """
-    nombre = f"{ID}_{contImg}.jpg"
-    ruta_destino = os.path.join("carpeta_imagenes", nombre)
-
-    if os.path.exists(ruta_destino):
-        logger.info(f"Imagen ya existe, se omite la descarga: {ruta_destino}")
-        return ruta_destino
-
     options = webdriver.EdgeOptions()
     options.add_argument("--headless=new")
     driver = webdriver.Edge(options=options)
@@ -59,31 +71,31 @@ def descarga_img_selenium(url, contImg, ID):
         js = """
         const url = arguments[0];
         return fetch(url)
-            .then(res => res.blob())
-            .then(blob => new Promise((resolve) => {
+            .then(res => res.blob().then(blob => new Promise((resolve) => {
                 const reader = new FileReader();
-                reader.onloadend = () => resolve(reader.result.split(',')[1]);
+                reader.onloadend = () => resolve({
+                    data: reader.result.split(',')[1],
+                    etag: res.headers.get('ETag'),
+                    last_modified: res.headers.get('Last-Modified'),
+                    content_type: res.headers.get('Content-Type')
+                });
                 reader.readAsDataURL(blob);
-            }));
+            })));
         """
         
-        base64_data = driver.execute_script(js, src)
+        resultado = driver.execute_script(js, src) or {}
+        base64_data = resultado.get("data")
         
         if not base64_data:
-            logger.error(f"No se pudo obtener la imagen en base64 con JS desde la URL: {url}")
-            return None
-        
-        imagen = base64.b64decode(base64_data)
+            raise ValueError(f"No se pudo obtener la imagen en base64 con JS desde la URL: {url}")
         
-        with open(ruta_destino, "wb") as f:
-            f.write(imagen)
-        
-        logger.info(f"Imagen descargada y guardada exitosamente en: {ruta_destino}")
-        return ruta_destino
-    
-    except Exception:
-        logger.exception(f"Error fatal al descargar o procesar la imagen desde la URL: {url}")
-        return None
+        metadatos = {
+            "src": src,
+            "etag": resultado.get("etag"),
+            "last_modified": resultado.get("last_modified"),
+            "content_type": resultado.get("content_type"),
+        }
+        return base64.b64decode(base64_data), metadatos
     
     finally:
         driver.quit()
@@ -93,45 +105,44 @@ def descarga_img_selenium(url, contImg, ID):
 # FUNCIONES DE PROCESAMIENTO DE IMÁGENES
 # ============================================================================
 
-def procesar_imagenes_historico(location_urls, comment_id):
+def parsear_location_urls(location_urls, comment_id):
     """
-    Procesa y descarga imágenes asociadas a un comentario.
+    Convierte el texto de LOCATION_URLS en la lista de URLs no vacías del comentario.
+    Retorna una lista vacía si el campo no tiene URLs o su formato no es válido.
     """
     if not location_urls:
-        return 0
-    
-    contador_imagenes = 0
+        return []
     
     try:
         urls = ast.literal_eval(location_urls)
-        if not isinstance(urls, list):
-            logger.warning(f"El formato de location_urls para el comentario {comment_id} no es una lista: {location_urls}")
-            return 0
-
-        cont_img = 1
-        for url in urls:
-            if not url:
-                continue
-            
-            logger.info(f"Procesando imagen {cont_img}/{len(urls)} para comentario ID {comment_id}...")
-            ruta_img = descarga_img_selenium(url, cont_img, comment_id)
-            
-            if ruta_img:
-                cont_img += 1
-                contador_imagenes += 1
-    
     except (ValueError, SyntaxError):
         logger.error(f"Error de formato en 'location_urls' para comentario ID {comment_id}. Valor: {location_urls}")
-    except Exception:
-        logger.exception(f"Error inesperado procesando imágenes para comentario ID {comment_id}.")
-    
-    return contador_imagenes
+        return []
+
+    if not isinstance(urls, list):
+        logger.warning(f"El formato de location_urls para el comentario {comment_id} no es una lista: {location_urls}")
+        return []
+
+    return [url for url in urls if url]
 
 
 # ============================================================================
 # FUNCIONES DE GESTIÓN DE TABLAS SQLITE
 # ============================================================================
 
+def _asegurar_columna(cursor, tabla, columna, definicion):
+    """
+    Agrega una columna a una tabla existente si aún no la tiene (migración de bases antiguas).
+    Retorna True si la columna se agregó.
+    """
+    cursor.execute(f"PRAGMA table_info({tabla})")
+    if columna not in {fila[1] for fila in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}")
+        logger.info(f"Columna '{columna}' agregada a la tabla '{tabla}'.")
+        return True
+    return False
+
+
 def crear_tabla_ot(cursor):
     """Crea la tabla de órdenes de trabajo si no existe"""
     cursor.execute("""
@@ -164,12 +175,147 @@ def crear_tabla_comentarios(cursor):
         CREATED_DATE TEXT,
         MD5 TEXT,
         status TEXT NOT NULL DEFAULT 'pendiente',
-        ACTIVITY_NAME TEXT
+        ACTIVITY_NAME TEXT,
+        FINGERPRINT TEXT,
+        queued_at TEXT,
+        lease_owner TEXT,
+        lease_expira TEXT,
+        data_sent_at TEXT,
+        images_sent_at TEXT,
+        payload_hash TEXT
     )
     """)
+    _asegurar_columna(cursor, "comentarios", "FINGERPRINT", "TEXT")
+    if _asegurar_columna(cursor, "comentarios", "queued_at", "TEXT"):
+        # Los pendientes anteriores a la columna empiezan a contar su espera desde la migración.
+        cursor.execute("UPDATE comentarios SET queued_at = datetime('now', 'localtime') WHERE queued_at IS NULL")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_comentarios_prioridad
+        ON comentarios (status, COMMENT_USED_FOR, CREATED_DATE, id)
+    """)
+    _asegurar_columna(cursor, "comentarios", "lease_owner", "TEXT")
+    _asegurar_columna(cursor, "comentarios", "lease_expira", "TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_comentarios_arriendo ON comentarios (status, lease_expira)")
+    _asegurar_columna(cursor, "comentarios", "images_sent_at", "TEXT")
+    _asegurar_columna(cursor, "comentarios", "payload_hash", "TEXT")
+    if _asegurar_columna(cursor, "comentarios", "data_sent_at", "TEXT"):
+        # Un comentario 'exitoso' ya tiene sus datos e imágenes entregados con el contenido actual.
+        cursor.execute("""
+            UPDATE comentarios
+            SET data_sent_at = datetime('now', 'localtime'), images_sent_at = datetime('now', 'localtime'),
+                payload_hash = FINGERPRINT
+            WHERE status = 'exitoso'
+        """)
     logger.info("Tabla 'comentarios' asegurada en SQLite.")
 
 
+def crear_tabla_download_queue(cursor):
+    """
+    Crea la cola persistente de descargas si no existe.
+    Hay una fila por URL de LOCATION_URLS; `ordinal` (desde 1) define el nombre del archivo
+    y `sent_at` indica cuándo la imagen se envió al endpoint.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS download_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        comment_id INTEGER NOT NULL,
+        ordinal INTEGER NOT NULL,
+        url TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pendiente',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TEXT,
+        last_error TEXT,
+        local_path TEXT,
+        sent_at TEXT,
+        UNIQUE (comment_id, ordinal)
+    )
+    """)
+    _asegurar_columna(cursor, "download_queue", "sent_at", "TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_download_queue_status ON download_queue (status, next_attempt_at)")
+    logger.info("Tabla 'download_queue' asegurada en SQLite.")
+
+
+def crear_tabla_comentarios_archivados(cursor):
+    """
+    Crea la tabla de lápidas de comentarios archivados si no existe.
+    Conserva el id y la huella de cada comentario movido a la base de archivo, para que la
+    sincronización no lo vuelva a ingresar como nuevo.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS comentarios_archivados (
+        id INTEGER PRIMARY KEY,
+        FINGERPRINT TEXT,
+        archivado_at TEXT NOT NULL
+    )
+    """)
+    logger.info("Tabla 'comentarios_archivados' asegurada en SQLite.")
+
+
+def crear_secuencia_cambios(cursor):
+    """
+    Asegura la columna `change_seq` de comentarios y los triggers que la mantienen.
+    Cada inserción y cada cambio de contenido (FINGERPRINT) o de estado le asigna el siguiente
+    número de secuencia, que usan las exportaciones incrementales como cursor.
+    El último número asignado se guarda en la tabla de una fila `secuencia_cambios` y nunca retrocede,
+    aunque el archivado borre las filas con la secuencia más alta.
+    """
+    _asegurar_columna(cursor, "comentarios", "change_seq", "INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_comentarios_change_seq ON comentarios (change_seq)")
+    cursor.execute("UPDATE comentarios SET change_seq = id WHERE change_seq IS NULL")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS secuencia_cambios (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        ultimo INTEGER NOT NULL
+    )
+    """)
+    # El contador parte del mayor número ya asignado o ya exportado (bases anteriores a la tabla).
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'export_cursores'")
+    exportado = "(SELECT MAX(ultimo) FROM export_cursores WHERE tabla = 'comentarios')" if cursor.fetchone() else "0"
+    cursor.execute(f"""
+        INSERT INTO secuencia_cambios (id, ultimo)
+        VALUES (1, MAX((SELECT COALESCE(MAX(change_seq), 0) FROM comentarios), COALESCE({exportado}, 0)))
+        ON CONFLICT (id) DO UPDATE SET ultimo = MAX(ultimo, excluded.ultimo)
+    """)
+    # Se recrean siempre para que las bases existentes tomen el contador y la condición vigentes.
+    cursor.execute("DROP TRIGGER IF EXISTS trg_comentarios_change_seq_insert")
+    cursor.execute("""
+    CREATE TRIGGER trg_comentarios_change_seq_insert AFTER INSERT ON comentarios
+    BEGIN
+        UPDATE secuencia_cambios SET ultimo = ultimo + 1 WHERE id = 1;
+        UPDATE comentarios SET change_seq = (SELECT ultimo FROM secuencia_cambios WHERE id = 1)
+        WHERE id = NEW.id;
+    END
+    """)
+    # Inicializar la huella de una fila antigua (OLD.FINGERPRINT nulo) no es un cambio de contenido, y
+    # reclamar o liberar un arriendo ('pendiente' <-> 'en_proceso') no es un cambio de estado visible.
+    cursor.execute("DROP TRIGGER IF EXISTS trg_comentarios_change_seq_update")
+    cursor.execute("""
+    CREATE TRIGGER trg_comentarios_change_seq_update AFTER UPDATE OF FINGERPRINT, status ON comentarios
+    WHEN (NEW.status IS NOT OLD.status
+          AND COALESCE(NEW.status, '') <> 'en_proceso'
+          AND NOT (OLD.status = 'en_proceso' AND NEW.status = 'pendiente'))
+      OR (OLD.FINGERPRINT IS NOT NULL AND NEW.FINGERPRINT IS NOT OLD.FINGERPRINT)
+    BEGIN
+        UPDATE secuencia_cambios SET ultimo = ultimo + 1 WHERE id = 1;
+        UPDATE comentarios SET change_seq = (SELECT ultimo FROM secuencia_cambios WHERE id = 1)
+        WHERE id = NEW.id;
+    END
+    """)
+
+
+def asegurar_esquema(conn_sqlite):
+    """Crea todas las tablas locales que no existan. Se llama al abrir la conexión con SQLite."""
+    cursor = conn_sqlite.cursor()
+    crear_tabla_ot(cursor)
+    crear_tabla_comentarios(cursor)
+    crear_tabla_download_queue(cursor)
+    crear_tabla_cache_descargas(cursor)
+    crear_tabla_imagenes_procesadas(cursor)
+    crear_tabla_comentarios_archivados(cursor)
+    crear_secuencia_cambios(cursor)
+    conn_sqlite.commit()
+
+
 # ============================================================================
 # FUNCIONES DE INSERCIÓN Y CONSULTA EN SQLITE
 # ============================================================================
@@ -198,8 +344,8 @@ def insertar_comentario(conn_sqlite, cursor, datos_comentario):
                 id, ACTIVITY_ID, OT, ROLE_NAME, WORK_SEQUENCE_NAME,
                 ELEMENT_STEP, ELEMENT_INSTANCE_NAME, SUFFIX, COMMENT_TITLE,
                 COMMENT_DESCRIPTION, LOCATION_URLS, COMMENT_USED_FOR, CREATED_DATE,
-                MD5, ACTIVITY_NAME
-            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                MD5, ACTIVITY_NAME, FINGERPRINT, queued_at
+            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?, datetime('now', 'localtime'))
         """, datos_comentario)
         conn_sqlite.commit()
         logger.info(f"Nuevo comentario guardado en SQLite: ID={datos_comentario[0]}")
@@ -208,6 +354,25 @@ def insertar_comentario(conn_sqlite, cursor, datos_comentario):
         raise # relanzar para que el flujo principal lo maneje
 
 
+def actualizar_comentario(cursor, datos_comentario):
+    """
+    Sobrescribe los datos de un comentario existente con los de una extracción cuyo contenido cambió
+    y lo vuelve a marcar como 'pendiente' para que se re-envíe. No hace commit.
+    Si otro proceso lo tenía 'en_proceso', su arriendo se anula y ese proceso no podrá marcarlo 'exitoso'.
+    """
+    comment_id, *columnas = datos_comentario
+    cursor.execute("""
+        UPDATE comentarios SET
+            ACTIVITY_ID = ?, OT = ?, ROLE_NAME = ?, WORK_SEQUENCE_NAME = ?,
+            ELEMENT_STEP = ?, ELEMENT_INSTANCE_NAME = ?, SUFFIX = ?, COMMENT_TITLE = ?,
+            COMMENT_DESCRIPTION = ?, LOCATION_URLS = ?, COMMENT_USED_FOR = ?, CREATED_DATE = ?,
+            MD5 = ?, ACTIVITY_NAME = ?, FINGERPRINT = ?, status = 'pendiente',
+            queued_at = datetime('now', 'localtime'), lease_owner = NULL, lease_expira = NULL
+        WHERE id = ?
+    """, (*columnas, comment_id))
+    logger.info(f"Comentario modificado en Snowflake actualizado en SQLite y marcado como 'pendiente': ID={comment_id}")
+
+
 def comentario_existe(cursor, comment_id):
     """Verifica si un comentario ya existe en SQLite por su ID"""
     cursor.execute("SELECT 1 FROM comentarios WHERE id = ?", (comment_id,))
@@ -224,83 +389,762 @@ def ot_existe(cursor, firma):
 # FUNCIONES DE GESTIÓN DE ESTADO
 # ============================================================================
 
-def get_pending_comentarios(conn_sqlite):
-    """Obtiene todos los comentarios con estado 'pendiente' de SQLite."""
-    try:
-        conn_sqlite.row_factory = sqlite3.Row
-        cursor = conn_sqlite.cursor()
-        # Se renombra 'id' a 'ID' para que la clave del diccionario coincida con el resto del código.
-        cursor.execute("""
-            SELECT 
-                id AS ID,
-                ACTIVITY_ID, 
-                OT, 
-                ROLE_NAME, 
-                WORK_SEQUENCE_NAME, 
-                ELEMENT_STEP, 
-                ELEMENT_INSTANCE_NAME, 
-                SUFFIX, 
-                COMMENT_TITLE, 
-                COMMENT_DESCRIPTION, 
-                LOCATION_URLS, 
-                COMMENT_USED_FOR, 
-                CREATED_DATE, 
-                MD5, 
-                status, 
-                ACTIVITY_NAME 
-            FROM comentarios 
-            WHERE status = 'pendiente'
-        """)
-        rows = cursor.fetchall()
-        comentarios = [dict(row) for row in rows]
-        logger.info(f"Se encontraron {len(comentarios)} comentarios con estado 'pendiente'.")
-        return comentarios
-    except sqlite3.OperationalError as e:
-        logger.error(f"Error operacional de SQLite: {e}. Es posible que la columna 'OT' no exista en la tabla 'comentarios'. Si estás usando un modo que no sea 'historico' o 'temp', prueba a ejecutar 'historico' primero para actualizar el esquema de la base de datos.")
-        return []
-    except Exception:
-        logger.exception("Error al obtener comentarios pendientes de SQLite.")
-        return []
-    finally:
-        conn_sqlite.row_factory = None
+TAMANO_PAGINA_PENDIENTES = 500
+
+COLUMNAS_COMENTARIO_ENVIO = """
+    id AS ID, ACTIVITY_ID, OT, ROLE_NAME, WORK_SEQUENCE_NAME, ELEMENT_STEP,
+    ELEMENT_INSTANCE_NAME, SUFFIX, COMMENT_TITLE, COMMENT_DESCRIPTION, LOCATION_URLS,
+    COMMENT_USED_FOR, CREATED_DATE, MD5, status, ACTIVITY_NAME
+"""
+
 
-def get_pending_comentario_ids(conn_sqlite):
+# Datos de un comentario que aún deben enviarse al endpoint: nunca entregados, o entregados con
+# un contenido distinto del actual (la huella guardada al enviar no coincide con FINGERPRINT).
+CONDICION_DATOS_SIN_ENVIAR = "(data_sent_at IS NULL OR payload_hash IS NOT FINGERPRINT)"
+
+
+def contar_comentarios_pendientes(conn_sqlite):
+    """Retorna la cantidad de comentarios con estado 'pendiente'."""
+    cursor = conn_sqlite.cursor()
+    cursor.execute("SELECT COUNT(*) FROM comentarios WHERE status = 'pendiente'")
+    return cursor.fetchone()[0]
+
+
+def contar_datos_sin_enviar(conn_sqlite):
+    """Retorna la cantidad de comentarios cuyos datos no se han entregado con su contenido actual."""
+    cursor = conn_sqlite.cursor()
+    cursor.execute(f"SELECT COUNT(*) FROM comentarios WHERE {CONDICION_DATOS_SIN_ENVIAR}")
+    return cursor.fetchone()[0]
+
+
+def huellas_datos_sin_enviar(conn_sqlite, ids):
     """
-    Obtiene solo los IDs de los comentarios con estado 'pendiente' de SQLite.
-    Es una versión ligera para 'solofotos' que no necesita todos los datos.
+    De los comentarios `ids`, retorna {id: FINGERPRINT} de los que requieren enviar sus datos.
+    Se llama antes del envío para registrar después la huella del contenido efectivamente enviado.
     """
-    try:
-        cursor = conn_sqlite.cursor()
-        cursor.execute("SELECT id FROM comentarios WHERE status = 'pendiente'")
-        rows = cursor.fetchall()
-        # Se retorna una lista de diccionarios para mantener la estructura de datos esperada.
-        comentarios = [{'ID': row[0]} for row in rows]
-        logger.info(f"Se encontraron {len(comentarios)} IDs de comentarios con estado 'pendiente'.")
-        return comentarios
-    except Exception:
-        logger.exception("Error al obtener IDs de comentarios pendientes de SQLite.")
-        return []
+    ids = list(ids)
+    if not ids:
+        return {}
+    cursor = conn_sqlite.execute(f"""
+        SELECT id, FINGERPRINT FROM comentarios
+        WHERE id IN ({",".join("?" for _ in ids)}) AND {CONDICION_DATOS_SIN_ENVIAR}
+    """, ids)
+    return dict(cursor.fetchall())
 
-def update_comment_status(conn_sqlite, comment_id, status):
-    """Actualiza el estado de un único comentario en la base de datos."""
-    if not comment_id:
-        logger.warning("Se intentó actualizar el estado de un comentario sin ID.")
+
+def _escribir_datos_enviados(conn_sqlite, filas):
+    """Escribe las filas (data_sent_at, payload_hash, id) de datos entregados. No hace commit."""
+    conn_sqlite.executemany("UPDATE comentarios SET data_sent_at = ?, payload_hash = ? WHERE id = ?", filas)
+
+
+def registrar_datos_enviados(conn_sqlite, huellas, servicio=None):
+    """
+    Registra como entregados los datos de los comentarios de `huellas` ({id: huella enviada}).
+    Con `servicio` (ServicioEscritura), la escritura pasa por el hilo escritor único.
+    """
+    if not huellas:
         return
+    ahora = fecha_hora_actual()
+    escribir(conn_sqlite, servicio, _escribir_datos_enviados,
+             [(ahora, huella, comment_id) for comment_id, huella in huellas.items()])
+    logger.info(f"Datos de {len(huellas)} comentario(s) registrados como entregados.")
+
+
+def iterar_paginas_datos_sin_enviar(conn_sqlite, tamano_pagina=TAMANO_PAGINA_PENDIENTES):
+    """
+    Itera en páginas de tamaño fijo (lista de diccionarios) los comentarios cuyos datos nunca se
+    entregaron al endpoint o cambiaron desde la última entrega (ver CONDICION_DATOS_SIN_ENVIAR).
+    Usa paginación keyset sobre `id`, por lo que la memoria no depende del tamaño del backlog y los
+    cambios hechos mientras se itera no desplazan las páginas siguientes.
+    """
+    cursor = conn_sqlite.cursor()
+    cursor.row_factory = sqlite3.Row
+    ultimo_id = None
 
-    logger.info(f"Actualizando estado a '{status}' para el comentario ID: {comment_id}...")
+    while True:
+        condicion_keyset = "" if ultimo_id is None else "AND id > ?"
+        parametros = (tamano_pagina,) if ultimo_id is None else (ultimo_id, tamano_pagina)
+        cursor.execute(f"""
+            SELECT {COLUMNAS_COMENTARIO_ENVIO}
+            FROM comentarios
+            WHERE {CONDICION_DATOS_SIN_ENVIAR} {condicion_keyset}
+            ORDER BY id
+            LIMIT ?
+        """, parametros)
+        pagina = [dict(row) for row in cursor.fetchall()]
+        if not pagina:
+            return
+
+        yield pagina
+
+        if len(pagina) < tamano_pagina:
+            return
+        # COLUMNAS_COMENTARIO_ENVIO renombra 'id' a 'ID' para que coincida con el resto del código.
+        ultimo_id = pagina[-1]['ID']
+
+
+# Duración del arriendo de los comentarios reclamados por un proceso de envío. Mientras el proceso
+# sigue activo lo renueva; si muere, al vencer el plazo los comentarios vuelven a 'pendiente'.
+ARRIENDO_DURACION_MIN = 15
+
+
+def identificador_proceso():
+    """Identificador único del proceso de envío, usado como dueño de los arriendos."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _vencimiento_arriendo(duracion_min):
+    """Fecha y hora de vencimiento de un arriendo que empieza ahora."""
+    return (datetime.now() + timedelta(minutes=duracion_min)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def liberar_arriendos_vencidos(conn_sqlite):
+    """
+    Devuelve a 'pendiente' los comentarios 'en_proceso' cuyo arriendo venció (su proceso murió o se colgó).
+    No hace commit. Retorna la cantidad de comentarios liberados.
+    """
+    cursor = conn_sqlite.execute("""
+        UPDATE comentarios SET status = 'pendiente', lease_owner = NULL, lease_expira = NULL
+        WHERE status = 'en_proceso' AND lease_expira < ?
+    """, (fecha_hora_actual(),))
+    if cursor.rowcount:
+        logger.warning(f"{cursor.rowcount} comentario(s) con arriendo vencido devuelto(s) a 'pendiente'.")
+    return cursor.rowcount
+
+
+def reclamar_comentarios(conn_sqlite, ids, propietario, duracion_min=ARRIENDO_DURACION_MIN):
+    """
+    Reclama atómicamente para `propietario` los comentarios de `ids` que sigan 'pendiente',
+    pasándolos a 'en_proceso' con un arriendo de `duracion_min` minutos.
+    Usa BEGIN IMMEDIATE, por lo que dos procesos nunca obtienen el mismo comentario.
+    Retorna el conjunto de IDs efectivamente reclamados.
+    """
+    ids = list(ids)
+    if not ids:
+        return set()
+
+    marcadores = ",".join("?" for _ in ids)
+    conn_sqlite.execute("BEGIN IMMEDIATE")
     try:
-        cursor = conn_sqlite.cursor()
-        cursor.execute("UPDATE comentarios SET status = ? WHERE id = ?", (status, comment_id))
+        liberar_arriendos_vencidos(conn_sqlite)
+        conn_sqlite.execute(f"""
+            UPDATE comentarios SET status = 'en_proceso', lease_owner = ?, lease_expira = ?
+            WHERE status = 'pendiente' AND id IN ({marcadores})
+        """, (propietario, _vencimiento_arriendo(duracion_min), *ids))
+        reclamados = {fila[0] for fila in conn_sqlite.execute(
+            f"SELECT id FROM comentarios WHERE status = 'en_proceso' AND lease_owner = ? AND id IN ({marcadores})",
+            (propietario, *ids)
+        )}
         conn_sqlite.commit()
-        
-        if cursor.rowcount == 0:
-            logger.warning(f"No se encontró el comentario con ID {comment_id} para actualizar. No se realizaron cambios.")
-        else:
-            logger.info(f"{cursor.rowcount} fila(s) de comentario actualizada(s) a '{status}' en la base de datos.")
-            
     except Exception:
-        logger.exception(f"Error al actualizar el estado para el ID de comentario: {comment_id}")
         conn_sqlite.rollback()
+        raise
+
+    if len(reclamados) < len(ids):
+        logger.info(f"{len(ids) - len(reclamados)} comentario(s) ya reclamado(s) por otro proceso; se omiten.")
+    return reclamados
+
+
+def renovar_arriendos(conn_sqlite, propietario, duracion_min=ARRIENDO_DURACION_MIN):
+    """Extiende el arriendo de todos los comentarios que `propietario` tiene 'en_proceso'."""
+    with conn_sqlite:
+        cursor = conn_sqlite.execute(
+            "UPDATE comentarios SET lease_expira = ? WHERE status = 'en_proceso' AND lease_owner = ?",
+            (_vencimiento_arriendo(duracion_min), propietario)
+        )
+    return cursor.rowcount
+
+
+def liberar_arriendos(conn_sqlite, propietario):
+    """
+    Devuelve a 'pendiente' los comentarios que `propietario` aún tiene 'en_proceso' (los que no se
+    completaron). Debe llamarse después de vaciar el EscritorEstados del proceso.
+    """
+    with conn_sqlite:
+        cursor = conn_sqlite.execute("""
+            UPDATE comentarios SET status = 'pendiente', lease_owner = NULL, lease_expira = NULL
+            WHERE status = 'en_proceso' AND lease_owner = ?
+        """, (propietario,))
+    if cursor.rowcount:
+        logger.info(f"{cursor.rowcount} comentario(s) no completado(s) devuelto(s) a 'pendiente'.")
+    return cursor.rowcount
+
+
+# Peso relativo de capacidad de envío por COMMENT_USED_FOR: por cada comentario 'Report'
+# se envían hasta 3 'Notification'. Los valores no listados usan PRIORIDAD_PESO_OTROS.
+PRIORIDAD_PESOS = {"Notification": 3, "Report": 1}
+PRIORIDAD_PESO_OTROS = 1
+# Protección contra inanición: los pendientes que llevan en cola más que esto se envían antes que el resto.
+PRIORIDAD_ESPERA_MAXIMA_HORAS = 24
+# Inicio de la espera en cola de un pendiente. Una fila que llegó a 'pendiente' sin marcar queued_at
+# cuenta desde su CREATED_DATE, y sin ninguna de las dos fechas se considera la más antigua.
+COLUMNA_INICIO_ESPERA = "COALESCE(queued_at, CREATED_DATE, '')"
+
+
+def _percentil(valores_ordenados, percentil):
+    """Percentil por rango más cercano de una lista ya ordenada."""
+    indice = max(0, -(-len(valores_ordenados) * percentil // 100) - 1)
+    return valores_ordenados[int(indice)]
+
+
+class PlanificadorEnvios:
+    """
+    Ordena los comentarios 'pendiente' por prioridad y reparte la capacidad de envío entre clases.
+
+    - Los pendientes que superan `espera_maxima_horas` en cola forman la clase 'vencido' y se
+      atienden primero, del más antiguo al más nuevo (protección contra inanición).
+    - El resto se agrupa por COMMENT_USED_FOR y se intercala por ronda ponderada según `pesos`;
+      dentro de cada clase se envían primero los de CREATED_DATE más reciente.
+    - Cada clase se lee con paginación keyset, por lo que la memoria no depende del backlog.
+
+    `registrar_envio()` anota la latencia en cola (ahora - COLUMNA_INICIO_ESPERA) de cada comentario enviado
+    y `reportar_latencias()` escribe en el log los percentiles por clase.
+
+    Con `propietario`, cada página se reclama con un arriendo antes de entregarse (ver
+    reclamar_comentarios), así varios procesos de envío se reparten el backlog sin duplicados.
+    El proceso debe llamar a `renovar_arriendo()` mientras trabaja y a `liberar_arriendos()` al terminar.
+    """
+
+    def __init__(self, conn_sqlite, pesos=None, peso_otros=PRIORIDAD_PESO_OTROS,
+                 espera_maxima_horas=PRIORIDAD_ESPERA_MAXIMA_HORAS, propietario=None,
+                 duracion_arriendo_min=ARRIENDO_DURACION_MIN):
+        self.conn_sqlite = conn_sqlite
+        self.propietario = propietario
+        self.duracion_arriendo_min = duracion_arriendo_min
+        self._ultima_renovacion = time.monotonic()
+        self.pesos = dict(PRIORIDAD_PESOS if pesos is None else pesos)
+        self.peso_otros = peso_otros
+        self.umbral_vencido = (datetime.now() - timedelta(hours=espera_maxima_horas)).strftime("%Y-%m-%d %H:%M:%S")
+        self._en_curso = {}
+        self.latencias = {}
+
+    def _condiciones_clases(self):
+        """Retorna [(clase, peso, condición SQL, parámetros)] con clases disjuntas."""
+        no_vencido = f"{COLUMNA_INICIO_ESPERA} >= ?"
+        clases = [
+            (clase, peso, f"{no_vencido} AND COMMENT_USED_FOR = ?", (self.umbral_vencido, clase))
+            for clase, peso in sorted(self.pesos.items(), key=lambda item: -item[1])
+        ]
+        marcadores = ",".join("?" for _ in self.pesos)
+        condicion_otros = f"{no_vencido} AND (COMMENT_USED_FOR IS NULL OR COMMENT_USED_FOR NOT IN ({marcadores}))"
+        clases.append(("otros", self.peso_otros, condicion_otros, (self.umbral_vencido, *self.pesos)))
+        return clases
+
+    def _iterar_clase(self, condicion, parametros, tamano_pagina, vencido=False):
+        """Itera los pendientes de una clase en su orden de prioridad, leyendo por páginas (keyset)."""
+        # 'vencido': más antiguos en cola primero. Resto: CREATED_DATE más reciente primero.
+        if vencido:
+            clave, orden, comparacion = COLUMNA_INICIO_ESPERA, "ASC", ">"
+        else:
+            clave, orden, comparacion = "COALESCE(CREATED_DATE, '')", "DESC", "<"
+        cursor = self.conn_sqlite.cursor()
+        cursor.row_factory = sqlite3.Row
+        ultimo = None
+
+        while True:
+            condicion_keyset = "" if ultimo is None else f"AND ({clave}, id) {comparacion} (?, ?)"
+            cursor.execute(f"""
+                SELECT {COLUMNAS_COMENTARIO_ENVIO}, {COLUMNA_INICIO_ESPERA} AS _QUEUED_AT, {clave} AS _CLAVE
+                FROM comentarios
+                WHERE status = 'pendiente' AND {condicion} {condicion_keyset}
+                ORDER BY {clave} {orden}, id {orden}
+                LIMIT ?
+            """, (*parametros, *(ultimo or ()), tamano_pagina))
+            filas = [dict(row) for row in cursor.fetchall()]
+            if not filas:
+                return
+
+            siguiente = (filas[-1]["_CLAVE"], filas[-1]["ID"])
+            yield from filas
+
+            if len(filas) < tamano_pagina:
+                return
+            ultimo = siguiente
+
+    def paginas(self, tamano_pagina=TAMANO_PAGINA_PENDIENTES):
+        """Itera páginas de comentarios pendientes (listas de diccionarios) en orden de prioridad."""
+        if self.propietario is not None:
+            # Los arriendos vencidos se liberan antes de leer, para que entren en esta misma pasada.
+            with self.conn_sqlite:
+                liberar_arriendos_vencidos(self.conn_sqlite)
+        iteradores = [("vencido", 1, self._iterar_clase(f"{COLUMNA_INICIO_ESPERA} < ?", (self.umbral_vencido,), tamano_pagina, vencido=True))]
+        iteradores += [
+            (clase, peso, self._iterar_clase(condicion, parametros, tamano_pagina))
+            for clase, peso, condicion, parametros in self._condiciones_clases()
+        ]
+
+        pagina, candidatas = [], []
+        while iteradores:
+            # Ronda ponderada: cada clase aporta hasta `peso` comentarios por vuelta. Mientras queden
+            # vencidos, la vuelta termina tras ellos, así que se agotan antes de atender al resto.
+            for clase, peso, iterador in list(iteradores):
+                agotada = False
+                for _ in range(tamano_pagina if clase == "vencido" else peso):
+                    fila = next(iterador, None)
+                    if fila is None:
+                        iteradores.remove((clase, peso, iterador))
+                        agotada = True
+                        break
+                    self._en_curso[fila["ID"]] = (clase, fila.pop("_QUEUED_AT"))
+                    del fila["_CLAVE"]
+                    candidatas.append(fila)
+                    if len(pagina) + len(candidatas) >= tamano_pagina:
+                        pagina += self._reclamar(candidatas)
+                        candidatas = []
+                        if len(pagina) >= tamano_pagina:
+                            yield pagina
+                            pagina = []
+                if clase == "vencido" and not agotada:
+                    break
+
+        pagina += self._reclamar(candidatas)
+        if pagina:
+            yield pagina
+
+    def _reclamar(self, candidatas):
+        """Reclama los comentarios candidatos y retorna solo los que no tomó otro proceso."""
+        if self.propietario is None or not candidatas:
+            return candidatas
+        reclamados = reclamar_comentarios(
+            self.conn_sqlite, [fila["ID"] for fila in candidatas], self.propietario, self.duracion_arriendo_min
+        )
+        self._ultima_renovacion = time.monotonic()
+        for fila in candidatas:
+            if fila["ID"] not in reclamados:
+                self._en_curso.pop(fila["ID"], None)
+        return [fila for fila in candidatas if fila["ID"] in reclamados]
+
+    def renovar_arriendo(self):
+        """Renueva el arriendo de los comentarios reclamados si ya pasó un tercio de su duración."""
+        if self.propietario is None:
+            return
+        if time.monotonic() - self._ultima_renovacion >= self.duracion_arriendo_min * 60 / 3:
+            renovar_arriendos(self.conn_sqlite, self.propietario, self.duracion_arriendo_min)
+            self._ultima_renovacion = time.monotonic()
+
+    def liberar_arriendos(self):
+        """Devuelve a 'pendiente' los comentarios reclamados que no se completaron."""
+        if self.propietario is not None:
+            liberar_arriendos(self.conn_sqlite, self.propietario)
+
+    def registrar_envio(self, comment_id):
+        """Anota la latencia en cola de un comentario enviado con éxito."""
+        clase, queued_at = self._en_curso.pop(comment_id, (None, None))
+        if clase is None or not queued_at:
+            return
+        try:
+            espera = (datetime.now() - datetime.strptime(queued_at[:19], "%Y-%m-%d %H:%M:%S")).total_seconds()
+        except ValueError:
+            # CREATED_DATE (usado si falta queued_at) puede venir en otro formato desde Snowflake.
+            return
+        self.latencias.setdefault(clase, []).append(max(0.0, espera))
+
+    def reportar_latencias(self):
+        """Escribe en el log los percentiles de latencia en cola por clase de prioridad."""
+        if not self.latencias:
+            logger.info("No se enviaron comentarios; no hay latencias en cola que reportar.")
+            return
+        for clase, valores in sorted(self.latencias.items()):
+            valores = sorted(valores)
+            p50, p90, p99 = (_percentil(valores, p) / 60 for p in (50, 90, 99))
+            logger.info(
+                f"Latencia en cola [{clase}]: {len(valores)} enviados, p50={p50:.1f} min, "
+                f"p90={p90:.1f} min, p99={p99:.1f} min, máx={valores[-1] / 60:.1f} min."
+            )
+
+
+def configurar_durabilidad(conn_sqlite, synchronous="FULL"):
+    """
+    Configura el modo de diario WAL y el nivel de sincronización de SQLite.
+    Con 'FULL' cada commit hace fsync, por lo que ante un corte solo se pierde lo que
+    aún no se había vaciado (como máximo una ventana del EscritorEstados). Con 'NORMAL'
+    se hacen menos fsync; una caída del proceso no pierde datos, pero un corte de
+    energía puede revertir las transacciones posteriores al último checkpoint.
+    """
+    synchronous = synchronous.upper()
+    if synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        raise ValueError(f"Nivel de sincronización de SQLite no válido: '{synchronous}'")
+
+    modo_diario = conn_sqlite.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    conn_sqlite.execute(f"PRAGMA synchronous={synchronous}")
+    logger.info(f"SQLite configurado con journal_mode={modo_diario} y synchronous={synchronous}.")
+
+
+def escribir_cambios_estado(conn_sqlite, cambios, propietario=None):
+    """
+    Escribe una lista de cambios (status, comment_id). Los comentarios que pasan a 'exitoso' marcan
+    sus imágenes descargadas como enviadas y registran `images_sent_at`. Con `propietario`, solo se
+    actualizan los comentarios que ese proceso sigue teniendo 'en_proceso'. No hace commit.
+    """
+    ahora = fecha_hora_actual()
+    enviados = [(ahora, comment_id) for status, comment_id in cambios if status == "exitoso"]
+    if propietario is None:
+        conn_sqlite.executemany("UPDATE comentarios SET status = ? WHERE id = ?", cambios)
+    else:
+        conn_sqlite.executemany("""
+            UPDATE comentarios SET status = ?, lease_owner = NULL, lease_expira = NULL
+            WHERE id = ? AND status = 'en_proceso' AND lease_owner = ?
+        """, [(status, comment_id, propietario) for status, comment_id in cambios])
+    conn_sqlite.executemany("""
+        UPDATE download_queue SET sent_at = ?
+        WHERE comment_id = ? AND status = 'descargada' AND sent_at IS NULL
+    """, enviados)
+    conn_sqlite.executemany(
+        "UPDATE comentarios SET images_sent_at = ? WHERE id = ? AND status = 'exitoso'", enviados
+    )
+
+
+class EscritorEstados:
+    """
+    Acumula los cambios de estado de comentarios y los escribe en lote con
+    executemany dentro de una única transacción.
+
+    El búfer se vacía al alcanzar `tamano_lote` cambios, cuando han pasado más de
+    `intervalo` segundos desde el último vaciado y siempre al cerrar. El intervalo se revisa
+    al registrar y en `vaciar_si_vencido()`, que los bucles de envío llaman antes de cada envío
+    para que un envío lento no retenga estados ya confirmados. Usado como
+    context manager, también se vacía si el bloque termina con una excepción.
+    Si un mismo comentario cambia varias veces antes de vaciar, solo se escribe el último estado.
+    Al pasar a 'exitoso', sus imágenes descargadas se marcan como enviadas (`sent_at`) y el comentario
+    registra `images_sent_at`, en la misma transacción.
+    Con `propietario`, solo se actualizan los comentarios que ese proceso sigue teniendo 'en_proceso'
+    (si el arriendo venció o el comentario se modificó mientras tanto, el cambio se descarta).
+    Con `servicio` (ServicioEscritura), cada lote se escribe a través del hilo escritor único en vez
+    de `conn_sqlite`, para compartir la base con otras etapas concurrentes sin bloqueos.
+    """
+
+    def __init__(self, conn_sqlite, tamano_lote=100, intervalo=10.0, propietario=None, servicio=None):
+        self.conn_sqlite = conn_sqlite
+        self.servicio = servicio
+        self.propietario = propietario
+        self.tamano_lote = max(1, tamano_lote)
+        self.intervalo = intervalo
+        self._pendientes = {}
+        self._ultimo_vaciado = time.monotonic()
+        self.total_escritos = 0
+
+    def registrar(self, comment_id, status):
+        """Registra un cambio de estado; vacía el búfer si se cumple el tamaño o el intervalo."""
+        if not comment_id:
+            logger.warning("Se intentó registrar un cambio de estado para un comentario sin ID.")
+            return
+
+        self._pendientes.pop(comment_id, None)
+        self._pendientes[comment_id] = status
+
+        if len(self._pendientes) >= self.tamano_lote:
+            self.vaciar()
+        else:
+            self.vaciar_si_vencido()
+
+    def vaciar_si_vencido(self):
+        """Vacía el búfer si hay cambios pendientes y pasó el intervalo desde el último vaciado."""
+        if self._pendientes and time.monotonic() - self._ultimo_vaciado >= self.intervalo:
+            self.vaciar()
+
+    def vaciar(self):
+        """Escribe todos los cambios acumulados en una sola transacción."""
+        self._ultimo_vaciado = time.monotonic()
+        if not self._pendientes:
+            return
+
+        cambios = [(status, comment_id) for comment_id, status in self._pendientes.items()]
+        try:
+            escribir(self.conn_sqlite, self.servicio, escribir_cambios_estado, cambios, self.propietario)
+        except Exception:
+            logger.exception(f"Error al escribir un lote de {len(cambios)} cambios de estado. Se conservarán en el búfer para el próximo vaciado.")
+            raise
+
+        self._pendientes.clear()
+        self.total_escritos += len(cambios)
+        logger.info(f"Lote de {len(cambios)} cambio(s) de estado escrito en SQLite.")
+
+    def cerrar(self):
+        """Vacía los cambios pendientes. Debe llamarse siempre al terminar."""
+        self.vaciar()
+        logger.info(f"Escritor de estados cerrado. Total de cambios de estado escritos: {self.total_escritos}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.cerrar()
+        except Exception:
+            if exc_type is None:
+                raise
+            logger.exception("No se pudieron escribir los estados pendientes al cerrar tras un error previo.")
+        return False
+
+
+# ============================================================================
+# FUNCIONES DE COLA DE DESCARGAS
+# ============================================================================
+
+def fecha_hora_actual():
+    """Fecha y hora local en el formato de texto usado en las tablas de SQLite."""
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def encolar_descargas(cursor, comment_id, location_urls):
+    """
+    Agrega a la cola una fila 'pendiente' por cada URL del comentario que aún no esté encolada.
+    Las URLs nuevas de un comentario modificado reciben ordinales a continuación de los existentes,
+    así las imágenes ya descargadas conservan su nombre. Retorna la cantidad encolada.
+    """
+    cursor.execute("SELECT url, ordinal FROM download_queue WHERE comment_id = ?", (comment_id,))
+    existentes = dict(cursor.fetchall())
+    siguiente = max(existentes.values(), default=0) + 1
+
+    filas = []
+    for url in parsear_location_urls(location_urls, comment_id):
+        if url in existentes:
+            continue
+        existentes[url] = siguiente
+        filas.append((comment_id, siguiente, url))
+        siguiente += 1
+    cursor.executemany(
+        "INSERT OR IGNORE INTO download_queue (comment_id, ordinal, url) VALUES (?,?,?)", filas
+    )
+    return len(filas)
+
+
+def encolar_comentarios_sin_cola(conn_sqlite):
+    """
+    Encola las URLs de los comentarios que aún no tienen filas en la cola
+    (por ejemplo, los ingresados antes de que existiera `download_queue`).
+    """
+    cursor = conn_sqlite.cursor()
+    cursor.execute("""
+        SELECT c.id, c.LOCATION_URLS, c.status
+        FROM comentarios AS c
+        WHERE c.LOCATION_URLS IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM download_queue AS q WHERE q.comment_id = c.id)
+    """)
+    total = 0
+    for comment_id, location_urls, status in cursor.fetchall():
+        total += encolar_descargas(conn_sqlite.cursor(), comment_id, location_urls)
+        if status == "exitoso":
+            # Sus imágenes ya se enviaron antes de que existiera la cola; no deben re-enviarse.
+            conn_sqlite.execute(
+                "UPDATE download_queue SET sent_at = ? WHERE comment_id = ? AND sent_at IS NULL",
+                (fecha_hora_actual(), comment_id)
+            )
+    conn_sqlite.commit()
+    if total:
+        logger.info(f"Se encolaron {total} URLs de comentarios que no tenían descargas registradas.")
+    return total
+
+
+def _calcular_proximo_intento(intentos):
+    """Retorna la fecha del próximo intento aplicando backoff exponencial según los intentos hechos."""
+    espera = min(DESCARGAS_BACKOFF_BASE_SEG * 2 ** (intentos - 1), DESCARGAS_BACKOFF_MAXIMO_SEG)
+    return (datetime.now() + timedelta(seconds=espera)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _escribir_imagen(ruta, contenido):
+    """Escribe una imagen de forma atómica (archivo temporal + os.replace)."""
+    ruta_tmp = f"{ruta}.tmp"
+    with abrir_para_escribir(ruta_tmp) as f:
+        f.write(contenido)
+    os.replace(ruta_tmp, ruta)
+
+
+def _materializar_desde_cache(entrada, ruta_destino):
+    """Deja en `ruta_destino` el contenido cacheado de la entrada (copiándolo si vive en otra ruta)."""
+    if os.path.normpath(entrada["local_path"]) == os.path.normpath(ruta_destino):
+        return ruta_destino
+    if not (os.path.isfile(ruta_destino) and archivo_coincide(entrada, ruta_destino)):
+        with open(entrada["local_path"], "rb") as f:
+            _escribir_imagen(ruta_destino, f.read())
+    return ruta_destino
+
+
+def descargar_a_archivo(url, comment_id, ordinal, conn_cache=None):
+    """
+    Descarga una URL de la cola a su ruta local usando la caché por URL (download_cache):
+    - Si la URL ya se descargó y su archivo está intacto, se sirve desde disco (copiándolo si
+      hace falta); si la entrada tiene más de CACHE_DESCARGAS_REVALIDAR_HORAS se revalida antes
+      con un GET condicional. Solo si eso falla se abre el navegador.
+    - Un archivo '<ID>_<n>.jpg' existente se reutiliza salvo que la caché indique que pertenece a otra URL.
+    Solo lee SQLite (`conn_cache` puede ser de solo lectura), por lo que puede ejecutarse en procesos
+    de trabajo. Retorna (ruta, error, entrada_cache); la entrada, si no es None, debe guardarse con
+    registrar_resultado_descarga.
+    """
+    ruta_existente = buscar_imagen(comment_id, ordinal)
+    ruta_destino = ruta_existente or ruta_imagen(comment_id, ordinal)
+    entrada = obtener_entrada_cache(conn_cache, url) if conn_cache is not None else None
+
+    try:
+        if entrada and archivo_coincide(entrada):
+            if entrada_vigente(entrada):
+                logger.info(f"Imagen servida desde la caché de descargas: {url}")
+                return _materializar_desde_cache(entrada, ruta_destino), None, None
+
+            estado, contenido, metadatos = revalidar_condicional(entrada)
+            if estado == "no_modificada":
+                logger.info(f"Imagen en caché revalidada sin cambios: {url}")
+                ruta = _materializar_desde_cache(entrada, ruta_destino)
+                return ruta, None, nueva_entrada_cache(url, entrada["local_path"], metadatos, entrada["descargado_at"])
+            if estado == "modificada":
+                _escribir_imagen(ruta_destino, contenido)
+                logger.info(f"Imagen en caché modificada en el origen; actualizada en: {ruta_destino}")
+                return ruta_destino, None, nueva_entrada_cache(url, ruta_destino, metadatos)
+
+        elif ruta_existente:
+            propietaria = url_de_ruta(conn_cache, ruta_existente) if conn_cache is not None else None
+            if propietaria is None or propietaria == normalizar_url(url):
+                logger.info(f"Imagen ya existe, se omite la descarga: {ruta_existente}")
+                entrada_nueva = nueva_entrada_cache(url, ruta_existente) if conn_cache is not None and propietaria is None else None
+                return ruta_existente, None, entrada_nueva
+            logger.warning(f"El archivo {ruta_existente} corresponde a otra URL ({propietaria}); se descargará de nuevo.")
+
+        imagen, metadatos = obtener_imagen_selenium_con_metadatos(url)
+        _escribir_imagen(ruta_destino, imagen)
+        logger.info(f"Imagen descargada y guardada exitosamente en: {ruta_destino}")
+        return ruta_destino, None, nueva_entrada_cache(url, ruta_destino, metadatos)
+    except Exception as e:
+        logger.exception(f"Error al descargar la imagen {ordinal} del comentario ID {comment_id} desde la URL: {url}")
+        return None, f"{type(e).__name__}: {e}", None
+
+
+def registrar_resultado_descarga(conn_sqlite, queue_id, comment_id, ordinal, attempts, ruta, error, entrada_cache=None):
+    """
+    Actualiza la fila de la cola con el resultado de un intento de descarga, aplicando
+    backoff exponencial o marcándola 'fallida' al agotar los intentos. Si se entrega
+    `entrada_cache`, la guarda en la caché de descargas. No hace commit.
+    """
+    intentos = attempts + 1
+    if entrada_cache is not None:
+        guardar_entrada_cache(conn_sqlite, entrada_cache)
+    if error is None:
+        conn_sqlite.execute("""
+            UPDATE download_queue
+            SET status = 'descargada', attempts = ?, next_attempt_at = NULL, last_error = NULL, local_path = ?
+            WHERE id = ?
+        """, (intentos, ruta, queue_id))
+    elif intentos >= DESCARGAS_MAX_INTENTOS:
+        logger.error(f"Descarga de imagen {ordinal} del comentario ID {comment_id} marcada como 'fallida' tras {intentos} intentos.")
+        conn_sqlite.execute("""
+            UPDATE download_queue SET status = 'fallida', attempts = ?, next_attempt_at = NULL, last_error = ?
+            WHERE id = ?
+        """, (intentos, error, queue_id))
+    else:
+        proximo = _calcular_proximo_intento(intentos)
+        logger.warning(f"Descarga de imagen {ordinal} del comentario ID {comment_id} reintentará desde {proximo} (intento {intentos}/{DESCARGAS_MAX_INTENTOS}).")
+        conn_sqlite.execute("""
+            UPDATE download_queue SET attempts = ?, next_attempt_at = ?, last_error = ?
+            WHERE id = ?
+        """, (intentos, proximo, error, queue_id))
+
+
+def descargar_elemento_cola(conn_sqlite, queue_id, comment_id, ordinal, url, attempts, servicio=None):
+    """
+    Descarga una URL de la cola y registra el resultado en su fila (a través de `servicio`, si se
+    entrega). Retorna True si la imagen quedó disponible localmente.
+    """
+    ruta, error, entrada_cache = descargar_a_archivo(url, comment_id, ordinal, conn_sqlite)
+    escribir(conn_sqlite, servicio, registrar_resultado_descarga,
+             queue_id, comment_id, ordinal, attempts, ruta, error, entrada_cache)
+    return error is None
+
+
+def procesar_cola_descargas(conn_sqlite, esperar_reintentos=False, presupuesto=None, servicio=None, contar_items=True):
+    """
+    Drena la cola de descargas: procesa cada fila 'pendiente' cuyo próximo intento ya venció.
+    Si `esperar_reintentos` es True, espera a que venzan los reintentos programados hasta que
+    no queden filas pendientes; si es False, deja los reintentos futuros para la próxima ejecución.
+    Con un `presupuesto` (PresupuestoEjecucion), cada descarga cuenta como elemento y al agotarse
+    no se inician más: las filas restantes quedan 'pendiente' para la próxima ejecución. Con
+    `contar_items=False` las descargas solo respetan el límite de tiempo y no consumen --max-items.
+    Con `servicio` (ServicioEscritura), los resultados se escriben a través del hilo escritor único.
+    Retorna un diccionario con la cantidad de descargas exitosas y fallidas de esta pasada.
+    """
+    os.makedirs(CARPETA_IMAGENES, exist_ok=True)
+    resumen = {"descargadas": 0, "fallidas": 0}
+    cursor = conn_sqlite.cursor()
+
+    while True:
+        cursor.execute("""
+            SELECT id, comment_id, ordinal, url, attempts
+            FROM download_queue
+            WHERE status = 'pendiente' AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+            ORDER BY id
+        """, (fecha_hora_actual(),))
+        vencidas = cursor.fetchall()
+
+        for i, (queue_id, comment_id, ordinal, url, attempts) in enumerate(vencidas, start=1):
+            if presupuesto is not None and not (presupuesto.iniciar_item() if contar_items else presupuesto.continuar()):
+                break
+            logger.info(f"Procesando descarga {i}/{len(vencidas)}: imagen {ordinal} del comentario ID {comment_id}...")
+            if descargar_elemento_cola(conn_sqlite, queue_id, comment_id, ordinal, url, attempts, servicio):
+                resumen["descargadas"] += 1
+            else:
+                resumen["fallidas"] += 1
+
+        if not esperar_reintentos or (presupuesto is not None and presupuesto.agotado):
+            break
+
+        cursor.execute("SELECT MIN(next_attempt_at) FROM download_queue WHERE status = 'pendiente'")
+        proximo = cursor.fetchone()[0]
+        if proximo is None:
+            if not vencidas:
+                break
+            continue
+
+        espera = (datetime.strptime(proximo, "%Y-%m-%d %H:%M:%S") - datetime.now()).total_seconds()
+        restante = presupuesto.restante() if presupuesto is not None else None
+        if restante is not None and espera > restante:
+            logger.info(f"El próximo reintento de la cola vence en {int(espera)} s, después del límite de la ejecución. Se deja para la próxima.")
+            break
+        if espera > 0:
+            logger.info(f"Esperando {int(espera)} s hasta el próximo reintento programado de la cola de descargas...")
+            time.sleep(espera)
+
+    logger.info(f"Cola de descargas procesada. Descargadas: {resumen['descargadas']}, intentos fallidos: {resumen['fallidas']}.")
+    return resumen
+
+
+def get_imagenes_enviadas(conn_sqlite, comment_id):
+    """
+    Retorna los nombres de archivo de las imágenes del comentario que ya se enviaron al endpoint,
+    para que un comentario re-marcado como 'pendiente' solo re-envíe sus imágenes nuevas.
+    """
+    cursor = conn_sqlite.cursor()
+    cursor.execute(
+        "SELECT local_path FROM download_queue WHERE comment_id = ? AND sent_at IS NOT NULL AND local_path IS NOT NULL",
+        (comment_id,)
+    )
+    return {os.path.basename(ruta) for (ruta,) in cursor.fetchall()}
+
+
+def _escribir_imagenes_enviadas(conn_sqlite, filas):
+    """Escribe las filas (sent_at, comment_id, local_path) de imágenes enviadas. No hace commit."""
+    conn_sqlite.executemany("UPDATE download_queue SET sent_at = ? WHERE comment_id = ? AND local_path = ?", filas)
+
+
+def registrar_imagenes_enviadas(conn_sqlite, comment_id, nombres, servicio=None):
+    """
+    Marca como enviadas (`sent_at`) las imágenes indicadas por nombre de archivo de un comentario
+    que no quedó completo, para que el siguiente intento solo envíe las que faltan. Confirma la
+    escritura (a través de `servicio`, si se entrega).
+    """
+    nombres = set(nombres)
+    cursor = conn_sqlite.execute(
+        "SELECT local_path FROM download_queue WHERE comment_id = ? AND sent_at IS NULL AND local_path IS NOT NULL",
+        (comment_id,)
+    )
+    rutas = [ruta for (ruta,) in cursor.fetchall() if os.path.basename(ruta) in nombres]
+    if rutas:
+        ahora = fecha_hora_actual()
+        escribir(conn_sqlite, servicio, _escribir_imagenes_enviadas, [(ahora, comment_id, ruta) for ruta in rutas])
+
+
+def resumen_cola_descargas(conn_sqlite):
+    """Retorna un diccionario con la cantidad de filas de la cola por estado."""
+    cursor = conn_sqlite.cursor()
+    cursor.execute("SELECT status, COUNT(*) FROM download_queue GROUP BY status")
+    return dict(cursor.fetchall())
 
 
 # ============================================================================
@@ -327,6 +1171,14 @@ def extraer_datos_comentario(row):
     }
 
 
+def generar_huella_comentario(datos):
+    """
+    Genera la huella del contenido completo de un comentario extraído.
+    A diferencia del MD5 (que solo usa activity_id y OT), cambia si cambia cualquier columna.
+    """
+    return generar_md5(*(datos[campo] for campo in sorted(datos)))
+
+
 def preparar_datos_insercion(datos):
     """Prepara los datos para inserción en SQLite. Retorna: (tupla_para_insert, firma_md5)"""
     firma = generar_md5(datos['activity_id'], datos['OT'])
@@ -335,7 +1187,7 @@ def preparar_datos_insercion(datos):
         datos['role_name'], datos['work_sequence_name'], datos['element_step'],
         datos['element_instance_name'], datos['suffix'], datos['comment_title'],
         datos['comment_description'], datos['location_urls'], datos['comment_used_for'],
-        datos['created_date'], firma, datos["activity_name"] 
+        datos['created_date'], firma, datos["activity_name"], generar_huella_comentario(datos)
     ), firma
 
 def crear_json_temporal(comentarios_nuevos):
@@ -361,20 +1213,24 @@ def crear_json_temporal(comentarios_nuevos):
 # FUNCIÓN PRINCIPAL: CREAR ÓRDENES DE TRABAJO
 # ============================================================================
 
-def crear_ot(session, query_inicio, conn_sqlite):
-    """Obtiene las OTs desde Snowflake y las guarda en SQLite."""
+def crear_ot(session, query_inicio, conn_sqlite, filas=None):
+    """
+    Obtiene las OTs desde Snowflake y las guarda en SQLite.
+    Si se entregan `filas` (resultado ya obtenido de la query, p. ej. de forma asíncrona), no se ejecuta la query.
+    """
     logger.info("Iniciando subproceso: Sincronización de Órdenes de Trabajo (OTs).")
     try:
         cursor = conn_sqlite.cursor()
         crear_tabla_ot(cursor)
         
-        logger.info("Ejecutando query de OTs en Snowflake...")
-        ot = session.sql(query_inicio)
-        rows = ot.collect()
-        logger.info(f"Query ejecutada. {len(rows)} OTs recibidas de Snowflake.")
+        if filas is None:
+            logger.info("Ejecutando query de OTs en Snowflake...")
+            ot = session.sql(query_inicio)
+            filas = ot.collect()
+        logger.info(f"Query ejecutada. {len(filas)} OTs recibidas de Snowflake.")
         
         cont = 0
-        for row in rows:
+        for row in filas:
             if insertar_ot(conn_sqlite, cursor, row["ACTIVITY_ID"], row["OT"]):
                 cont += 1
         
@@ -384,79 +1240,219 @@ def crear_ot(session, query_inicio, conn_sqlite):
         logger.exception("Error crítico en el proceso 'crear_ot'.")
 
 
+def crear_ot_desde_comentarios(conn_sqlite, filas_comentarios):
+    """
+    Deriva las OTs (ACTIVITY_ID, OT) de la extracción de comentarios y las guarda en SQLite,
+    sin ejecutar QUERY_OT. Solo incluye las OTs que tienen al menos un comentario extraído.
+    """
+    logger.info("Iniciando subproceso: Sincronización de OTs derivadas de la extracción de comentarios.")
+    try:
+        cursor = conn_sqlite.cursor()
+        crear_tabla_ot(cursor)
+
+        pares = dict.fromkeys((row["ACTIVITY_ID"], row["OT"]) for row in filas_comentarios)
+        cont = 0
+        for activity_id, ot in pares:
+            if insertar_ot(conn_sqlite, cursor, activity_id, ot):
+                cont += 1
+
+        logger.info(f"Sincronización de OTs finalizada. {len(pares)} OTs distintas en los comentarios, {cont} nuevas guardadas.")
+
+    except Exception:
+        logger.exception("Error crítico en el proceso 'crear_ot_desde_comentarios'.")
+
+
+# ============================================================================
+# FUNCIONES DE EXTRACCIÓN CONCURRENTE
+# ============================================================================
+
+# Cada cuánto se consulta a Snowflake si terminaron las queries enviadas de forma asíncrona.
+INTERVALO_SONDEO_QUERIES_SEG = 1.0
+
+
+def ejecutar_queries_concurrentes(session, consultas, intervalo=INTERVALO_SONDEO_QUERIES_SEG):
+    """
+    Envía todas las queries de `consultas` ({nombre: query}) a la vez como trabajos asíncronos de
+    Snowpark (collect_nowait) y entrega (nombre, filas) a medida que cada una termina.
+    Si una query falla se registra en el log y se entrega (nombre, None), sin afectar a las demás.
+    """
+    trabajos = {}
+    for nombre, query in consultas.items():
+        logger.info(f"Enviando query '{nombre}' a Snowflake de forma asíncrona...")
+        try:
+            trabajos[nombre] = (session.sql(query).collect_nowait(), time.monotonic())
+        except Exception:
+            logger.exception(f"No se pudo enviar la query '{nombre}' a Snowflake.")
+            yield nombre, None
+
+    while trabajos:
+        terminados = [nombre for nombre, (trabajo, _) in trabajos.items() if trabajo.is_done()]
+        if not terminados:
+            time.sleep(intervalo)
+            continue
+        for nombre in terminados:
+            trabajo, inicio = trabajos.pop(nombre)
+            try:
+                filas = trabajo.result()
+            except Exception:
+                logger.exception(f"La query asíncrona '{nombre}' falló en Snowflake.")
+                filas = None
+            else:
+                logger.info(f"Query '{nombre}' completada en {time.monotonic() - inicio:.1f} s con {len(filas)} filas.")
+            yield nombre, filas
+
+
 # ============================================================================
 # FUNCIÓN PRINCIPAL: CREAR COMENTARIOS
 # ============================================================================
 
-def crear_comentarios_historico(session, query, conn_sqlite):
-    """Procesa comentarios en modo HISTÓRICO: guarda en SQLite y descarga imágenes."""
-    cont_nuevos = 0
+def cargar_huellas_comentarios(cursor):
+    """
+    Retorna un diccionario {id: FINGERPRINT} con todos los comentarios ya guardados en SQLite,
+    incluidos los archivados (lápidas en comentarios_archivados).
+    """
+    cursor.execute("""
+        SELECT id, FINGERPRINT FROM comentarios_archivados
+        UNION ALL
+        SELECT id, FINGERPRINT FROM comentarios
+    """)
+    return dict(cursor.fetchall())
+
+
+def sincronizar_comentario(conn_sqlite, cursor, datos, huellas):
+    """
+    Compara la huella de un comentario extraído con la almacenada y aplica solo el cambio necesario:
+    - 'nuevo': no existía; se inserta y se encolan sus imágenes.
+    - 'modificado': la huella cambió; se actualiza, vuelve a 'pendiente' y se encolan solo sus URLs nuevas.
+    - 'adoptado': fila antigua sin huella; se guarda la huella sin marcarla para re-envío.
+    - 'sin_cambios': la huella coincide; no se hace nada.
+    Retorna (resultado, cantidad_de_urls_encoladas). `huellas` se actualiza en el lugar.
+    """
+    comment_id = datos['comment_id']
+    datos_insercion, _ = preparar_datos_insercion(datos)
+    huella = datos_insercion[-1]
+
+    if comment_id not in huellas:
+        insertar_comentario(conn_sqlite, cursor, datos_insercion)
+        resultado = "nuevo"
+    elif huellas[comment_id] == huella:
+        return "sin_cambios", 0
+    elif huellas[comment_id] is None:
+        cursor.execute("UPDATE comentarios SET FINGERPRINT = ? WHERE id = ?", (huella, comment_id))
+        conn_sqlite.commit()
+        huellas[comment_id] = huella
+        return "adoptado", 0
+    else:
+        actualizar_comentario(cursor, datos_insercion)
+        resultado = "modificado"
+        if cursor.rowcount == 0:
+            # Estaba archivado: cambió en Snowflake, así que vuelve a la base activa con su cola de
+            # descargas y se actualiza como cualquier modificación (solo se envían sus URLs nuevas).
+            if reingresar_archivado(conn_sqlite, comment_id):
+                actualizar_comentario(cursor, datos_insercion)
+            else:
+                cursor.execute("DELETE FROM comentarios_archivados WHERE id = ?", (comment_id,))
+                insertar_comentario(conn_sqlite, cursor, datos_insercion)
+            logger.info(f"Comentario archivado modificado en Snowflake; reingresado como 'pendiente': ID={comment_id}")
+
+    huellas[comment_id] = huella
+    encoladas = encolar_descargas(cursor, comment_id, datos['location_urls'])
+    if encoladas and resultado == "modificado":
+        # Hay imágenes nuevas que entregar; las ya enviadas se omiten gracias a download_queue.sent_at.
+        cursor.execute("UPDATE comentarios SET images_sent_at = NULL WHERE id = ?", (comment_id,))
+    conn_sqlite.commit()
+    return resultado, encoladas
+
+
+def _registrar_resumen_sincronizacion(contadores, modo):
+    """Escribe en el log el resumen de una sincronización de comentarios."""
+    logger.info(
+        f"Sincronización de comentarios en modo {modo}: {contadores['nuevo']} nuevos, "
+        f"{contadores['modificado']} modificados (re-marcados 'pendiente'), "
+        f"{contadores['sin_cambios']} sin cambios, {contadores['adoptado']} con huella inicializada."
+    )
+
+
+def crear_comentarios_historico(session, query, conn_sqlite, descargar=True, filas=None):
+    """
+    Procesa comentarios en modo HISTÓRICO: guarda nuevos y modificados en SQLite y descarga imágenes.
+    Con `descargar=False` solo encola las imágenes (el backfill paralelo las descarga después).
+    Si se entregan `filas` (resultado ya obtenido de la query), no se ejecuta la query.
+    """
+    contadores = Counter()
     cont_imagenes_total = 0
     try:
-        os.makedirs("carpeta_imagenes", exist_ok=True)
+        os.makedirs(CARPETA_IMAGENES, exist_ok=True)
         cursor = conn_sqlite.cursor()
         crear_tabla_comentarios(cursor)
+        crear_tabla_download_queue(cursor)
 
-        logger.info("Ejecutando query de comentarios en Snowflake...")
-        comments = session.sql(query)
-        rows_comments = comments.collect()
+        if filas is None:
+            logger.info("Ejecutando query de comentarios en Snowflake...")
+            comments = session.sql(query)
+            filas = comments.collect()
+        rows_comments = filas
         logger.info(f"Query ejecutada. {len(rows_comments)} comentarios recibidos de Snowflake.")
+        huellas = cargar_huellas_comentarios(cursor)
         
         for i, row in enumerate(rows_comments):
             datos = extraer_datos_comentario(row)
             comment_id = datos['comment_id']
             logger.debug(f"Procesando comentario {i+1}/{len(rows_comments)} - ID: {comment_id}")
 
-            if comentario_existe(cursor, comment_id):
-                logger.debug(f"Comentario ID {comment_id} ya existe en SQLite, se omite.")
-                continue
-            
-            datos_insercion, _ = preparar_datos_insercion(datos)
             try:
-                insertar_comentario(conn_sqlite, cursor, datos_insercion)
-                cont_nuevos += 1
-                cont_imagenes_total += procesar_imagenes_historico(datos['location_urls'], comment_id)
+                resultado, encoladas = sincronizar_comentario(conn_sqlite, cursor, datos, huellas)
+                contadores[resultado] += 1
+                cont_imagenes_total += encoladas
             except sqlite3.IntegrityError:
                 # Ya logueado en insertar_comentario, no es necesario hacer más.
                 pass
         
-        logger.info(f"Total de comentarios nuevos guardados en modo histórico: {cont_nuevos}")
-        logger.info(f"Total de imágenes descargadas en modo histórico: {cont_imagenes_total}")
+        _registrar_resumen_sincronizacion(contadores, "histórico")
+        logger.info(f"Total de imágenes encoladas en modo histórico: {cont_imagenes_total}")
+        if descargar:
+            resumen = procesar_cola_descargas(conn_sqlite)
+            logger.info(f"Total de imágenes descargadas en modo histórico: {resumen['descargadas']}")
 
     except Exception:
         logger.exception("Error crítico en 'crear_comentarios_historico'.")
 
 
-def crear_comentarios_temp(session, query, conn_sqlite):
-    """Procesa comentarios en modo TEMPORAL: guarda nuevos y descarga sus imágenes."""
+def crear_comentarios_temp(session, query, conn_sqlite, filas=None, presupuesto=None, servicio=None):
+    """
+    Procesa comentarios en modo TEMPORAL: guarda nuevos y modificados y descarga sus imágenes.
+    Si se entregan `filas` (resultado ya obtenido de la query), no se ejecuta la query.
+    Las descargas respetan el límite de tiempo del `presupuesto` de la ejecución (--max-items solo
+    cuenta los envíos) y escriben sus resultados a través de `servicio` (ServicioEscritura), si se entregan.
+    """
     comentarios_nuevos_para_envio = []
-    cont_nuevos_guardados = 0
+    contadores = Counter()
     try:
-        os.makedirs("carpeta_imagenes", exist_ok=True)
+        os.makedirs(CARPETA_IMAGENES, exist_ok=True)
         cursor = conn_sqlite.cursor()
         crear_tabla_comentarios(cursor)
+        crear_tabla_download_queue(cursor)
 
-        logger.info("Ejecutando query de comentarios en Snowflake...")
-        comments = session.sql(query)
-        rows_comments = comments.collect()
+        if filas is None:
+            logger.info("Ejecutando query de comentarios en Snowflake...")
+            comments = session.sql(query)
+            filas = comments.collect()
+        rows_comments = filas
         logger.info(f"Query ejecutada. {len(rows_comments)} comentarios recibidos de Snowflake.")
+        huellas = cargar_huellas_comentarios(cursor)
 
         for row in rows_comments:
             datos = extraer_datos_comentario(row)
             comment_id = datos['comment_id']
             logger.debug(f"Procesando comentario ID: {comment_id}")
 
-            if comentario_existe(cursor, comment_id):
-                logger.debug(f"Comentario ID {comment_id} ya existe en SQLite, se omite.")
-                continue
-            
-            datos_insercion, firma = preparar_datos_insercion(datos)
             try:
-                insertar_comentario(conn_sqlite, cursor, datos_insercion)
-                cont_nuevos_guardados += 1
-                logger.info(f"Nuevo comentario ID {comment_id} guardado, procesando imágenes...")
-                procesar_imagenes_historico(datos['location_urls'], comment_id)
+                resultado, _ = sincronizar_comentario(conn_sqlite, cursor, datos, huellas)
+                contadores[resultado] += 1
+                if resultado not in ("nuevo", "modificado"):
+                    continue
                 
+                _, firma = preparar_datos_insercion(datos)
                 if not ot_existe(cursor, firma):
                     insertar_ot(conn_sqlite, cursor, datos['activity_id'], datos['OT'])
                 
@@ -475,8 +1471,9 @@ def crear_comentarios_temp(session, query, conn_sqlite):
                 # Ya logueado en insertar_comentario.
                 pass
         
-        if cont_nuevos_guardados > 0:
-            logger.info(f"Total de comentarios nuevos guardados en modo temp: {cont_nuevos_guardados}")
+        _registrar_resumen_sincronizacion(contadores, "temp")
+        
+        procesar_cola_descargas(conn_sqlite, presupuesto=presupuesto, servicio=servicio, contar_items=False)
         
         return comentarios_nuevos_para_envio
 
@@ -485,14 +1482,14 @@ def crear_comentarios_temp(session, query, conn_sqlite):
         return []
 
 
-def crear_comentarios(session, query, conn_sqlite, parametro):
+def crear_comentarios(session, query, conn_sqlite, parametro, filas=None, presupuesto=None, servicio=None):
     """Función dispatcher que llama al modo correcto según el parámetro."""
     logger.info(f"Iniciando subproceso: Sincronización de Comentarios en modo '{parametro.upper()}'.")
     if parametro == "historico":
-        crear_comentarios_historico(session, query, conn_sqlite)
+        crear_comentarios_historico(session, query, conn_sqlite, filas=filas)
         return None
     elif parametro == "temp":
-        return crear_comentarios_temp(session, query, conn_sqlite)
+        return crear_comentarios_temp(session, query, conn_sqlite, filas=filas, presupuesto=presupuesto, servicio=servicio)
     else:
         # Este error no debería ocurrir si se valida en main.py, pero es una salvaguarda.
         msg = f"Parámetro de modo de creación de comentarios no reconocido: '{parametro}'"
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures comunes de las pruebas: una base SQLite temporal con el esquema completo y un
+ayudante para insertar comentarios con los valores mínimos
+"""
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snowflake_servicios import asegurar_esquema, insertar_comentario
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """Ruta de una base SQLite temporal con el esquema completo; el directorio de trabajo es tmp_path."""
+    monkeypatch.chdir(tmp_path)
+    ruta = str(tmp_path / "BDD_SNOWFLAKE.db")
+    conn = sqlite3.connect(ruta)
+    conn.execute("PRAGMA journal_mode = WAL")
+    asegurar_esquema(conn)
+    conn.close()
+    return ruta
+
+
+@pytest.fixture
+def conn(db_path):
+    """Conexión a la base temporal, cerrada al terminar la prueba."""
+    conexion = sqlite3.connect(db_path)
+    yield conexion
+    conexion.close()
+
+
+def agregar_comentario(conn, comment_id, activity_id=1, usado_para="observacion", creado="2024-01-01 00:00:00",
+                       urls=None, huella=None):
+    """Inserta un comentario 'pendiente' con los datos mínimos y lo confirma."""
+    insertar_comentario(conn, conn.cursor(), (
+        comment_id, activity_id, f"OT-{activity_id}", "rol", "secuencia", 1, "elemento", "", "titulo",
+        "descripcion", urls, usado_para, creado, f"md5-{comment_id}", "actividad", huella or f"huella-{comment_id}"
+    ))
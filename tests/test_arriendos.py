@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de los arriendos con que varios procesos de envío se reparten los pendientes."""
+import sqlite3
+import threading
+
+from snowflake_servicios import reclamar_comentarios, liberar_arriendos, renovar_arriendos
+
+from conftest import agregar_comentario
+
+
+def test_reclamos_concurrentes_no_se_solapan(conn, db_path):
+    ids = list(range(1, 201))
+    for comment_id in ids:
+        agregar_comentario(conn, comment_id)
+
+    propietarios = [f"proceso-{i}" for i in range(4)]
+    barrera = threading.Barrier(len(propietarios))
+    reclamados = {}
+    errores = []
+
+    def reclamar(propietario):
+        conexion = sqlite3.connect(db_path, timeout=30)
+        try:
+            barrera.wait()
+            # Cada proceso intenta tomar todos los IDs, en páginas de 20 y en un orden distinto.
+            orden = ids[propietarios.index(propietario) * 50:] + ids[:propietarios.index(propietario) * 50]
+            obtenidos = set()
+            for inicio in range(0, len(orden), 20):
+                obtenidos |= reclamar_comentarios(conexion, orden[inicio:inicio + 20], propietario)
+            reclamados[propietario] = obtenidos
+        except Exception as e:
+            errores.append(e)
+        finally:
+            conexion.close()
+
+    hilos = [threading.Thread(target=reclamar, args=(propietario,)) for propietario in propietarios]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    assert not errores
+    todos = [comment_id for obtenidos in reclamados.values() for comment_id in obtenidos]
+    assert sorted(todos) == ids
+    duenos = dict(conn.execute("SELECT id, lease_owner FROM comentarios WHERE status = 'en_proceso'"))
+    assert all(duenos[comment_id] == propietario for propietario, obtenidos in reclamados.items() for comment_id in obtenidos)
+
+
+def test_arriendo_vencido_se_puede_reclamar(conn):
+    agregar_comentario(conn, 1)
+    assert reclamar_comentarios(conn, [1], "muerto", duracion_min=-1) == {1}
+    assert reclamar_comentarios(conn, [1], "vivo") == {1}
+    assert conn.execute("SELECT lease_owner FROM comentarios WHERE id = 1").fetchone()[0] == "vivo"
+
+
+def test_arriendo_vigente_no_se_puede_reclamar_y_se_libera(conn):
+    agregar_comentario(conn, 1)
+    agregar_comentario(conn, 2)
+    assert reclamar_comentarios(conn, [1, 2], "a") == {1, 2}
+    assert reclamar_comentarios(conn, [1, 2], "b") == set()
+    assert renovar_arriendos(conn, "a") == 2
+
+    conn.execute("UPDATE comentarios SET status = 'exitoso', lease_owner = NULL, lease_expira = NULL WHERE id = 1")
+    conn.commit()
+    assert liberar_arriendos(conn, "a") == 1
+    assert conn.execute("SELECT status, lease_owner FROM comentarios WHERE id = 2").fetchone() == ("pendiente", None)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Pruebas del servicio de escritura única en SQLite."""
+import sqlite3
+import threading
+
+import pytest
+
+from escritor_sqlite_servicios import ServicioEscritura, escribir
+
+
+def _insertar(conn, valor):
+    conn.execute("INSERT INTO datos (valor) VALUES (?)", (valor,))
+    return valor
+
+
+def _fallar(conn, valor):
+    conn.execute("INSERT INTO datos (valor) VALUES (?)", (valor,))
+    raise ValueError("falla a propósito")
+
+
+@pytest.fixture
+def db_datos(tmp_path):
+    ruta = str(tmp_path / "datos.db")
+    conn = sqlite3.connect(ruta)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("CREATE TABLE datos (valor INTEGER UNIQUE)")
+    conn.commit()
+    conn.close()
+    return ruta
+
+
+def _valores(ruta):
+    conn = sqlite3.connect(ruta)
+    try:
+        return sorted(fila[0] for fila in conn.execute("SELECT valor FROM datos"))
+    finally:
+        conn.close()
+
+
+def test_comando_fallido_solo_deshace_lo_suyo(db_datos):
+    # Un intervalo largo asegura que los cuatro comandos queden en la misma transacción.
+    with ServicioEscritura(db_datos, intervalo=1.0) as servicio:
+        futuros = [
+            servicio.enviar(_insertar, 1),
+            servicio.enviar(_fallar, 2),
+            servicio.enviar(_insertar, 1),  # viola UNIQUE
+            servicio.enviar(_insertar, 3),
+        ]
+        servicio.vaciar()
+
+    assert futuros[0].result() == 1
+    with pytest.raises(ValueError):
+        futuros[1].result()
+    with pytest.raises(sqlite3.IntegrityError):
+        futuros[2].result()
+    assert futuros[3].result() == 3
+    assert servicio.total_transacciones == 1
+    assert _valores(db_datos) == [1, 3]
+
+
+def test_varios_hilos_escriben_sin_perder_comandos(db_datos):
+    with ServicioEscritura(db_datos, tamano_lote=25) as servicio:
+        def enviar(base):
+            for valor in range(base, base + 100):
+                servicio.enviar(_insertar, valor)
+
+        hilos = [threading.Thread(target=enviar, args=(base,)) for base in range(0, 400, 100)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+
+    assert _valores(db_datos) == list(range(400))
+    assert servicio.total_comandos == 400
+
+
+def test_escribir_con_transaccion_abierta_no_se_bloquea(db_datos):
+    conn = sqlite3.connect(db_datos, timeout=1)
+    try:
+        conn.execute("INSERT INTO datos (valor) VALUES (10)")
+        assert conn.in_transaction
+        with ServicioEscritura(db_datos, timeout=1) as servicio:
+            assert escribir(conn, servicio, _insertar, 11) == 11
+        assert escribir(conn, None, _insertar, 12) == 12
+    finally:
+        conn.close()
+    assert _valores(db_datos) == [10, 11, 12]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Pruebas del cursor de la exportación incremental frente al archivado y la restauración."""
+import json
+import os
+
+import carga_servicios
+from carga_servicios import exportar_delta
+from retencion_servicios import archivar_entregados, restaurar_comentarios
+
+from conftest import agregar_comentario
+
+
+def _exportar(tmp_path, consumidor="bi"):
+    """Ejecuta una exportación y retorna los ids de comentarios exportados."""
+    ruta_manifiesto = exportar_delta(consumidor, carpeta=str(tmp_path / "exportaciones"))
+    with open(ruta_manifiesto, encoding="utf-8") as f:
+        manifiesto = json.load(f)
+    ids = []
+    for archivo in manifiesto["archivos"]:
+        if archivo["tabla"] != "comentarios":
+            continue
+        with open(os.path.join(os.path.dirname(ruta_manifiesto), archivo["archivo"]), encoding="utf-8") as f:
+            ids.extend(json.loads(linea)["id"] for linea in f)
+    return sorted(ids)
+
+
+def _marcar_entregados(conn, ids):
+    conn.executemany("""
+        UPDATE comentarios SET status = 'exitoso', data_sent_at = '2000-01-01 00:00:00',
+            images_sent_at = '2000-01-01 00:00:00'
+        WHERE id = ?
+    """, [(comment_id,) for comment_id in ids])
+    conn.commit()
+
+
+def test_cursor_avanza_y_no_repite(conn, db_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(carga_servicios, "DB_PATH", db_path)
+    agregar_comentario(conn, 1)
+    agregar_comentario(conn, 2)
+
+    assert _exportar(tmp_path) == [1, 2]
+    assert _exportar(tmp_path) == []
+
+    conn.execute("UPDATE comentarios SET status = 'exitoso' WHERE id = 2")
+    conn.commit()
+    assert _exportar(tmp_path) == [2]
+
+
+def test_archivar_insertar_y_restaurar_se_exportan(conn, db_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(carga_servicios, "DB_PATH", db_path)
+    for comment_id in (1, 2, 3):
+        agregar_comentario(conn, comment_id)
+    # Las filas entregadas son las de secuencia más alta: al archivarlas, MAX(change_seq) retrocede.
+    _marcar_entregados(conn, [2, 3])
+    assert _exportar(tmp_path) == [1, 2, 3]
+
+    archivar_entregados(conn, dias=1, carpeta_imagenes=str(tmp_path / "imagenes"),
+                        carpeta_archivo=str(tmp_path / "archivo"), db_archivo=str(tmp_path / "archivo.db"))
+    assert [fila[0] for fila in conn.execute("SELECT id FROM comentarios")] == [1]
+
+    agregar_comentario(conn, 4)
+    assert _exportar(tmp_path) == [4]
+
+    assert restaurar_comentarios(conn, [2, 3], carpeta_imagenes=str(tmp_path / "imagenes"),
+                                 db_archivo=str(tmp_path / "archivo.db")) == 2
+    assert _exportar(tmp_path) == [2, 3]
+
+    ultimo = conn.execute("SELECT ultimo FROM secuencia_cambios").fetchone()[0]
+    assert ultimo == conn.execute("SELECT MAX(change_seq) FROM comentarios").fetchone()[0]
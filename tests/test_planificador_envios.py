@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Pruebas del orden de envío de PlanificadorEnvios."""
+from datetime import datetime, timedelta
+
+from snowflake_servicios import PlanificadorEnvios
+
+from conftest import agregar_comentario
+
+
+def _hace(horas):
+    return (datetime.now() - timedelta(hours=horas)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _orden(conn, tamano_pagina=100, **kwargs):
+    planificador = PlanificadorEnvios(conn, **kwargs)
+    return [fila["ID"] for pagina in planificador.paginas(tamano_pagina) for fila in pagina]
+
+
+def test_ronda_ponderada_y_mas_recientes_primero(conn):
+    for comment_id in range(1, 7):
+        agregar_comentario(conn, comment_id, usado_para="Notification", creado=f"2024-01-0{comment_id} 00:00:00")
+    for comment_id in (11, 12):
+        agregar_comentario(conn, comment_id, usado_para="Report", creado=f"2024-01-0{comment_id - 10} 00:00:00")
+    agregar_comentario(conn, 21, usado_para="Otro")
+
+    assert _orden(conn) == [6, 5, 4, 12, 21, 3, 2, 1, 11]
+
+
+def test_vencidos_primero_del_mas_antiguo(conn):
+    agregar_comentario(conn, 1, usado_para="Notification")
+    agregar_comentario(conn, 2, usado_para="Report")
+    agregar_comentario(conn, 3, usado_para="Report")
+    conn.execute("UPDATE comentarios SET queued_at = ? WHERE id = 2", (_hace(30),))
+    conn.execute("UPDATE comentarios SET queued_at = ? WHERE id = 3", (_hace(48),))
+    conn.commit()
+
+    assert _orden(conn, espera_maxima_horas=24) == [3, 2, 1]
+
+
+def test_pendientes_sin_queued_at_no_se_omiten(conn):
+    agregar_comentario(conn, 1, usado_para="Notification", creado=_hace(1))
+    agregar_comentario(conn, 2, usado_para="Notification", creado=_hace(72))
+    agregar_comentario(conn, 3, usado_para="Report", creado=None)
+    conn.execute("UPDATE comentarios SET queued_at = NULL")
+    conn.commit()
+
+    # Sin queued_at la espera cuenta desde CREATED_DATE; sin ninguna fecha, es la más antigua.
+    assert _orden(conn, espera_maxima_horas=24) == [3, 2, 1]
+
+
+def test_paginas_respetan_el_tamano(conn):
+    for comment_id in range(1, 8):
+        agregar_comentario(conn, comment_id)
+    planificador = PlanificadorEnvios(conn)
+    assert [len(pagina) for pagina in planificador.paginas(3)] == [3, 3, 1]
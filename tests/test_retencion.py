@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Pruebas del archivado y del reingreso de un comentario archivado que cambió en Snowflake."""
+import os
+
+from imagenes_servicios import ruta_imagen
+from retencion_servicios import archivar_entregados, adjuntar_base_archivo
+from snowflake_servicios import cargar_huellas_comentarios, sincronizar_comentario, get_imagenes_enviadas
+
+
+def _datos(comment_id, urls, descripcion="descripcion"):
+    return {
+        'comment_id': comment_id, 'activity_id': 1, 'OT': "OT-1", 'role_name': "rol",
+        'work_sequence_name': "secuencia", 'element_step': 1, 'element_instance_name': "elemento",
+        'suffix': "", 'comment_title': "titulo", 'comment_description': descripcion,
+        'location_urls': repr(urls), 'comment_used_for': "observacion",
+        'created_date': "2024-01-01 00:00:00", 'activity_name': "actividad"
+    }
+
+
+def _sincronizar(conn, datos):
+    cursor = conn.cursor()
+    return sincronizar_comentario(conn, cursor, datos, cargar_huellas_comentarios(cursor))
+
+
+def _entregar_todo(conn, comment_id):
+    """Simula la descarga y el envío de todas las imágenes y datos del comentario."""
+    filas = conn.execute("SELECT ordinal FROM download_queue WHERE comment_id = ?", (comment_id,)).fetchall()
+    for (ordinal,) in filas:
+        ruta = ruta_imagen(comment_id, ordinal)
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        with open(ruta, "wb") as f:
+            f.write(f"imagen {ordinal}".encode())
+        conn.execute("""
+            UPDATE download_queue SET status = 'descargada', local_path = ?, sent_at = '2000-01-01 00:00:00'
+            WHERE comment_id = ? AND ordinal = ?
+        """, (ruta, comment_id, ordinal))
+    conn.execute("""
+        UPDATE comentarios SET status = 'exitoso', data_sent_at = '2000-01-01 00:00:00',
+            images_sent_at = '2000-01-01 00:00:00', payload_hash = FINGERPRINT
+        WHERE id = ?
+    """, (comment_id,))
+    conn.commit()
+
+
+def test_reingreso_de_archivado_solo_encola_urls_nuevas(conn):
+    assert _sincronizar(conn, _datos(7, ["http://x/a", "http://x/b"])) == ("nuevo", 2)
+    _entregar_todo(conn, 7)
+    assert archivar_entregados(conn, dias=1)["comentarios"] == 1
+
+    assert _sincronizar(conn, _datos(7, ["http://x/a", "http://x/b", "http://x/c"], "editado")) == ("modificado", 1)
+
+    cola = conn.execute(
+        "SELECT ordinal, url, sent_at IS NOT NULL FROM download_queue WHERE comment_id = 7 ORDER BY ordinal"
+    ).fetchall()
+    assert cola == [(1, "http://x/a", 1), (2, "http://x/b", 1), (3, "http://x/c", 0)]
+    assert get_imagenes_enviadas(conn, 7) == {"7_1.jpg", "7_2.jpg"}
+    status, images_sent_at, datos_al_dia = conn.execute(
+        "SELECT status, images_sent_at, payload_hash IS FINGERPRINT FROM comentarios WHERE id = 7"
+    ).fetchone()
+    assert (status, images_sent_at, datos_al_dia) == ("pendiente", None, 0)
+    assert conn.execute("SELECT COUNT(*) FROM comentarios_archivados").fetchone()[0] == 0
+
+
+def test_archivar_dos_veces_no_duplica_la_cola(conn):
+    _sincronizar(conn, _datos(8, ["http://x/a"]))
+    _entregar_todo(conn, 8)
+    archivar_entregados(conn, dias=1)
+
+    _sincronizar(conn, _datos(8, ["http://x/a", "http://x/b"], "editado"))
+    _entregar_todo(conn, 8)
+    archivar_entregados(conn, dias=1)
+
+    adjuntar_base_archivo(conn)
+    cola = conn.execute("SELECT ordinal FROM archivo.download_queue WHERE comment_id = 8 ORDER BY ordinal").fetchall()
+    assert cola == [(1,), (2,)]